@@ -0,0 +1,333 @@
+"""End-to-end load test against the real service with a fake Supabase and webhook sink
+
+Starts an in-process stand-in for Supabase storage, PostgREST and the webhook
+receiver, launches the service on localhost pointed at it, then submits a
+request mix with Poisson arrivals and measures submit-to-webhook latency.
+
+    cd ffmpeg-service
+    python -m benchmarks.load_test --rate 2 --duration 60 \\
+        --mix thumbnail=0.5,watermark=0.2,resize=0.1,compat_thumbnail=0.1,compat_watermark=0.1
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import FileResponse, JSONResponse
+
+from benchmarks.run_benchmarks import SERVICE_DIR, generate_input
+
+REQUEST_KINDS = ["thumbnail", "preview", "watermark", "resize", "compat_thumbnail", "compat_watermark"]
+
+class FakeSupabase:
+    """Storage, PostgREST and webhook receiver endpoints backed by memory"""
+
+    def __init__(self, sources: Dict[str, str]):
+        self.sources = sources
+        self.objects: Dict[str, bytes] = {}
+        self.db_patches = 0
+        self.webhooks: Dict[str, Tuple[float, str]] = {}
+        self.app = self._build_app()
+
+    def _build_app(self) -> FastAPI:
+        app = FastAPI()
+
+        @app.api_route("/media/{name}", methods=["GET", "HEAD"])
+        async def media(name: str):
+            if name not in self.sources:
+                return Response(status_code=404)
+            return FileResponse(self.sources[name], media_type="video/mp4")
+
+        @app.post("/storage/v1/object/user-files/{path:path}")
+        async def upload(path: str, request: Request):
+            self.objects[path] = await request.body()
+            return {"Key": f"user-files/{path}"}
+
+        @app.get("/storage/v1/object/info/user-files/{path:path}")
+        async def object_info(path: str):
+            if path not in self.objects:
+                return JSONResponse({"error": "not_found"}, status_code=404)
+            return {"name": path, "size": len(self.objects[path])}
+
+        @app.api_route("/storage/v1/object/public/user-files/{path:path}", methods=["GET", "HEAD"])
+        async def public_object(path: str):
+            if path not in self.objects:
+                return Response(status_code=404)
+            return Response(self.objects[path], media_type="application/octet-stream")
+
+        @app.patch("/rest/v1/ai_generations")
+        async def patch_generations(request: Request):
+            await request.body()
+            self.db_patches += 1
+            if "return=representation" in request.headers.get("prefer", ""):
+                return JSONResponse([])
+            return Response(status_code=204)
+
+        @app.post("/webhook")
+        async def webhook(request: Request):
+            body = await request.json()
+            received = time.perf_counter()
+            for payload in body if isinstance(body, list) else [body]:
+                self.webhooks.setdefault(payload.get("processing_id"), (received, payload.get("status")))
+            return {"received": True}
+
+        return app
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    """Nearest-rank percentile"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return round(ordered[index], 3)
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    mix = {}
+    for part in spec.split(","):
+        kind, _, weight = part.partition("=")
+        kind = kind.strip()
+        if kind not in REQUEST_KINDS:
+            raise ValueError(f"Unknown request kind '{kind}' (choose from {', '.join(REQUEST_KINDS)})")
+        mix[kind] = float(weight or 1)
+    return mix
+
+def build_request(kind: str, n: int, video_url: str, webhook_url: str) -> Tuple[str, Dict[str, Any]]:
+    """Endpoint path and body for one request of the given kind"""
+    generation_id = f"load-{n}"
+    common = {"generation_id": generation_id, "video_url": video_url, "user_id": "load-test", "webhook_url": webhook_url}
+    if kind == "thumbnail":
+        return "/api/v1/extract-thumbnail", {**common, "timestamp": 1.0}
+    if kind == "preview":
+        return "/api/v1/create-preview", {**common, "duration": 2.0}
+    if kind == "watermark":
+        return "/api/v1/add-watermark", common
+    if kind == "resize":
+        return "/api/v1/resize-video", {**common, "width": 640, "height": 360}
+    if kind == "compat_thumbnail":
+        return "/extract-thumbnail", {
+            "generation_id": generation_id, "video_url": video_url,
+            "extract_frame": 0.1, "webhook_url": webhook_url
+        }
+    return "/apply-watermark", {
+        "generation_id": generation_id, "content_url": video_url,
+        "watermark_position": "bottom-center", "webhook_url": webhook_url
+    }
+
+async def wait_until_ready(url: str, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get(url)).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.25)
+    raise RuntimeError(f"{url} did not become ready within {timeout:.0f}s")
+
+def start_service(
+    port: int,
+    fake_url: str,
+    work_dir: str,
+    cache: bool,
+    workers: int,
+    extra_env: Dict[str, str]
+) -> subprocess.Popen:
+    env = {
+        **os.environ,
+        "SUPABASE_URL": fake_url,
+        "SUPABASE_SERVICE_ROLE_KEY": "load-test-key",
+        "SUPABASE_ANON_KEY": "load-test-key",
+        "RESUMABLE_UPLOAD_THRESHOLD_MB": "100000",
+        "ARTIFACT_CACHE_ENABLED": "true" if cache else "false",
+        "ARTIFACT_CACHE_PATH": os.path.join(work_dir, "artifacts.db"),
+        "WEBHOOK_OUTBOX_PATH": os.path.join(work_dir, "outbox.db"),
+        "JOB_QUEUE_PATH": os.path.join(work_dir, "jobs.db"),
+        "WORKSPACE_DIR": os.path.join(work_dir, "jobs"),
+        "LOG_LEVEL": os.environ.get("LOG_LEVEL", "WARNING"),
+        **extra_env
+    }
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning",
+         "--workers", str(workers)],
+        cwd=SERVICE_DIR,
+        env=env
+    )
+
+async def run_load(args) -> Dict[str, Any]:
+    mix = parse_mix(args.mix)
+    kinds, weights = list(mix), list(mix.values())
+    rng = random.Random(args.seed)
+
+    sources = {}
+    for spec in args.sources.split(","):
+        resolution, _, duration = spec.partition(":")
+        path = generate_input(resolution, int(duration or 4), "h264")
+        sources[os.path.basename(path)] = path
+
+    fake = FakeSupabase(sources)
+    fake_port = free_port()
+    fake_url = f"http://127.0.0.1:{fake_port}"
+    fake_server = uvicorn.Server(uvicorn.Config(fake.app, host="127.0.0.1", port=fake_port, log_level="warning"))
+    fake_task = asyncio.create_task(fake_server.serve())
+
+    work_dir = tempfile.mkdtemp(prefix="ffmpeg-load-")
+    service = None
+    service_url = args.service_url
+    if not service_url:
+        service_port = free_port()
+        service_url = f"http://127.0.0.1:{service_port}"
+        extra_env = dict(item.split("=", 1) for item in args.service_env)
+        service = start_service(service_port, fake_url, work_dir, args.cache, args.workers, extra_env)
+
+    submitted: Dict[str, Tuple[str, float]] = {}
+    submit_errors: Dict[str, int] = {kind: 0 for kind in kinds}
+    rejected: Dict[str, int] = {kind: 0 for kind in kinds}
+    counts: Dict[str, int] = {kind: 0 for kind in kinds}
+
+    try:
+        await wait_until_ready(f"{fake_url}/docs")
+        await wait_until_ready(f"{service_url}/health")
+        print(f"Service ready at {service_url}; fake Supabase at {fake_url}")
+
+        async with httpx.AsyncClient(base_url=service_url, timeout=30.0) as client:
+            async def submit(n: int, kind: str):
+                name = rng.choice(list(sources))
+                # Unique query string so single-flight does not merge requests
+                video_url = f"{fake_url}/media/{name}" + ("" if args.coalesce else f"?r={n}")
+                path, body = build_request(kind, n, video_url, f"{fake_url}/webhook")
+                started = time.perf_counter()
+                try:
+                    response = await client.post(path, json=body)
+                    # Admission control turning work away is reported apart from errors
+                    if response.status_code == 429:
+                        rejected[kind] += 1
+                        return
+                    response.raise_for_status()
+                    submitted[response.json()["processing_id"]] = (kind, started)
+                except (httpx.HTTPError, KeyError, ValueError) as e:
+                    submit_errors[kind] += 1
+                    print(f"⚠️ {kind} submit failed: {e}")
+
+            tasks = []
+            run_started = time.perf_counter()
+            n = 0
+            while time.perf_counter() - run_started < args.duration:
+                kind = rng.choices(kinds, weights)[0]
+                counts[kind] += 1
+                tasks.append(asyncio.create_task(submit(n, kind)))
+                n += 1
+                await asyncio.sleep(rng.expovariate(args.rate))
+            await asyncio.gather(*tasks)
+
+            # Drain: wait for outstanding webhooks
+            deadline = time.perf_counter() + args.timeout
+            while time.perf_counter() < deadline and any(pid not in fake.webhooks for pid in submitted):
+                await asyncio.sleep(0.2)
+
+            health = (await client.get("/health")).json()
+    finally:
+        if service:
+            service.terminate()
+            service.wait(timeout=30)
+        fake_server.should_exit = True
+        await fake_task
+
+    return report(kinds, counts, submitted, submit_errors, rejected, fake, run_started, health, args)
+
+def report(kinds, counts, submitted, submit_errors, rejected, fake, run_started, health, args) -> Dict[str, Any]:
+    def summarize(selected: List[str]) -> Dict[str, Any]:
+        latencies, failed, timed_out = [], 0, 0
+        for pid, (kind, started) in submitted.items():
+            if kind not in selected:
+                continue
+            received = fake.webhooks.get(pid)
+            if received is None:
+                timed_out += 1
+            elif received[1] != "completed":
+                failed += 1
+            else:
+                latencies.append(received[0] - started)
+        requests = sum(counts[kind] for kind in selected)
+        admitted = requests - sum(rejected[kind] for kind in selected)
+        errors = failed + timed_out + sum(submit_errors[kind] for kind in selected)
+        return {
+            "requests": requests,
+            "completed": len(latencies),
+            "failed": failed,
+            "timed_out": timed_out,
+            "submit_errors": sum(submit_errors[kind] for kind in selected),
+            "rejected": requests - admitted,
+            "error_rate": round(errors / admitted, 4) if admitted else 0.0,
+            "latency_p50_seconds": percentile(latencies, 50),
+            "latency_p95_seconds": percentile(latencies, 95),
+            "latency_p99_seconds": percentile(latencies, 99),
+            "latency_max_seconds": round(max(latencies), 3) if latencies else None
+        }
+
+    last_webhook = max((received for received, _ in fake.webhooks.values()), default=run_started)
+    overall = summarize(kinds)
+    elapsed = max(last_webhook - run_started, 1e-9)
+    result = {
+        "config": {
+            "rate": args.rate, "duration": args.duration, "mix": args.mix,
+            "sources": args.sources, "cache": args.cache, "workers": args.workers, "seed": args.seed
+        },
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_per_second": round(overall["completed"] / elapsed, 3),
+        "overall": overall,
+        "by_kind": {kind: summarize([kind]) for kind in kinds},
+        "fake_supabase": {"uploads": len(fake.objects), "db_patches": fake.db_patches},
+        "service_health": health
+    }
+
+    print(f"\n{'kind':<18} {'req':>5} {'ok':>5} {'429':>5} {'err%':>6} {'p50':>8} {'p95':>8} {'p99':>8}")
+    for kind, row in [*result["by_kind"].items(), ("overall", overall)]:
+        fmt = lambda v: f"{v:>7.2f}s" if v is not None else f"{'-':>8}"
+        print(
+            f"{kind:<18} {row['requests']:>5} {row['completed']:>5} {row['rejected']:>5} {row['error_rate']:>6.1%} "
+            f"{fmt(row['latency_p50_seconds'])} {fmt(row['latency_p95_seconds'])} {fmt(row['latency_p99_seconds'])}"
+        )
+    print(f"\nThroughput: {result['throughput_per_second']} jobs/s over {result['elapsed_seconds']}s")
+    return result
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=float, default=1.0, help="Mean arrivals per second (Poisson)")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds to keep submitting")
+    parser.add_argument("--mix", default="thumbnail=0.6,watermark=0.2,compat_thumbnail=0.1,compat_watermark=0.1")
+    parser.add_argument("--sources", default="720p:4", help="Comma-separated resolution:seconds test inputs")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Seconds to wait for webhooks after submitting")
+    parser.add_argument("--cache", action="store_true", help="Enable the artifact cache (off by default)")
+    parser.add_argument("--coalesce", action="store_true", help="Reuse source URLs so identical jobs can coalesce")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes sharing the job queue")
+    parser.add_argument("--service-url", default=None, help="Use an already running service configured for the fake")
+    parser.add_argument("--service-env", nargs="*", default=[], metavar="KEY=VALUE", help="Extra env for the service")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default=None, help="Write the report as JSON")
+    args = parser.parse_args(argv)
+
+    result = asyncio.run(run_load(args))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"Report written to {args.output}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
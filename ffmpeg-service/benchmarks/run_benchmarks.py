@@ -0,0 +1,243 @@
+"""Microbenchmarks for FFmpegProcessor operations on synthetic inputs
+
+Inputs are generated with ffmpeg's lavfi sources (testsrc2 + sine), so every
+machine benchmarks identical content. Each measurement runs in a fresh
+process to isolate CPU time and peak RSS.
+
+    cd ffmpeg-service
+    python -m benchmarks.run_benchmarks --output benchmarks/results/baseline.json
+    python -m benchmarks.run_benchmarks --baseline benchmarks/results/baseline.json
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import resource
+import statistics
+import subprocess
+import multiprocessing
+from datetime import datetime, timezone
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CACHE_DIR = os.path.join(SERVICE_DIR, "benchmarks", ".cache")
+WATERMARK_PATH = os.path.join(SERVICE_DIR, "assets", "default_watermark.png")
+
+RESOLUTIONS = {"360p": (640, 360), "720p": (1280, 720), "1080p": (1920, 1080)}
+
+# Codec -> (container, ffmpeg encoder args)
+CODECS = {
+    "h264": ("mp4", ["-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p", "-c:a", "aac"]),
+    "hevc": ("mp4", ["-c:v", "libx265", "-preset", "veryfast", "-pix_fmt", "yuv420p", "-tag:v", "hvc1",
+             "-x265-params", "log-level=error", "-c:a", "aac"]),
+    "vp9": ("webm", ["-c:v", "libvpx-vp9", "-deadline", "realtime", "-cpu-used", "8", "-b:v", "2M", "-c:a", "libopus"])
+}
+
+OPERATIONS = {
+    "extract_thumbnail": {"timestamp": 1.0, "width": 320, "height": 180},
+    "add_watermark": {"position": "bottom-center", "opacity": 0.9, "scale": 0.5},
+    "resize_video": {"width": 640, "height": 360, "preserve_aspect_ratio": True},
+    "get_video_metadata": {}
+}
+
+QUICK_MATRIX = {"resolutions": ["360p", "720p"], "durations": [4], "codecs": ["h264"]}
+FULL_MATRIX = {"resolutions": ["360p", "720p", "1080p"], "durations": [4, 15], "codecs": ["h264", "hevc", "vp9"]}
+
+def generate_input(resolution: str, duration: int, codec: str, fps: int = 30) -> str:
+    """Create (or reuse) a deterministic test video"""
+    width, height = RESOLUTIONS[resolution]
+    container, codec_args = CODECS[codec]
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = os.path.join(CACHE_DIR, f"src_{resolution}_{duration}s_{codec}.{container}")
+    if os.path.exists(path):
+        return path
+
+    cmd = [
+        "ffmpeg", "-y", "-hide_banner", "-loglevel", "error",
+        "-f", "lavfi", "-i", f"testsrc2=size={width}x{height}:rate={fps}:duration={duration}",
+        "-f", "lavfi", "-i", f"sine=frequency=440:sample_rate=48000:duration={duration}",
+        *codec_args,
+        "-threads", "1",
+        "-shortest",
+        path + ".tmp." + container
+    ]
+    subprocess.run(cmd, check=True)
+    os.replace(path + ".tmp." + container, path)
+    return path
+
+def _measure(operation: str, input_path: str, params: Dict[str, Any], work_dir: str) -> Dict[str, Any]:
+    """Run one operation in this (fresh) worker process and measure it"""
+    import logging
+    logging.disable(logging.CRITICAL)
+    sys.path.insert(0, SERVICE_DIR)
+    from utils.ffmpeg_processor import FFmpegProcessor
+
+    processor = FFmpegProcessor()
+    method = getattr(processor, operation)
+    kwargs = dict(params)
+    if operation == "add_watermark":
+        kwargs["watermark_path"] = WATERMARK_PATH
+    if operation != "get_video_metadata":
+        kwargs["work_dir"] = work_dir
+    # The service discovers capabilities once at startup, so their processes stay out of the timing
+    asyncio.run(processor.capabilities())
+
+    self_before = resource.getrusage(resource.RUSAGE_SELF)
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started = time.perf_counter()
+    error = None
+    try:
+        result = asyncio.run(method(input_path, **kwargs))
+    except Exception as e:
+        result = None
+        error = str(e)
+    wall = time.perf_counter() - started
+    self_after = resource.getrusage(resource.RUSAGE_SELF)
+    children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    if isinstance(result, dict) and result.get("error"):
+        error = result["error"]
+    output_bytes = 0
+    if isinstance(result, str) and os.path.exists(result):
+        output_bytes = os.path.getsize(result)
+        os.remove(result)
+
+    cpu = (
+        (self_after.ru_utime - self_before.ru_utime) + (self_after.ru_stime - self_before.ru_stime)
+        + (children_after.ru_utime - children_before.ru_utime) + (children_after.ru_stime - children_before.ru_stime)
+    )
+    # ru_maxrss is KB on Linux, bytes on macOS
+    rss_unit = 1 if sys.platform == "darwin" else 1024
+    return {
+        "wall_seconds": wall,
+        "cpu_seconds": cpu,
+        "ffmpeg_peak_rss_bytes": children_after.ru_maxrss * rss_unit,
+        "python_peak_rss_bytes": self_after.ru_maxrss * rss_unit,
+        "output_bytes": output_bytes,
+        "error": error
+    }
+
+def run_case(
+    pool: ProcessPoolExecutor,
+    operation: str,
+    input_path: str,
+    repeat: int,
+    work_dir: str
+) -> Dict[str, Any]:
+    """Repeat one operation and summarize (median wall/CPU, max RSS)"""
+    runs = [
+        pool.submit(_measure, operation, input_path, OPERATIONS[operation], work_dir).result()
+        for _ in range(repeat)
+    ]
+    errors = [run["error"] for run in runs if run["error"]]
+    walls = [run["wall_seconds"] for run in runs]
+    return {
+        "wall_seconds": round(statistics.median(walls), 4),
+        "wall_seconds_min": round(min(walls), 4),
+        "cpu_seconds": round(statistics.median(run["cpu_seconds"] for run in runs), 4),
+        "ffmpeg_peak_rss_mb": round(max(run["ffmpeg_peak_rss_bytes"] for run in runs) / 1e6, 1),
+        "python_peak_rss_mb": round(max(run["python_peak_rss_bytes"] for run in runs) / 1e6, 1),
+        "output_bytes": runs[-1]["output_bytes"],
+        "runs": repeat,
+        "error": errors[0] if errors else None
+    }
+
+def environment() -> Dict[str, Any]:
+    def command_output(cmd: List[str]) -> Optional[str]:
+        try:
+            return subprocess.run(cmd, capture_output=True, text=True, cwd=SERVICE_DIR).stdout.strip() or None
+        except OSError:
+            return None
+
+    ffmpeg_version = command_output(["ffmpeg", "-version"])
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "git_commit": command_output(["git", "rev-parse", "--short", "HEAD"]),
+        "ffmpeg": ffmpeg_version.splitlines()[0] if ffmpeg_version else None,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count()
+    }
+
+def compare(results: List[Dict[str, Any]], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    """Print wall-time deltas against a baseline; returns the regressed case ids"""
+    previous = {result["id"]: result for result in baseline.get("results", [])}
+    regressions = []
+    print(f"\n{'case':<48} {'base':>9} {'now':>9} {'delta':>8}")
+    for result in results:
+        before = previous.get(result["id"])
+        if not before or result["error"] or before.get("error"):
+            continue
+        delta = (result["wall_seconds"] - before["wall_seconds"]) / before["wall_seconds"]
+        flag = ""
+        if delta > threshold:
+            flag = "  REGRESSION"
+            regressions.append(result["id"])
+        print(f"{result['id']:<48} {before['wall_seconds']:>8.3f}s {result['wall_seconds']:>8.3f}s {delta:>+7.1%}{flag}")
+    return regressions
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--matrix", choices=["quick", "full"], default="quick")
+    parser.add_argument("--operations", nargs="+", choices=sorted(OPERATIONS), default=sorted(OPERATIONS))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", default=None, help="JSON results path (default: benchmarks/results/<timestamp>.json)")
+    parser.add_argument("--baseline", default=None, help="Earlier results JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Wall-time increase counted as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args(argv)
+
+    matrix = FULL_MATRIX if args.matrix == "full" else QUICK_MATRIX
+    work_dir = os.path.join(CACHE_DIR, "outputs")
+    os.makedirs(work_dir, exist_ok=True)
+
+    results = []
+    # A fresh process per measurement keeps rusage (CPU, peak RSS) per run
+    pool = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"), max_tasks_per_child=1)
+    try:
+        for codec in matrix["codecs"]:
+            for resolution in matrix["resolutions"]:
+                for duration in matrix["durations"]:
+                    input_path = generate_input(resolution, duration, codec)
+                    for operation in args.operations:
+                        case_id = f"{operation}/{codec}/{resolution}/{duration}s"
+                        result = {
+                            "id": case_id,
+                            "operation": operation,
+                            "codec": codec,
+                            "resolution": resolution,
+                            "duration_seconds": duration,
+                            "input_bytes": os.path.getsize(input_path),
+                            **run_case(pool, operation, input_path, args.repeat, work_dir)
+                        }
+                        results.append(result)
+                        status = f"error: {result['error'][:60]}" if result["error"] else (
+                            f"{result['wall_seconds']:.3f}s wall, {result['cpu_seconds']:.3f}s cpu, "
+                            f"{result['ffmpeg_peak_rss_mb']}MB rss, {result['output_bytes']} bytes"
+                        )
+                        print(f"{case_id:<48} {status}")
+    finally:
+        pool.shutdown()
+
+    output = args.output or os.path.join(
+        SERVICE_DIR, "benchmarks", "results", datetime.now().strftime("%Y%m%d-%H%M%S") + ".json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({"environment": environment(), "matrix": args.matrix, "repeat": args.repeat, "results": results}, f, indent=2)
+    print(f"\nResults written to {output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions and args.fail_on_regression:
+            print(f"{len(regressions)} case(s) regressed by more than {args.threshold:.0%}")
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,318 @@
+"""Quality/bitrate tuning for the codec profiles over a corpus of local videos
+
+Encodes every video through FFmpegProcessor.resize_video (the production
+encode path, at the source resolution) for each codec x speed preset x CRF
+in the grid. Each output is scored against its source with SSIM, PSNR and,
+when ffmpeg has libvmaf, VMAF. The report lists the Pareto frontier over
+size, quality and encode time, and the smallest setting per codec that
+matches the quality of today's H.264 profile, as CODEC_PROFILE_OVERRIDES.
+
+    cd ffmpeg-service
+    python -m benchmarks.tune_quality --corpus ~/videos/sample --report benchmarks/results/tuning.md
+    python -m benchmarks.tune_quality --codecs hevc --crfs 24 26 28 --speeds fast medium
+"""
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import argparse
+import resource
+import subprocess
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from benchmarks.run_benchmarks import SERVICE_DIR, CACHE_DIR, environment, generate_input
+
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".mkv", ".webm", ".avi", ".m4v")
+
+# CRFs per codec; each scale is the encoder's own, so the ranges differ
+CRF_GRID = {
+    "h264": [18, 21, 23, 26, 29],
+    "hevc": [22, 25, 28, 31, 34],
+    "av1": [27, 31, 35, 40, 45],
+    "vp9": [28, 32, 36, 40, 44]
+}
+# Encoder -> (speed option, values from slower/better to faster)
+SPEED_GRID = {
+    "libx264": ("preset", ["slow", "medium", "veryfast"]),
+    "libx265": ("preset", ["slow", "medium", "fast"]),
+    "libsvtav1": ("preset", [6, 8, 10]),
+    "libaom-av1": ("cpu-used", [4, 6, 8]),
+    "libvpx-vp9": ("cpu-used", [2, 4, 6])
+}
+METRICS = ("vmaf", "ssim", "psnr")
+
+# Summary lines of ffmpeg's quality filters
+VMAF_PATTERN = re.compile(r"VMAF score: ([0-9.]+)")
+SSIM_PATTERN = re.compile(r"SSIM Y:.* All:([0-9.]+)")
+PSNR_PATTERN = re.compile(r"PSNR y:.* average:([0-9.]+|inf)")
+
+def find_corpus(paths: List[str]) -> List[str]:
+    """Video files under the given files and directories"""
+    videos = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                videos.extend(os.path.join(root, name) for name in sorted(files) if name.lower().endswith(VIDEO_EXTENSIONS))
+        else:
+            videos.append(path)
+    return videos
+
+def score(output_path: str, source_path: str, width: int, height: int, vmaf: bool) -> Dict[str, Optional[float]]:
+    """SSIM (0-1), PSNR (dB) and VMAF (0-100) of an encode against its source, in one decode of each"""
+    metrics = ["ssim", "psnr"] + (["vmaf"] if vmaf else [])
+    count = len(metrics)
+    distorted = "".join(f"[d{index}]" for index in range(count))
+    reference = "".join(f"[r{index}]" for index in range(count))
+    # Frames are paired by index: timestamps rounded to a container's time base
+    # (milliseconds in WebM) would pair some frames with their neighbours
+    align = "settb=1/1000,setpts=N"
+    graph = (
+        f"[0:v]scale={width}:{height}:flags=bicubic,format=yuv420p,{align},split={count}{distorted};"
+        f"[1:v]format=yuv420p,{align},split={count}{reference}"
+    )
+    for index, metric in enumerate(metrics):
+        name = "libvmaf=n_threads=%d" % (os.cpu_count() or 1) if metric == "vmaf" else metric
+        graph += f";[d{index}][r{index}]{name}"
+    result = subprocess.run(
+        ["ffmpeg", "-hide_banner", "-nostats", "-i", output_path, "-i", source_path,
+         "-lavfi", graph, "-f", "null", "-"],
+        capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr else "scoring failed")
+
+    def parse(pattern: re.Pattern) -> Optional[float]:
+        match = pattern.search(result.stderr)
+        return float(match.group(1)) if match else None
+
+    return {"ssim": parse(SSIM_PATTERN), "psnr": parse(PSNR_PATTERN), "vmaf": parse(VMAF_PATTERN) if vmaf else None}
+
+async def encode(processor, source_path: str, source: Dict[str, Any], codec: str,
+                 overrides: Dict[str, Any], work_dir: str) -> Tuple[str, float, float]:
+    """One encode through resize_video with profile overrides; (path, wall seconds, ffmpeg CPU seconds)"""
+    processor.profile_overrides = {processor.encoder_for(codec): overrides}
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started = time.perf_counter()
+    output_path = await processor.resize_video(
+        source_path, width=source["width"], codec=codec, h264_fallback=False, work_dir=work_dir
+    )
+    wall = time.perf_counter() - started
+    children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = (children_after.ru_utime - children_before.ru_utime) + (children_after.ru_stime - children_before.ru_stime)
+    return output_path, wall, cpu
+
+def pareto_front(sizes: np.ndarray, qualities: np.ndarray, seconds: Optional[np.ndarray] = None) -> np.ndarray:
+    """Mask of points no other point beats: no larger, no worse and (if given) no slower, better in one"""
+    costs = np.column_stack([sizes, -qualities] + ([seconds] if seconds is not None else []))
+    no_worse = (costs[None, :, :] <= costs[:, None, :]).all(axis=2)
+    better = (costs[None, :, :] < costs[:, None, :]).any(axis=2)
+    # dominated[i]: some j is no worse than i everywhere and better somewhere
+    return ~(no_worse & better).any(axis=1)
+
+def summarize(runs: List[Dict[str, Any]], metric: str) -> List[Dict[str, Any]]:
+    """Grid points over the whole corpus: total bytes and encode time, mean quality"""
+    points: Dict[str, Dict[str, Any]] = {}
+    for run in runs:
+        if run.get("error"):
+            continue
+        point = points.setdefault(run["setting"], {
+            key: run[key] for key in ("setting", "codec", "encoder", "speed_option", "speed", "crf", "default")
+        } | {"output_bytes": 0, "encode_seconds": 0.0, "cpu_seconds": 0.0, "quality": [], "videos": 0})
+        point["output_bytes"] += run["output_bytes"]
+        point["encode_seconds"] += run["encode_seconds"]
+        point["cpu_seconds"] += run["cpu_seconds"]
+        point["quality"].append(run[metric])
+        point["videos"] += 1
+
+    # Only settings that encoded every video are comparable
+    videos = max((point["videos"] for point in points.values()), default=0)
+    summary = [point for point in points.values() if point["videos"] == videos]
+    if not summary:
+        return []
+    for point in summary:
+        point["quality"] = round(float(np.mean(point["quality"])), 4)
+        point["encode_seconds"] = round(point["encode_seconds"], 3)
+        point["cpu_seconds"] = round(point["cpu_seconds"], 3)
+
+    sizes = np.array([point["output_bytes"] for point in summary], dtype=np.float64)
+    qualities = np.array([point["quality"] for point in summary])
+    seconds = np.array([point["encode_seconds"] for point in summary])
+    size_quality = pareto_front(sizes, qualities)
+    with_time = pareto_front(sizes, qualities, seconds)
+    for index, point in enumerate(summary):
+        point["size_quality_frontier"] = bool(size_quality[index])
+        point["frontier"] = bool(with_time[index])
+    return sorted(summary, key=lambda point: (point["codec"], point["output_bytes"]))
+
+def recommend(summary: List[Dict[str, Any]], target: float) -> Dict[str, Dict[str, Any]]:
+    """Per codec, the smallest frontier setting at or above the target quality"""
+    picks = {}
+    for point in summary:
+        if not point["frontier"] or point["quality"] < target:
+            continue
+        best = picks.get(point["codec"])
+        if best is None or (point["output_bytes"], point["encode_seconds"]) < (best["output_bytes"], best["encode_seconds"]):
+            picks[point["codec"]] = point
+    return picks
+
+def report(summary: List[Dict[str, Any]], picks: Dict[str, Dict[str, Any]], metric: str,
+           target: float, baseline: Optional[Dict[str, Any]], videos: List[str]) -> str:
+    """Markdown report: the frontier table, then the recommended profile overrides"""
+    lines = [
+        f"# Codec profile tuning ({len(videos)} videos, quality = mean {metric.upper()})",
+        "",
+        "| setting | bytes | quality | encode s | frontier |",
+        "|---------|------:|--------:|---------:|:--------:|"
+    ]
+    for point in summary:
+        mark = "●" if point["frontier"] else ("○" if point["size_quality_frontier"] else "")
+        lines.append(
+            f"| {point['setting']} | {point['output_bytes']} | {point['quality']} | {point['encode_seconds']} | {mark} |"
+        )
+    lines += [
+        "",
+        "● Pareto-optimal over size, quality and encode time; ○ over size and quality only.",
+        ""
+    ]
+    if baseline:
+        lines.append(f"Target quality {target} is the current H.264 profile ({baseline['setting']}, {baseline['output_bytes']} bytes).")
+    else:
+        lines.append(f"Target quality: {target}.")
+    lines.append("")
+    overrides = {}
+    for codec, point in sorted(picks.items()):
+        saved = ""
+        if baseline:
+            change = point['output_bytes'] / baseline['output_bytes'] - 1
+            saved = f", {abs(100 * change):.1f}% {'larger' if change > 0 else 'smaller'} than the H.264 profile"
+        lines.append(f"- **{codec}**: {point['setting']} ({point['output_bytes']} bytes, {point['encode_seconds']}s{saved})")
+        overrides[point["encoder"]] = {point["speed_option"]: point["speed"], "crf": point["crf"]}
+    if overrides:
+        lines += ["", "```bash", f"CODEC_PROFILE_OVERRIDES='{json.dumps(overrides)}'", "```"]
+    else:
+        lines.append("No setting reached the target quality.")
+    return "\n".join(lines) + "\n"
+
+async def tune(args: argparse.Namespace, videos: List[str], work_dir: str) -> List[Dict[str, Any]]:
+    # Grid encodes would skew the service's learned run times
+    os.environ["COST_MODEL_PATH"] = os.path.join(work_dir, "tuning_cost_model.db")
+    os.environ["TRACING_ENABLED"] = "false"
+    sys.path.insert(0, SERVICE_DIR)
+    from utils.ffmpeg_processor import FFmpegProcessor, CODEC_PROFILES
+
+    processor = FFmpegProcessor()
+    capabilities = await processor.capabilities()
+    vmaf = "libvmaf" in capabilities["filters"]
+    if not vmaf:
+        print("libvmaf not in this ffmpeg build; scoring SSIM and PSNR only")
+
+    runs = []
+    for codec in args.codecs:
+        encoder = processor.encoder_for(codec)
+        if encoder is None:
+            print(f"Skipping {codec}: no encoder in this ffmpeg build")
+            continue
+        speed_option, speeds = SPEED_GRID[encoder]
+        defaults = dict(CODEC_PROFILES[codec]["encoders"])[encoder]
+        speeds = args.speeds or speeds
+        crfs = args.crfs or CRF_GRID[codec]
+        # The shipped profile is always measured, so the report has its baseline
+        grid = {(defaults.get(speed_option), defaults["crf"])}
+        grid.update((speed, crf) for speed in speeds for crf in crfs)
+
+        for speed, crf in sorted(grid, key=lambda item: (str(item[0]), item[1])):
+            if isinstance(speed, str) and speed.isdigit():
+                speed = int(speed)
+            setting = f"{codec}/{encoder} {speed_option}={speed} crf={crf}"
+            for video in videos:
+                source = await processor.probe_source(video)
+                run = {
+                    "setting": setting, "codec": codec, "encoder": encoder, "speed_option": speed_option,
+                    "speed": speed, "crf": crf, "video": video,
+                    "default": speed == defaults.get(speed_option) and crf == defaults["crf"]
+                }
+                try:
+                    if source is None:
+                        raise ValueError("could not probe the video")
+                    output_path, wall, cpu = await encode(
+                        processor, video, source, codec, {speed_option: speed, "crf": crf}, work_dir
+                    )
+                    try:
+                        run.update(
+                            output_bytes=os.path.getsize(output_path),
+                            encode_seconds=round(wall, 3),
+                            cpu_seconds=round(cpu, 3),
+                            **score(output_path, video, source["width"], source["height"], vmaf)
+                        )
+                    finally:
+                        os.remove(output_path)
+                    status = (f"{run['output_bytes']:>10} bytes {run['encode_seconds']:>7.2f}s "
+                              + " ".join(f"{metric}={run[metric]}" for metric in METRICS if run[metric] is not None))
+                except Exception as e:
+                    run["error"] = str(e)
+                    status = f"error: {run['error'][:60]}"
+                runs.append(run)
+                print(f"{setting:<44} {os.path.basename(video):<28} {status}")
+    return runs
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", nargs="+", default=None,
+                        help="Video files or directories (default: the generated 360p/720p benchmark clips)")
+    parser.add_argument("--codecs", nargs="+", choices=sorted(CRF_GRID), default=sorted(CRF_GRID))
+    parser.add_argument("--crfs", nargs="+", type=int, default=None, help="CRFs for every codec (default: per-codec grid)")
+    parser.add_argument("--speeds", nargs="+", default=None, help="Presets/cpu-used values for every codec")
+    parser.add_argument("--metric", choices=METRICS, default=None, help="Quality used for the frontier (default: vmaf if available, else ssim)")
+    parser.add_argument("--target", type=float, default=None, help="Minimum quality (default: the current H.264 profile's)")
+    parser.add_argument("--output", default=None, help="JSON results path (default: benchmarks/results/tuning-<timestamp>.json)")
+    parser.add_argument("--report", default=None, help="Also write the Markdown report here")
+    args = parser.parse_args(argv)
+
+    import logging
+    logging.disable(logging.CRITICAL)
+
+    videos = find_corpus(args.corpus) if args.corpus else [
+        generate_input("360p", 4, "h264"), generate_input("720p", 4, "h264")
+    ]
+    if not videos:
+        print("No videos in the corpus")
+        return 1
+    work_dir = os.path.join(CACHE_DIR, "outputs")
+    os.makedirs(work_dir, exist_ok=True)
+
+    runs = asyncio.run(tune(args, videos, work_dir))
+    metric = args.metric or ("vmaf" if any(run.get("vmaf") is not None for run in runs) else "ssim")
+    summary = summarize(runs, metric)
+    baseline = next((point for point in summary if point["codec"] == "h264" and point["default"]), None)
+    target = args.target if args.target is not None else (baseline["quality"] if baseline else 0.0)
+    picks = recommend(summary, target)
+    markdown = report(summary, picks, metric, target, baseline, videos)
+    print("\n" + markdown)
+
+    output = args.output or os.path.join(
+        SERVICE_DIR, "benchmarks", "results", datetime.now().strftime("tuning-%Y%m%d-%H%M%S") + ".json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({
+            "environment": environment(),
+            "metric": metric,
+            "target": target,
+            "videos": videos,
+            "runs": runs,
+            "summary": summary,
+            "recommended": {codec: point["setting"] for codec, point in picks.items()}
+        }, f, indent=2)
+    print(f"Results written to {output}")
+    if args.report:
+        with open(args.report, "w") as f:
+            f.write(markdown)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
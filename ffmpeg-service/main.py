@@ -1,25 +1,53 @@
 ﻿import os
 import uuid
 import logging
-from typing import Optional, Dict, Any
+import asyncio
+from typing import Optional, Dict, Any, List, Tuple, Callable, Awaitable
+from urllib.parse import urlparse
+from contextvars import ContextVar
 from datetime import datetime
-from fastapi import FastAPI, HTTPException, BackgroundTasks, Header
+import time
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Header, Request, Depends
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import httpx
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, AsyncExitStack
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# Configure logging (LOG_FORMAT=json for structured logs)
+from utils.log_config import configure_logging
+log_listener = configure_logging()
 logger = logging.getLogger(__name__)
 
 # Import processors
-from utils.ffmpeg_processor import FFmpegProcessor
+from utils.ffmpeg_processor import FFmpegProcessor, DEFAULT_WATERMARK_PATH
 from utils.storage import StorageManager
+from utils.storage_backends import LocalStorageBackend, content_type_for, parse_range, iter_file_range
 from utils.webhook import WebhookManager
+from utils.singleflight import SingleFlight
+from utils.artifact_cache import ArtifactCache, ArtifactCacheHit
+from utils.stage_graph import StageGraph
+from utils.workspace import WorkspaceManager
+from utils.job_queue import JobQueue, JobRunner
+from utils.admission import AdmissionController, AdmissionRejected
+from utils.cost_model import cost_model
+from utils.transform import TransformPlan, TransformPlanError
+from utils.fingerprint import FingerprintIndex, FRAME_SIZE, frame_hashes
+from utils.keyframe_index import KeyframeIndex, KeyframeIndexCache
+from utils.metrics import (
+    REGISTRY as metrics_registry,
+    STAGE_SECONDS,
+    STAGE_ERRORS,
+    JOBS_IN_FLIGHT,
+    JOBS_WAITING,
+    JOBS_QUEUED,
+    BACKLOG_SECONDS,
+    ADMISSION_REJECTED,
+    NEAR_DUPLICATE_HITS,
+    WEBHOOK_OUTBOX_PENDING,
+    current_operation
+)
+from utils.tracing import tracer
 from models.schemas import (
     ThumbnailRequest, 
     WatermarkRequest, 
@@ -27,6 +55,10 @@ from models.schemas import (
     ResizeVideoRequest,
     MergeVideosRequest,
     ExtractAudioRequest,
+    PreviewOptions,
+    PreviewRequest,
+    CodecOptions,
+    TransformRequest,
     ProcessingResponse
 )
 
@@ -35,12 +67,42 @@ from models.schemas import (
 async def lifespan(app: FastAPI):
     # Startup
     logger.info("🚀 FFmpeg microservice starting up...")
-    logger.info(f"Environment: {os.getenv('RAILWAY_ENVIRONMENT', 'development')}")
-    logger.info(f"Port: {os.getenv('PORT', '8000')}")
-    logger.info(f"Supabase URL: {'Configured' if os.getenv('SUPABASE_URL') else 'Not configured'}")
+    logger.info("Environment: %s", os.getenv('RAILWAY_ENVIRONMENT', 'development'))
+    logger.info("Port: %s", os.getenv('PORT', '8000'))
+    logger.info("Supabase URL: %s", 'Configured' if os.getenv('SUPABASE_URL') else 'Not configured')
+    await start_background_services(
+        run_jobs=os.getenv("JOB_QUEUE_EMBEDDED_WORKER", "true").lower() != "false"
+    )
     yield
     # Shutdown
     logger.info("🛑 FFmpeg microservice shutting down...")
+    await stop_background_services(DRAIN_GRACE_SECONDS)
+
+async def start_background_services(run_jobs: bool):
+    """Start capability discovery, the workspace sweeper, webhook outbox and (optionally) the queued-job worker"""
+    ffmpeg_processor.start_discovery()
+    await workspace_manager.start()
+    if webhook_manager.outbox:
+        await webhook_manager.outbox.start()
+    if run_jobs and job_runner:
+        await job_runner.start()
+
+async def stop_background_services(grace: float = 0.0):
+    """Drain running jobs for up to `grace` seconds, requeue the rest and stop background work"""
+    begin_drain()
+    if job_runner:
+        drain_state.update(await job_runner.stop(grace))
+    if webhook_manager.outbox:
+        await webhook_manager.outbox.stop()
+    # Deferred work is optional (cache warming); cancelling it releases the workspaces it holds
+    for task in deferred_tasks:
+        task.cancel()
+    if deferred_tasks:
+        await asyncio.wait(deferred_tasks)
+    await workspace_manager.stop()
+    await storage_manager.generation_updates.close()
+    if log_listener:
+        log_listener.stop()
 
 # Initialize FastAPI app
 app = FastAPI(
@@ -63,6 +125,52 @@ app.add_middleware(
 ffmpeg_processor = FFmpegProcessor()
 storage_manager = StorageManager()
 webhook_manager = WebhookManager()
+single_flight = SingleFlight()
+artifact_cache = ArtifactCache()
+fingerprint_index = FingerprintIndex()
+keyframe_cache = KeyframeIndexCache()
+workspace_manager = WorkspaceManager()
+# Durable queue shared by every worker process; disabled runs jobs as in-process background tasks
+job_queue = JobQueue() if os.getenv("JOB_QUEUE_ENABLED", "true").lower() != "false" else None
+admission = AdmissionController(job_queue.backlog if job_queue else lambda: 0.0)
+# Submitted jobs are costed from the source's size; the cost is corrected once the source is downloaded
+PROBE_TIMEOUT_SECONDS = float(os.getenv("COST_MODEL_PROBE_TIMEOUT_SECONDS", "5"))
+# (processing_id, request params) of the queued or background job running in this context
+current_job: ContextVar[Optional[Tuple[str, Dict[str, Any]]]] = ContextVar("current_job", default=None)
+
+# Draining instances reject new jobs and report it on /health
+DRAIN_GRACE_SECONDS = float(os.getenv("DRAIN_GRACE_SECONDS", "25"))
+DRAIN_TOKEN = os.getenv("DRAIN_TOKEN", "")
+drain_state: Dict[str, Any] = {"draining": False, "started_at": None, "finished": 0, "requeued": 0}
+
+def begin_drain():
+    """Stop taking new jobs; running jobs continue"""
+    if not drain_state["draining"]:
+        logger.info("🚰 Draining: new jobs are rejected")
+        drain_state.update(draining=True, started_at=datetime.utcnow().isoformat())
+    if job_runner:
+        job_runner.draining = True
+
+async def reject_when_draining():
+    if drain_state["draining"]:
+        raise HTTPException(
+            status_code=503,
+            detail="Instance is draining, retry on another instance",
+            headers={"Retry-After": "5"}
+        )
+
+# Expected scratch space per job, as a multiple of the source size
+WORKSPACE_SIZE_FACTORS = {"thumbnail": 1.2, "preview": 1.3, "watermark": 2.5, "resize": 2.5, "transform": 2.5, "metadata": 1.0, "keyframes": 1.0}
+DEFAULT_SOURCE_BYTES = int(os.getenv("WORKSPACE_DEFAULT_SOURCE_MB", "200")) * 1024 * 1024
+
+# Queue depth gauges are read at scrape time
+JOBS_IN_FLIGHT.set_function(single_flight.in_flight)
+JOBS_WAITING.set_function(lambda: workspace_manager.waiting)
+BACKLOG_SECONDS.set_function(admission.backlog)
+if job_queue:
+    JOBS_QUEUED.set_function(lambda: job_queue.stats()["queued"])
+if webhook_manager.outbox:
+    WEBHOOK_OUTBOX_PENDING.set_function(lambda: webhook_manager.outbox.stats()["pending"])
 
 # Root endpoint
 @app.get("/")
@@ -78,7 +186,19 @@ async def root():
             "/api/v1/extract-thumbnail",
             "/api/v1/add-watermark",
             "/api/v1/get-metadata",
+            "/api/v1/keyframes",
             "/api/v1/resize-video",
+            "/api/v1/create-preview",
+            "/api/v1/transform",
+            "/api/v1/jobs/{processing_id}",
+            "/api/v1/explain/{operation}",
+            "/api/v1/drain",
+            "/api/v1/capabilities",
+            "/api/v1/webhook-outbox",
+            "/api/v1/traces/{processing_id}",
+            "/capacity",
+            "/metrics",
+            "/files/{path}",
             "/extract-thumbnail",
             "/apply-watermark"
         ]
@@ -88,19 +208,174 @@ async def root():
 @app.get("/health")
 async def health_check():
     """Health check endpoint for Railway"""
-    # Test FFmpeg availability
-    ffmpeg_status = await ffmpeg_processor.check_ffmpeg()
+    # FFmpeg availability comes from the discovery run at startup; polls don't spawn processes
+    capabilities = await ffmpeg_processor.capabilities()
     
-    return {
-        "status": "healthy",
+    health = {
+        "status": "draining" if drain_state["draining"] else "healthy",
         "service": "ffmpeg-processor",
         "timestamp": datetime.utcnow().isoformat(),
-        "ffmpeg_available": ffmpeg_status,
-        "storage_configured": storage_manager.is_configured()
+        "ffmpeg_available": capabilities["available"],
+        "ffmpeg": {
+            key: capabilities[key]
+            for key in ("version", "ffprobe_json", "ffmpeg_python", "missing", "discovered_at")
+        },
+        "storage_configured": storage_manager.is_configured(),
+        "storage": storage_manager.backend.describe(),
+        "in_flight_jobs": single_flight.in_flight(),
+        "coalesced_requests": single_flight.coalesced_count,
+        "artifact_cache": artifact_cache.stats(),
+        "fingerprints": fingerprint_index.stats(),
+        "keyframe_indexes": keyframe_cache.stats(),
+        "workspaces": workspace_manager.stats(),
+        "job_queue": {**await asyncio.to_thread(job_queue.stats), "worker": job_runner.stats()} if job_queue else None,
+        "cost_model": await asyncio.to_thread(cost_model.stats),
+        "webhook_outbox": await asyncio.to_thread(webhook_manager.outbox.stats) if webhook_manager.outbox else None,
+        "drain": drain_state
     }
+    # 503 takes a draining instance out of load balancer rotation
+    return JSONResponse(health, status_code=503 if drain_state["draining"] else 200)
+
+# Full capability discovery result
+@app.get("/api/v1/capabilities")
+async def get_capabilities():
+    """FFmpeg version, encoders, filters and ffprobe support, as discovered at startup"""
+    return await ffmpeg_processor.capabilities()
+
+# Admission capacity for edge functions and autoscalers
+@app.get("/capacity")
+async def capacity():
+    """Remaining backlog budget and estimated queue wait"""
+    report = await asyncio.to_thread(admission.capacity)
+    report["accepting"] = not drain_state["draining"] and (report["remaining_seconds"] > 0 or not admission.enabled)
+    if job_queue:
+        stats = await asyncio.to_thread(job_queue.stats)
+        report.update(queued_jobs=stats["queued"], running_jobs=stats["running"])
+    return report
+
+# Start draining ahead of shutdown (e.g. from a pre-stop hook)
+@app.post("/api/v1/drain")
+async def drain(authorization: Optional[str] = Header(None)):
+    """Reject new jobs and stop claiming queued ones; requires DRAIN_TOKEN"""
+    if not DRAIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Drain endpoint is disabled")
+    if authorization != f"Bearer {DRAIN_TOKEN}":
+        raise HTTPException(status_code=401, detail="Invalid drain token")
+    begin_drain()
+    return {"drain": drain_state, "running_jobs": job_runner.stats()["running"] if job_runner else None}
+
+# Prometheus metrics
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Prometheus metrics in the text exposition format"""
+    # Queue depth gauges read SQLite at scrape time, so render off the event loop
+    return PlainTextResponse(
+        await asyncio.to_thread(metrics_registry.render),
+        media_type="text/plain; version=0.0.4"
+    )
+
+# Queued job status
+@app.get("/api/v1/jobs/{processing_id}")
+async def get_job(processing_id: str):
+    """Queue state of a job: status, attempts, timings and last error"""
+    if not job_queue:
+        raise HTTPException(status_code=404, detail="Job queue is disabled")
+    job = await asyncio.to_thread(job_queue.get, processing_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    job.pop("payload")
+    return job
+
+# Dry run of a job
+@app.post("/api/v1/explain/{operation}")
+async def explain_job(operation: str, request: dict):
+    """ffmpeg commands, predicted run time and output size of a job, without running it"""
+    if operation not in JOB_HANDLERS:
+        raise HTTPException(status_code=404, detail=f"Unknown operation: {operation}")
+    try:
+        job_request = JOB_HANDLERS[operation][0].model_validate(request)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    params = job_request.model_dump()
+    check_source_url(job_request.video_url)
+    await check_codec(job_request)
+    source = await describe_source(job_request.video_url, probe=True)
+    check_target_size(job_request, source)
+    try:
+        commands = ffmpeg_processor.plan_commands(operation, params, source)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    prediction = await asyncio.to_thread(cost_model.predict, operation, params, source)
+    backlog = await asyncio.to_thread(admission.backlog)
+    return {
+        "operation": operation,
+        "source": source,
+        "commands": commands,
+        "predicted_seconds": prediction["seconds"],
+        "predicted_output_bytes": prediction["output_bytes"],
+        "runs": prediction["runs"],
+        "queue": {
+            "backlog_seconds": round(backlog, 3),
+            "estimated_wait_seconds": round(backlog / admission.slots, 3),
+            "retry_after": admission.retry_after(prediction["seconds"], backlog)
+        }
+    }
+
+# Webhook outbox delivery stats
+@app.get("/api/v1/webhook-outbox")
+async def webhook_outbox_stats():
+    """Webhook outbox queue sizes and delivery lag"""
+    if not webhook_manager.outbox:
+        raise HTTPException(status_code=404, detail="Webhook outbox is disabled")
+    return await asyncio.to_thread(webhook_manager.outbox.stats)
+
+# Recent job traces
+@app.get("/api/v1/traces/{processing_id}")
+async def get_trace(processing_id: str):
+    """Spans recorded for a job, from the in-memory trace exporter"""
+    if not tracer.memory:
+        raise HTTPException(status_code=404, detail="In-memory trace exporter is disabled")
+    trace_id = tracer.trace_id_for(processing_id)
+    spans = tracer.memory.get_trace(trace_id)
+    if not spans:
+        raise HTTPException(status_code=404, detail="Trace not found")
+    return {"processing_id": processing_id, "trace_id": trace_id, "spans": spans}
+
+# Outputs stored by the local storage backend
+@app.api_route("/files/{path:path}", methods=["GET", "HEAD"])
+async def serve_stored_file(path: str, request: Request):
+    """Serve a locally stored output, honouring single byte-range requests"""
+    backend = storage_manager.backend
+    file_path = backend.resolve(path) if isinstance(backend, LocalStorageBackend) else None
+    if file_path is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    size = os.path.getsize(file_path)
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Cache-Control": backend.cache_control(path),
+        "Content-Type": content_type_for(os.path.splitext(file_path)[1])
+    }
+    try:
+        byte_range = parse_range(request.headers.get("range"), size)
+    except ValueError:
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+    
+    status_code = 200
+    start, end = 0, size - 1
+    if byte_range is not None:
+        start, end = byte_range
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    
+    if request.method == "HEAD":
+        return Response(status_code=status_code, headers=headers)
+    return StreamingResponse(iter_file_range(file_path, start, end), status_code=status_code, headers=headers)
 
 # Extract thumbnail from video
-@app.post("/api/v1/extract-thumbnail", response_model=ProcessingResponse)
+@app.post("/api/v1/extract-thumbnail", response_model=ProcessingResponse, dependencies=[Depends(reject_when_draining)])
 async def extract_thumbnail(
     request: ThumbnailRequest,
     background_tasks: BackgroundTasks,
@@ -108,17 +383,13 @@ async def extract_thumbnail(
 ):
     """Extract a thumbnail from a video at specified timestamp"""
     try:
-        logger.info(f"📸 Extracting thumbnail for generation: {request.generation_id}")
+        logger.info("📸 Extracting thumbnail for generation: %s", request.generation_id)
         
         # Generate processing ID
         processing_id = str(uuid.uuid4())
         
         # Process in background
-        background_tasks.add_task(
-            process_thumbnail_extraction,
-            processing_id,
-            request
-        )
+        await submit_job("thumbnail", processing_id, request, background_tasks)
         
         return ProcessingResponse(
             success=True,
@@ -127,12 +398,14 @@ async def extract_thumbnail(
             status="processing"
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"❌ Error starting thumbnail extraction: {str(e)}")
+        logger.error("❌ Error starting thumbnail extraction: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 # Add watermark to video
-@app.post("/api/v1/add-watermark", response_model=ProcessingResponse)
+@app.post("/api/v1/add-watermark", response_model=ProcessingResponse, dependencies=[Depends(reject_when_draining)])
 async def add_watermark(
     request: WatermarkRequest,
     background_tasks: BackgroundTasks,
@@ -140,17 +413,13 @@ async def add_watermark(
 ):
     """Add watermark to a video"""
     try:
-        logger.info(f"💧 Adding watermark for generation: {request.generation_id}")
+        logger.info("💧 Adding watermark for generation: %s", request.generation_id)
         
         # Generate processing ID
         processing_id = str(uuid.uuid4())
         
         # Process in background
-        background_tasks.add_task(
-            process_watermark_addition,
-            processing_id,
-            request
-        )
+        await submit_job("watermark", processing_id, request, background_tasks)
         
         return ProcessingResponse(
             success=True,
@@ -159,8 +428,10 @@ async def add_watermark(
             status="processing"
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"❌ Error starting watermark addition: {str(e)}")
+        logger.error("❌ Error starting watermark addition: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 # Get video metadata
@@ -168,25 +439,54 @@ async def add_watermark(
 async def get_video_metadata(request: VideoMetadataRequest):
     """Extract metadata from a video file"""
     try:
-        logger.info(f"📊 Getting metadata for: {request.video_url}")
+        logger.info("📊 Getting metadata for: %s", request.video_url)
         
-        # Download video temporarily
-        video_path = await storage_manager.download_temp_file(request.video_url)
+        current_operation.set("metadata")
+        async with acquire_workspace("metadata", request.video_url) as workspace:
+            # Download video temporarily
+            started = time.perf_counter()
+            video_path = await storage_manager.download_temp_file(request.video_url, workspace.path)
+            STAGE_SECONDS.labels("metadata", "download").observe(time.perf_counter() - started)
+            
+            # Get metadata
+            started = time.perf_counter()
+            metadata = await ffmpeg_processor.get_video_metadata(video_path)
+            STAGE_SECONDS.labels("metadata", "probe").observe(time.perf_counter() - started)
+            if "error" in metadata:
+                STAGE_ERRORS.labels("metadata", "probe").inc()
         
-        # Get metadata
-        metadata = await ffmpeg_processor.get_video_metadata(video_path)
+        return metadata
+        
+    except Exception as e:
+        logger.error("❌ Error getting metadata: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+# Keyframe/GOP index of a video
+@app.post("/api/v1/keyframes", response_model=Dict[str, Any])
+async def get_keyframe_index(request: VideoMetadataRequest):
+    """Keyframe times and offsets, GOP lengths and per-second bitrate of a video"""
+    try:
+        logger.info("🗂️ Getting keyframe index for: %s", request.video_url)
         
-        # Cleanup
-        await storage_manager.cleanup_temp_file(video_path)
+        current_operation.set("keyframes")
+        async with acquire_workspace("keyframes", request.video_url) as workspace:
+            started = time.perf_counter()
+            video_path = await storage_manager.download_temp_file(request.video_url, workspace.path)
+            STAGE_SECONDS.labels("keyframes", "download").observe(time.perf_counter() - started)
+            
+            started = time.perf_counter()
+            source_hash = await artifact_cache.register_source(request.video_url, video_path)
+            keyframes = await load_keyframes(video_path, source_hash)
+            STAGE_SECONDS.labels("keyframes", "index").observe(time.perf_counter() - started)
         
-        return metadata
+        return {"source_hash": source_hash, **keyframes.summary()}
         
     except Exception as e:
-        logger.error(f"❌ Error getting metadata: {str(e)}")
+        logger.error("❌ Error getting keyframe index: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 # Resize/compress video
-@app.post("/api/v1/resize-video", response_model=ProcessingResponse)
+@app.post("/api/v1/resize-video", response_model=ProcessingResponse, dependencies=[Depends(reject_when_draining)])
 async def resize_video(
     request: ResizeVideoRequest,
     background_tasks: BackgroundTasks,
@@ -194,15 +494,11 @@ async def resize_video(
 ):
     """Resize or compress a video"""
     try:
-        logger.info(f"📐 Resizing video for generation: {request.generation_id}")
+        logger.info("📐 Resizing video for generation: %s", request.generation_id)
         
         processing_id = str(uuid.uuid4())
         
-        background_tasks.add_task(
-            process_video_resize,
-            processing_id,
-            request
-        )
+        await submit_job("resize", processing_id, request, background_tasks)
         
         return ProcessingResponse(
             success=True,
@@ -211,15 +507,73 @@ async def resize_video(
             status="processing"
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"❌ Error starting video resize: {str(e)}")
+        logger.error("❌ Error starting video resize: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+# Create hover preview clips
+@app.post("/api/v1/create-preview", response_model=ProcessingResponse, dependencies=[Depends(reject_when_draining)])
+async def create_preview(
+    request: PreviewRequest,
+    background_tasks: BackgroundTasks,
+    authorization: Optional[str] = Header(None)
+):
+    """Create a short, muted, low-res hover preview clip"""
+    try:
+        logger.info("🎞️ Creating preview for generation: %s", request.generation_id)
+        
+        processing_id = str(uuid.uuid4())
+        
+        await submit_job("preview", processing_id, request, background_tasks)
+        
+        return ProcessingResponse(
+            success=True,
+            processing_id=processing_id,
+            message="Preview creation started",
+            status="processing"
+        )
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error("❌ Error starting preview creation: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+# Several edits in one encode
+@app.post("/api/v1/transform", response_model=ProcessingResponse, dependencies=[Depends(reject_when_draining)])
+async def transform_video(
+    request: TransformRequest,
+    background_tasks: BackgroundTasks,
+    authorization: Optional[str] = Header(None)
+):
+    """Run an ordered list of edits (trim, scale, watermark, fps, audio) as one encode"""
+    try:
+        logger.info("🧩 Transforming video for generation: %s", request.generation_id)
+        
+        processing_id = str(uuid.uuid4())
+        
+        await submit_job("transform", processing_id, request, background_tasks)
+        
+        return ProcessingResponse(
+            success=True,
+            processing_id=processing_id,
+            message="Transform started",
+            status="processing"
+        )
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error("❌ Error starting transform: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 # ============================================
 # COMPATIBILITY ENDPOINTS FOR EDGE FUNCTIONS
 # ============================================
 
-@app.post("/extract-thumbnail")
+@app.post("/extract-thumbnail", dependencies=[Depends(reject_when_draining)])
 async def extract_thumbnail_compat(request: dict, background_tasks: BackgroundTasks):
     """Compatibility endpoint for edge functions"""
     try:
@@ -229,13 +583,16 @@ async def extract_thumbnail_compat(request: dict, background_tasks: BackgroundTa
             video_url=request.get('video_url'),
             user_id=request.get('user_id', 'edge-function'),
             timestamp=float(request.get('extract_frame', 0.5)) * 10,
+            preview=PreviewOptions() if request.get('include_preview') else None,
             webhook_url=request.get('webhook_url')
         )
         return await extract_thumbnail(thumbnail_request, background_tasks, None)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
-@app.post("/apply-watermark")
+@app.post("/apply-watermark", dependencies=[Depends(reject_when_draining)])
 async def apply_watermark_compat(request: dict, background_tasks: BackgroundTasks):
     """Compatibility endpoint for edge functions"""
     try:
@@ -250,211 +607,916 @@ async def apply_watermark_compat(request: dict, background_tasks: BackgroundTask
             webhook_url=request.get('webhook_url')
         )
         return await add_watermark(watermark_request, background_tasks, None)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 # Background processing functions
-async def process_thumbnail_extraction(processing_id: str, request: ThumbnailRequest):
-    """Background task to extract thumbnail"""
+async def build_preview_clips(
+    video_path: str,
+    options: PreviewOptions,
+    user_id: str,
+    generation_id: str,
+    object_stem: Optional[str] = None,
+    work_dir: Optional[str] = None,
+    keyframes: Optional[KeyframeIndex] = None
+) -> Dict[str, str]:
+    """Encode and upload hover previews from an already-downloaded video"""
+    preview_paths = await ffmpeg_processor.create_preview_clip(
+        video_path=video_path,
+        start=options.start,
+        duration=options.duration,
+        width=options.width,
+        fps=options.fps,
+        formats=options.formats,
+        max_bytes=options.max_bytes,
+        work_dir=work_dir,
+        keyframes=keyframes
+    )
+    
+    result = {}
     try:
-        logger.info(f"🎬 Processing thumbnail extraction: {processing_id}")
-        
-        # Download video
-        video_path = await storage_manager.download_temp_file(request.video_url)
-        
-        # Extract thumbnail
-        thumbnail_path = await ffmpeg_processor.extract_thumbnail(
+        for fmt, preview_path in preview_paths.items():
+            preview_url = await storage_manager.upload_file(
+                file_path=preview_path,
+                user_id=user_id,
+                folder=f"previews/{generation_id}",
+                object_stem=object_stem
+            )
+            result["preview_url" if fmt == "mp4" else f"preview_{fmt}_url"] = preview_url
+    finally:
+        for preview_path in preview_paths.values():
+            await storage_manager.cleanup_temp_file(preview_path)
+    
+    return result
+
+# Result fields of a codec-profile encode, indexed with its URL in the artifact cache
+CODEC_RESULT_FIELDS = [
+    "codec", "container", "output_bytes", "h264_url", "h264_bytes",
+    "h264_baseline", "bytes_saved", "bytes_saved_percent"
+]
+
+async def upload_encode(
+    output_path: str,
+    video_path: str,
+    operation: str,
+    request: CodecOptions,
+    folder: str,
+    object_stem: str
+) -> Dict[str, Any]:
+    """Upload an encode and its H.264 fallback, with the bytes saved against H.264
+    
+    Without a fallback file the H.264 size is the cost model's estimate for
+    the source (h264_baseline "estimated" rather than "measured").
+    """
+    fallback_path = ffmpeg_processor.fallback_path(output_path)
+    result = {
+        "codec": request.codec,
+        "container": os.path.splitext(output_path)[1].lstrip("."),
+        "output_bytes": os.path.getsize(output_path),
+        "h264_url": None,
+        "h264_bytes": None,
+        "h264_baseline": None
+    }
+    try:
+        result["url"] = await storage_manager.upload_file(
+            file_path=output_path,
+            user_id=request.user_id,
+            folder=folder,
+            object_stem=object_stem
+        )
+        if request.codec == "h264":
+            result.update(h264_url=result["url"], h264_bytes=result["output_bytes"], h264_baseline="measured")
+        elif os.path.exists(fallback_path):
+            result.update(
+                h264_url=await storage_manager.upload_file(
+                    file_path=fallback_path,
+                    user_id=request.user_id,
+                    folder=folder,
+                    object_stem=f"{object_stem}-h264"
+                ),
+                h264_bytes=os.path.getsize(fallback_path),
+                h264_baseline="measured"
+            )
+        else:
+            source = await ffmpeg_processor.probe_source(video_path)
+            if source:
+                params = {**request.model_dump(), "codec": "h264", "h264_fallback": False}
+                estimate = await asyncio.to_thread(cost_model.predict, operation, params, source)
+                result.update(
+                    h264_bytes=estimate["output_bytes"],
+                    h264_baseline="estimated"
+                )
+    finally:
+        await storage_manager.cleanup_temp_file(output_path)
+        if os.path.exists(fallback_path):
+            await storage_manager.cleanup_temp_file(fallback_path)
+    
+    if result["h264_bytes"]:
+        result["bytes_saved"] = result["h264_bytes"] - result["output_bytes"]
+        result["bytes_saved_percent"] = round(100 * result["bytes_saved"] / result["h264_bytes"], 1)
+        logger.info("📦 %s %s: %s bytes, %s%% smaller than H.264 (%s)", operation, request.codec,
+                    result["output_bytes"], result["bytes_saved_percent"], result["h264_baseline"])
+    else:
+        result["bytes_saved"] = result["bytes_saved_percent"] = None
+    return result
+
+def coalescing_key(operation: str, request: BaseModel) -> str:
+    """Single-flight key for a request, ignoring per-caller fields"""
+    params = request.model_dump(exclude={"video_url", "webhook_url"})
+    return SingleFlight.make_key(request.video_url, operation, params)
+
+# Previews of a lookalike source are interchangeable; encodes of it would carry its resolution and artifacts
+NEAR_DUPLICATE_OPERATIONS = ("thumbnail", "preview")
+
+async def near_duplicate_artifacts(source_hash: str, artifact_key: str, operation: str) -> Optional[Dict[str, Any]]:
+    """Artifacts produced from a source that looks the same as this one
+    
+    Only for NEAR_DUPLICATE_OPERATIONS. The artifact key includes the
+    owner, so only the same user's artifacts are ever returned.
+    """
+    if operation not in NEAR_DUPLICATE_OPERATIONS:
+        return None
+    for other_hash, distance in await asyncio.to_thread(fingerprint_index.near_duplicates, source_hash):
+        cached = await asyncio.to_thread(artifact_cache.get, other_hash, artifact_key)
+        if cached is not None:
+            logger.info("♻️ Near-duplicate of %s (distance %.2f) for %s", other_hash[:12], distance, operation)
+            fingerprint_index.near_hits += 1
+            NEAR_DUPLICATE_HITS.labels(operation).inc()
+            return cached
+    return None
+
+async def load_keyframes(video_path: str, source_hash: str) -> KeyframeIndex:
+    """A source's keyframe index, read from its packets on first use and cached by content"""
+    keyframes = await asyncio.to_thread(keyframe_cache.get, source_hash)
+    if keyframes is None:
+        keyframes = await ffmpeg_processor.keyframe_index(video_path)
+        await asyncio.to_thread(keyframe_cache.put, source_hash, keyframes)
+    return keyframes
+
+async def index_keyframes(video_path: str, source_hash: str):
+    """Build and cache a source's keyframe index for later jobs; seeks work without it"""
+    try:
+        await load_keyframes(video_path, source_hash)
+    except Exception as index_error:
+        logger.warning("⚠️ No keyframe index for %s: %s", source_hash[:12], index_error)
+
+async def index_fingerprint(video_path: str, source_hash: str):
+    """Add a downloaded source to the fingerprint index; failures only cost future near-duplicate hits"""
+    if not fingerprint_index.enabled or await asyncio.to_thread(fingerprint_index.get, source_hash) is not None:
+        return
+    try:
+        source = await ffmpeg_processor.probe_source(video_path)
+        if not source or not source.get("duration"):
+            return
+        frames = await ffmpeg_processor.sample_frames(video_path, source["duration"], fingerprint_index.frames, FRAME_SIZE)
+        await asyncio.to_thread(fingerprint_index.add, source_hash, source["duration"], frame_hashes(frames))
+    except Exception as fingerprint_error:
+        logger.warning("⚠️ Fingerprinting failed for %s: %s", source_hash[:12], fingerprint_error)
+
+def add_source_stages(graph: StageGraph) -> StageGraph:
+    """Download the source video and fingerprint it against the artifact index
+    
+    Also adds the source's cached keyframe index, read only for graphs whose
+    stages seek. A missing index is built after the job has returned.
+    """
+    async def download(video_url: str, work_dir: str) -> str:
+        video_path = await storage_manager.download_temp_file(video_url, work_dir)
+        await reprice_job(graph.name, video_path)
+        return video_path
+    
+    async def fingerprint(video_url: str, video_path: str, artifact_key: str, deferred: list) -> Dict[str, str]:
+        # Same content under a different URL still skips the encode
+        source_hash = await artifact_cache.register_source(video_url, video_path)
+        cached = await asyncio.to_thread(artifact_cache.get, source_hash, artifact_key)
+        if cached is None and graph.name in NEAR_DUPLICATE_OPERATIONS:
+            # A re-encode or rescale of an earlier source reuses that source's artifacts,
+            # which takes this source's own fingerprint to look up
+            await index_fingerprint(video_path, source_hash)
+            cached = await near_duplicate_artifacts(source_hash, artifact_key, graph.name)
+        elif cached is None:
+            # Only indexed for later thumbnail and preview jobs, so it waits until this job has returned
+            deferred.append(lambda: index_fingerprint(video_path, source_hash))
+        if cached is not None:
+            raise ArtifactCacheHit(cached)
+        return {
+            "source_hash": source_hash,
+            "object_stem": ArtifactCache.object_stem(source_hash, artifact_key)
+        }
+    
+    async def keyframes(video_path: str, source_hash: str, deferred: list) -> Optional[KeyframeIndex]:
+        # Scanning every packet here would hold up the first seek, so a miss seeks by timestamp
+        index = await asyncio.to_thread(keyframe_cache.get, source_hash)
+        if index is None and keyframe_cache.enabled:
+            deferred.append(lambda: index_keyframes(video_path, source_hash))
+        return index
+    
+    return (
+        graph
+        .add("download", download, inputs=["video_url", "work_dir"], outputs=["video_path"])
+        .add("fingerprint", fingerprint,
+             inputs=["video_url", "video_path", "artifact_key", "deferred"],
+             outputs=["source_hash", "object_stem"])
+        .add("keyframes", keyframes, inputs=["video_path", "source_hash", "deferred"], outputs=["keyframe_index"])
+    )
+
+def acquire_workspace(operation: str, video_url: Optional[str], known_size: Optional[int] = None):
+    """Reserve a scratch workspace sized from the source video"""
+    async def expected_bytes() -> int:
+        size = known_size
+        if size is None and video_url:
+            size = await storage_manager.get_remote_size(video_url)
+        return int((size or DEFAULT_SOURCE_BYTES) * WORKSPACE_SIZE_FACTORS.get(operation, 2.0))
+    
+    @asynccontextmanager
+    async def _acquire():
+        async with workspace_manager.acquire(operation, await expected_bytes()) as workspace:
+            yield workspace
+    
+    return _acquire()
+
+# Deferred work still holding a job workspace
+deferred_tasks: set = set()
+
+async def run_deferred(deferred: list, workspace_scope: AsyncExitStack):
+    """Run a finished job's deferred work, then release its workspace"""
+    try:
+        for work in deferred:
+            await work()
+    finally:
+        await workspace_scope.aclose()
+
+async def run_job_graph(
+    graph: StageGraph,
+    video_url: str,
+    owner: str,
+    operation: str,
+    params: Dict[str, Any],
+    artifact_fields: list
+) -> Dict[str, Any]:
+    """Run a job's stage graph, seeding already-indexed artifacts so their stages are skipped
+    
+    artifact_fields are the graph outputs indexed in the artifact cache. Only
+    artifacts produced for the same owner (user_id) are reused, since their
+    URLs point into that user's storage prefix. All intermediate files live
+    in the job's workspace, removed when the job ends. Stages can add work
+    to the "deferred" list; it runs after the result is returned, and the
+    workspace is removed once it is done.
+    """
+    artifact_key = ArtifactCache.artifact_key(operation, params, owner)
+    deferred: List[Callable[[], Awaitable[None]]] = []
+    context = {"video_url": video_url, "artifact_key": artifact_key, "deferred": deferred}
+    
+    # Known source URL - return existing artifacts without downloading
+    cached = await asyncio.to_thread(artifact_cache.lookup_url, video_url, artifact_key)
+    if cached is not None:
+        logger.info("♻️ Artifact cache hit for %s: %s", operation, video_url)
+        context.update(cached, cache_hit=True)
+    
+    workspace_scope = AsyncExitStack()
+    workspace = await workspace_scope.enter_async_context(
+        acquire_workspace(operation, video_url, known_size=0 if cached else None)
+    )
+    try:
+        context["work_dir"] = workspace.path
+        try:
+            result = await graph.run(context)
+        except ArtifactCacheHit as hit:
+            logger.info("♻️ Artifact cache hit for %s by content", operation)
+            result = await graph.run({**context, **hit.artifacts, "cache_hit": True})
+    except BaseException:
+        await workspace_scope.aclose()
+        raise
+    
+    if deferred:
+        task = asyncio.create_task(run_deferred(deferred, workspace_scope))
+        deferred_tasks.add(task)
+        task.add_done_callback(deferred_tasks.discard)
+    else:
+        await workspace_scope.aclose()
+    
+    if not result.get("cache_hit"):
+        await asyncio.to_thread(
+            artifact_cache.put,
+            result["source_hash"],
+            artifact_key,
+            {field: result[field] for field in artifact_fields}
+        )
+    return result
+
+async def run_thumbnail_extraction(request: ThumbnailRequest) -> Dict[str, Any]:
+    """Extract, upload and record a thumbnail; shared by coalesced callers"""
+    async def extract(video_path: str, keyframe_index: Optional[KeyframeIndex], work_dir: str) -> str:
+        return await ffmpeg_processor.extract_thumbnail(
             video_path=video_path,
             timestamp=request.timestamp,
             width=request.width,
-            height=request.height
+            height=request.height,
+            work_dir=work_dir,
+            keyframes=keyframe_index
         )
-        
-        # Upload thumbnail to storage
-        thumbnail_url = await storage_manager.upload_to_supabase(
+    
+    async def upload_thumbnail(thumbnail_path: str, object_stem: str) -> str:
+        thumbnail_url = await storage_manager.upload_file(
             file_path=thumbnail_path,
             user_id=request.user_id,
-            folder=f"thumbnails/{request.generation_id}"
+            folder=f"thumbnails/{request.generation_id}",
+            object_stem=object_stem
         )
-        
-        # UPDATE DATABASE with thumbnail URL
+        await storage_manager.cleanup_temp_file(thumbnail_path)
+        return thumbnail_url
+    
+    async def preview(video_path: str, object_stem: str, keyframe_index: Optional[KeyframeIndex], work_dir: str) -> Dict[str, str]:
+        # Hover preview is a cheap derivative of the same download
+        try:
+            return await build_preview_clips(
+                video_path,
+                request.preview,
+                request.user_id,
+                request.generation_id,
+                object_stem,
+                work_dir,
+                keyframe_index
+            )
+        except Exception as preview_error:
+            logger.warning("⚠️ Preview creation failed, continuing with thumbnail: %s", preview_error)
+            return {}
+    
+    async def update_database(thumbnail_url: str) -> bool:
         db_updated = await storage_manager.update_generation_thumbnail(
             generation_id=request.generation_id,
             thumbnail_url=thumbnail_url
         )
-        
         if db_updated:
-            logger.info(f"✅ Database updated with thumbnail URL for generation: {request.generation_id}")
+            logger.info("✅ Database updated with thumbnail URL for generation: %s", request.generation_id)
         else:
-            logger.warning(f"⚠️ Failed to update database for generation: {request.generation_id}")
-        
-        # Cleanup temp files
-        await storage_manager.cleanup_temp_file(video_path)
-        await storage_manager.cleanup_temp_file(thumbnail_path)
-        
-        # Send webhook if configured
-        if request.webhook_url:
-            await webhook_manager.send_completion_webhook(
-                generation_id=request.generation_id,
-                processing_id=processing_id,
-                status="completed",
-                result={
-                    "thumbnail_url": thumbnail_url,
-                    "timestamp": request.timestamp,
-                    "db_updated": db_updated
-                },
-                webhook_url=request.webhook_url
+            logger.warning("⚠️ Failed to update database for generation: %s", request.generation_id)
+        return db_updated
+    
+    artifact_fields = ["thumbnail_url", "preview_urls"] if request.preview else ["thumbnail_url"]
+    graph = (
+        add_source_stages(StageGraph("thumbnail", targets=artifact_fields + ["db_updated"]))
+        .add("extract", extract, inputs=["video_path", "keyframe_index", "work_dir"], outputs=["thumbnail_path"])
+        .add("upload_thumbnail", upload_thumbnail, inputs=["thumbnail_path", "object_stem"], outputs=["thumbnail_url"])
+        .add("preview", preview, inputs=["video_path", "object_stem", "keyframe_index", "work_dir"], outputs=["preview_urls"])
+        .add("db_update", update_database, inputs=["thumbnail_url"], outputs=["db_updated"])
+    )
+    
+    context = await run_job_graph(
+        graph,
+        request.video_url,
+        request.user_id,
+        "thumbnail",
+        request.model_dump(include={"timestamp", "width", "height", "preview"}),
+        artifact_fields
+    )
+    
+    return {
+        "thumbnail_url": context["thumbnail_url"],
+        **context.get("preview_urls", {}),
+        "timestamp": request.timestamp,
+        "db_updated": context["db_updated"],
+        "cache_hit": context.get("cache_hit", False)
+    }
+
+async def process_thumbnail_extraction(processing_id: str, request: ThumbnailRequest):
+    """Background task to extract thumbnail"""
+    current_operation.set("thumbnail")
+    with tracer.start_trace(processing_id, "thumbnail", generation_id=request.generation_id):
+        try:
+            logger.info("🎬 Processing thumbnail extraction: %s", processing_id)
+            
+            result = await single_flight.run(
+                coalescing_key("thumbnail", request),
+                lambda: run_thumbnail_extraction(request)
             )
-        
-        logger.info(f"✅ Thumbnail extraction completed: {processing_id}")
-        
-    except Exception as e:
-        logger.error(f"❌ Thumbnail extraction failed: {str(e)}")
-        if request.webhook_url:
-            await webhook_manager.send_completion_webhook(
-                generation_id=request.generation_id,
-                processing_id=processing_id,
-                status="failed",
-                error=str(e),
-                webhook_url=request.webhook_url
+            
+            # Send webhook if configured
+            if request.webhook_url:
+                await webhook_manager.send_completion_webhook(
+                    generation_id=request.generation_id,
+                    processing_id=processing_id,
+                    status="completed",
+                    result=result,
+                    webhook_url=request.webhook_url
+                )
+            
+            logger.info("✅ Thumbnail extraction completed: %s", processing_id)
+            
+        except Exception as e:
+            logger.error("❌ Thumbnail extraction failed: %s", e)
+            tracer.record_error(e)
+            if request.webhook_url:
+                await webhook_manager.send_completion_webhook(
+                    generation_id=request.generation_id,
+                    processing_id=processing_id,
+                    status="failed",
+                    error=str(e),
+                    webhook_url=request.webhook_url
+                )
+            # The job runner records the job as failed with this error
+            raise
+
+async def run_preview_creation(request: PreviewRequest) -> Dict[str, Any]:
+    """Build hover previews for a video; shared by coalesced callers"""
+    async def preview(video_path: str, object_stem: str, keyframe_index: Optional[KeyframeIndex], work_dir: str) -> Dict[str, str]:
+        return await build_preview_clips(
+            video_path,
+            request,
+            request.user_id,
+            request.generation_id,
+            object_stem,
+            work_dir,
+            keyframe_index
+        )
+    
+    graph = (
+        add_source_stages(StageGraph("preview", targets=["preview_urls"]))
+        .add("preview", preview, inputs=["video_path", "object_stem", "keyframe_index", "work_dir"], outputs=["preview_urls"])
+    )
+    
+    context = await run_job_graph(
+        graph,
+        request.video_url,
+        request.user_id,
+        "preview",
+        request.model_dump(include=set(PreviewOptions.model_fields)),
+        ["preview_urls"]
+    )
+    
+    return {
+        **context["preview_urls"],
+        "original_url": request.video_url,
+        "cache_hit": context.get("cache_hit", False)
+    }
+
+async def process_preview_creation(processing_id: str, request: PreviewRequest):
+    """Background task to create hover preview clips"""
+    current_operation.set("preview")
+    with tracer.start_trace(processing_id, "preview", generation_id=request.generation_id):
+        try:
+            logger.info("🎬 Processing preview creation: %s", processing_id)
+            
+            result = await single_flight.run(
+                coalescing_key("preview", request),
+                lambda: run_preview_creation(request)
             )
+            
+            # Send webhook if configured
+            if request.webhook_url:
+                await webhook_manager.send_completion_webhook(
+                    generation_id=request.generation_id,
+                    processing_id=processing_id,
+                    status="completed",
+                    result=result,
+                    webhook_url=request.webhook_url
+                )
+            
+            logger.info("✅ Preview creation completed: %s", processing_id)
+            
+        except Exception as e:
+            logger.error("❌ Preview creation failed: %s", e)
+            tracer.record_error(e)
+            if request.webhook_url:
+                await webhook_manager.send_completion_webhook(
+                    generation_id=request.generation_id,
+                    processing_id=processing_id,
+                    status="failed",
+                    error=str(e),
+                    webhook_url=request.webhook_url
+                )
+            # The job runner records the job as failed with this error
+            raise
 
-async def process_watermark_addition(processing_id: str, request: WatermarkRequest):
-    """Background task to add watermark"""
-    try:
-        logger.info(f"🎬 Processing watermark addition: {processing_id}")
-        
-        # Download video
-        video_path = await storage_manager.download_temp_file(request.video_url)
-        
-        # Download or use watermark
+async def run_watermark_addition(request: WatermarkRequest) -> Dict[str, Any]:
+    """Watermark, upload and record a video; shared by coalesced callers"""
+    async def fetch_watermark(work_dir: str) -> str:
+        # Download or use watermark - overlaps with the video download
         if request.watermark_url:
-            watermark_path = await storage_manager.download_temp_file(request.watermark_url)
-        else:
-            # Use default watermark
-            watermark_path = "assets/default_watermark.png"
-        
-        # Add watermark
-        output_path = await ffmpeg_processor.add_watermark(
+            return await storage_manager.download_temp_file(request.watermark_url, work_dir)
+        # Use default watermark
+        return DEFAULT_WATERMARK_PATH
+    
+    async def encode(video_path: str, watermark_path: str, source_hash: str, work_dir: str) -> str:
+        return await ffmpeg_processor.add_watermark(
             video_path=video_path,
             watermark_path=watermark_path,
             position=request.position,
             opacity=request.opacity,
-            scale=request.scale
+            scale=request.scale,
+            work_dir=work_dir,
+            codec=request.codec,
+            container=request.container,
+            h264_fallback=request.h264_fallback
         )
-        
-        # Upload watermarked video
-        watermarked_url = await storage_manager.upload_to_supabase(
-            file_path=output_path,
-            user_id=request.user_id,
-            folder=f"watermarked/{request.generation_id}"
+    
+    async def upload(output_path: str, video_path: str, object_stem: str) -> Dict[str, Any]:
+        uploaded = await upload_encode(
+            output_path, video_path, "watermark", request,
+            f"watermarked/{request.generation_id}", object_stem
         )
-        
-        # UPDATE DATABASE with watermarked URL
+        return {"watermarked_url": uploaded.pop("url"), **uploaded}
+    
+    async def update_database(watermarked_url: str) -> bool:
         db_updated = await storage_manager.update_generation_watermarked(
             generation_id=request.generation_id,
             watermarked_url=watermarked_url
         )
-        
         if db_updated:
-            logger.info(f"✅ Database updated with watermarked URL for generation: {request.generation_id}")
+            logger.info("✅ Database updated with watermarked URL for generation: %s", request.generation_id)
         else:
-            logger.warning(f"⚠️ Failed to update database for generation: {request.generation_id}")
-        
-        # Cleanup
-        await storage_manager.cleanup_temp_file(video_path)
-        await storage_manager.cleanup_temp_file(output_path)
-        if request.watermark_url:
-            await storage_manager.cleanup_temp_file(watermark_path)
-        
-        # Send webhook if configured
-        if request.webhook_url:
-            await webhook_manager.send_completion_webhook(
-                generation_id=request.generation_id,
-                processing_id=processing_id,
-                status="completed",
-                result={
-                    "watermarked_url": watermarked_url,
-                    "original_url": request.video_url,
-                    "db_updated": db_updated
-                },
-                webhook_url=request.webhook_url
-            )
-        
-        logger.info(f"✅ Watermark addition completed: {processing_id}")
-        
-    except Exception as e:
-        logger.error(f"❌ Watermark addition failed: {str(e)}")
-        if request.webhook_url:
-            await webhook_manager.send_completion_webhook(
-                generation_id=request.generation_id,
-                processing_id=processing_id,
-                status="failed",
-                error=str(e),
-                webhook_url=request.webhook_url
+            logger.warning("⚠️ Failed to update database for generation: %s", request.generation_id)
+        return db_updated
+    
+    graph = (
+        add_source_stages(StageGraph("watermark", targets=["watermarked_url", "db_updated", *CODEC_RESULT_FIELDS]))
+        .add("fetch_watermark", fetch_watermark, inputs=["work_dir"], outputs=["watermark_path"])
+        .add("encode", encode, inputs=["video_path", "watermark_path", "source_hash", "work_dir"], outputs=["output_path"])
+        .add("upload", upload, inputs=["output_path", "video_path", "object_stem"],
+             outputs=["watermarked_url", *CODEC_RESULT_FIELDS])
+        .add("db_update", update_database, inputs=["watermarked_url"], outputs=["db_updated"])
+    )
+    
+    context = await run_job_graph(
+        graph,
+        request.video_url,
+        request.user_id,
+        "watermark",
+        request.model_dump(include={
+            "position", "opacity", "scale", "watermark_url", "codec", "container", "h264_fallback"
+        }),
+        ["watermarked_url", *CODEC_RESULT_FIELDS]
+    )
+    
+    return {
+        "watermarked_url": context["watermarked_url"],
+        "original_url": request.video_url,
+        **{field: context[field] for field in CODEC_RESULT_FIELDS},
+        "db_updated": context["db_updated"],
+        "cache_hit": context.get("cache_hit", False)
+    }
+
+async def process_watermark_addition(processing_id: str, request: WatermarkRequest):
+    """Background task to add watermark"""
+    current_operation.set("watermark")
+    with tracer.start_trace(processing_id, "watermark", generation_id=request.generation_id):
+        try:
+            logger.info("🎬 Processing watermark addition: %s", processing_id)
+            
+            result = await single_flight.run(
+                coalescing_key("watermark", request),
+                lambda: run_watermark_addition(request)
             )
+            
+            # Send webhook if configured
+            if request.webhook_url:
+                await webhook_manager.send_completion_webhook(
+                    generation_id=request.generation_id,
+                    processing_id=processing_id,
+                    status="completed",
+                    result=result,
+                    webhook_url=request.webhook_url
+                )
+            
+            logger.info("✅ Watermark addition completed: %s", processing_id)
+            
+        except Exception as e:
+            logger.error("❌ Watermark addition failed: %s", e)
+            tracer.record_error(e)
+            if request.webhook_url:
+                await webhook_manager.send_completion_webhook(
+                    generation_id=request.generation_id,
+                    processing_id=processing_id,
+                    status="failed",
+                    error=str(e),
+                    webhook_url=request.webhook_url
+                )
+            # The job runner records the job as failed with this error
+            raise
 
-async def process_video_resize(processing_id: str, request: ResizeVideoRequest):
-    """Background task to resize video"""
-    try:
-        logger.info(f"🎬 Processing video resize: {processing_id}")
-        
-        # Download video
-        video_path = await storage_manager.download_temp_file(request.video_url)
-        
-        # Resize video
-        output_path = await ffmpeg_processor.resize_video(
+async def run_video_resize(request: ResizeVideoRequest) -> Dict[str, Any]:
+    """Resize and upload a video; shared by coalesced callers"""
+    async def resize(video_path: str, source_hash: str, work_dir: str) -> str:
+        return await ffmpeg_processor.resize_video(
             video_path=video_path,
             width=request.width,
             height=request.height,
             bitrate=request.bitrate,
-            preserve_aspect_ratio=request.preserve_aspect_ratio
+            preserve_aspect_ratio=request.preserve_aspect_ratio,
+            work_dir=work_dir,
+            codec=request.codec,
+            container=request.container,
+            h264_fallback=request.h264_fallback,
+            target_size_bytes=request.target_size_bytes
         )
-        
-        # Upload resized video
-        resized_url = await storage_manager.upload_to_supabase(
-            file_path=output_path,
-            user_id=request.user_id,
-            folder=f"resized/{request.generation_id}"
+    
+    async def upload(output_path: str, video_path: str, object_stem: str) -> Dict[str, Any]:
+        uploaded = await upload_encode(
+            output_path, video_path, "resize", request,
+            f"resized/{request.generation_id}", object_stem
         )
-        
-        # Get new file size
-        file_size = os.path.getsize(output_path)
-        
-        # Cleanup
-        await storage_manager.cleanup_temp_file(video_path)
-        await storage_manager.cleanup_temp_file(output_path)
-        
-        # Send webhook if configured
-        if request.webhook_url:
-            await webhook_manager.send_completion_webhook(
-                generation_id=request.generation_id,
-                processing_id=processing_id,
-                status="completed",
-                result={
-                    "resized_url": resized_url,
-                    "original_url": request.video_url,
-                    "new_size": file_size,
-                    "dimensions": f"{request.width}x{request.height}"
-                },
-                webhook_url=request.webhook_url
+        return {"resized_url": uploaded.pop("url"), "new_size": uploaded["output_bytes"], **uploaded}
+    
+    graph = (
+        add_source_stages(StageGraph("resize", targets=["resized_url", "new_size", *CODEC_RESULT_FIELDS]))
+        .add("resize", resize, inputs=["video_path", "source_hash", "work_dir"], outputs=["output_path"])
+        .add("upload", upload, inputs=["output_path", "video_path", "object_stem"],
+             outputs=["resized_url", "new_size", *CODEC_RESULT_FIELDS])
+    )
+    
+    context = await run_job_graph(
+        graph,
+        request.video_url,
+        request.user_id,
+        "resize",
+        request.model_dump(include={
+            "width", "height", "bitrate", "target_size_bytes", "preserve_aspect_ratio",
+            "codec", "container", "h264_fallback"
+        }),
+        ["resized_url", "new_size", *CODEC_RESULT_FIELDS]
+    )
+    
+    return {
+        "resized_url": context["resized_url"],
+        "original_url": request.video_url,
+        "new_size": context["new_size"],
+        "target_size_bytes": request.target_size_bytes,
+        **{field: context[field] for field in CODEC_RESULT_FIELDS},
+        "dimensions": f"{request.width}x{request.height}",
+        "cache_hit": context.get("cache_hit", False)
+    }
+
+async def process_video_resize(processing_id: str, request: ResizeVideoRequest):
+    """Background task to resize video"""
+    current_operation.set("resize")
+    with tracer.start_trace(processing_id, "resize", generation_id=request.generation_id):
+        try:
+            logger.info("🎬 Processing video resize: %s", processing_id)
+            
+            result = await single_flight.run(
+                coalescing_key("resize", request),
+                lambda: run_video_resize(request)
             )
+            
+            # Send webhook if configured
+            if request.webhook_url:
+                await webhook_manager.send_completion_webhook(
+                    generation_id=request.generation_id,
+                    processing_id=processing_id,
+                    status="completed",
+                    result=result,
+                    webhook_url=request.webhook_url
+                )
+            
+            logger.info("✅ Video resize completed: %s", processing_id)
+            
+        except Exception as e:
+            logger.error("❌ Video resize failed: %s", e)
+            tracer.record_error(e)
+            if request.webhook_url:
+                await webhook_manager.send_completion_webhook(
+                    generation_id=request.generation_id,
+                    processing_id=processing_id,
+                    status="failed",
+                    error=str(e),
+                    webhook_url=request.webhook_url
+                )
+            # The job runner records the job as failed with this error
+            raise
+
+async def run_transform(request: TransformRequest) -> Dict[str, Any]:
+    """Transform and upload a video; shared by coalesced callers"""
+    plan = TransformPlan(step.model_dump() for step in request.steps)
+    
+    async def fetch_watermarks(work_dir: str) -> List[str]:
+        # Custom images download alongside the video; steps without one use the default
+        async def fetch(watermark_url: Optional[str]) -> str:
+            if watermark_url:
+                return await storage_manager.download_temp_file(watermark_url, work_dir)
+            return DEFAULT_WATERMARK_PATH
         
-        logger.info(f"✅ Video resize completed: {processing_id}")
-        
-    except Exception as e:
-        logger.error(f"❌ Video resize failed: {str(e)}")
-        if request.webhook_url:
-            await webhook_manager.send_completion_webhook(
-                generation_id=request.generation_id,
-                processing_id=processing_id,
-                status="failed",
-                error=str(e),
-                webhook_url=request.webhook_url
+        return list(await asyncio.gather(*(fetch(watermark["watermark_url"]) for watermark in plan.watermarks)))
+    
+    async def encode(video_path: str, watermark_paths: List[str], source_hash: str, work_dir: str) -> str:
+        return await ffmpeg_processor.transform(
+            video_path=video_path,
+            plan=plan,
+            watermark_paths=watermark_paths,
+            bitrate=request.bitrate,
+            work_dir=work_dir,
+            codec=request.codec,
+            container=request.container,
+            h264_fallback=request.h264_fallback
+        )
+    
+    async def upload(output_path: str, video_path: str, object_stem: str) -> Dict[str, Any]:
+        uploaded = await upload_encode(
+            output_path, video_path, "transform", request,
+            f"transformed/{request.generation_id}", object_stem
+        )
+        return {"transformed_url": uploaded.pop("url"), **uploaded}
+    
+    graph = (
+        add_source_stages(StageGraph("transform", targets=["transformed_url", *CODEC_RESULT_FIELDS]))
+        .add("fetch_watermarks", fetch_watermarks, inputs=["work_dir"], outputs=["watermark_paths"])
+        .add("encode", encode, inputs=["video_path", "watermark_paths", "source_hash", "work_dir"], outputs=["output_path"])
+        .add("upload", upload, inputs=["output_path", "video_path", "object_stem"],
+             outputs=["transformed_url", *CODEC_RESULT_FIELDS])
+    )
+    
+    context = await run_job_graph(
+        graph,
+        request.video_url,
+        request.user_id,
+        "transform",
+        request.model_dump(include={"steps", "bitrate", "codec", "container", "h264_fallback"}),
+        ["transformed_url", *CODEC_RESULT_FIELDS]
+    )
+    
+    return {
+        "transformed_url": context["transformed_url"],
+        "original_url": request.video_url,
+        "steps": [step["op"] for step in plan.steps],
+        **{field: context[field] for field in CODEC_RESULT_FIELDS},
+        "cache_hit": context.get("cache_hit", False)
+    }
+
+async def process_transform(processing_id: str, request: TransformRequest):
+    """Background task to transform video"""
+    current_operation.set("transform")
+    with tracer.start_trace(processing_id, "transform", generation_id=request.generation_id):
+        try:
+            logger.info("🎬 Processing transform: %s", processing_id)
+            
+            result = await single_flight.run(
+                coalescing_key("transform", request),
+                lambda: run_transform(request)
+            )
+            
+            # Send webhook if configured
+            if request.webhook_url:
+                await webhook_manager.send_completion_webhook(
+                    generation_id=request.generation_id,
+                    processing_id=processing_id,
+                    status="completed",
+                    result=result,
+                    webhook_url=request.webhook_url
+                )
+            
+            logger.info("✅ Transform completed: %s", processing_id)
+            
+        except Exception as e:
+            logger.error("❌ Transform failed: %s", e)
+            tracer.record_error(e)
+            if request.webhook_url:
+                await webhook_manager.send_completion_webhook(
+                    generation_id=request.generation_id,
+                    processing_id=processing_id,
+                    status="failed",
+                    error=str(e),
+                    webhook_url=request.webhook_url
+                )
+            # The job runner records the job as failed with this error
+            raise
+
+# Queued jobs: operation -> (request model, job function)
+JOB_HANDLERS = {
+    "thumbnail": (ThumbnailRequest, process_thumbnail_extraction),
+    "watermark": (WatermarkRequest, process_watermark_addition),
+    "resize": (ResizeVideoRequest, process_video_resize),
+    "preview": (PreviewRequest, process_preview_creation),
+    "transform": (TransformRequest, process_transform)
+}
+
+async def submit_job(operation: str, processing_id: str, request: BaseModel, background_tasks: BackgroundTasks):
+    """Admit a job against the backlog, then queue it for any worker process
+    
+    The job's cost is its predicted run time; it decides admission and,
+    with shortest-job-first scheduling, when a worker picks it up. Runs it
+    as an in-process background task when the queue is disabled. Raises 429
+    with Retry-After when the backlog is over capacity.
+    
+    Nothing reads the source here beyond a HEAD for its size; the cost is
+    corrected from the downloaded file when the job runs.
+    """
+    check_source_url(request.video_url)
+    await check_codec(request)
+    cost = 0.0
+    if admission.enabled or (job_queue and job_queue.scheduling == "sjf"):
+        source = await describe_source(request.video_url)
+        check_target_size(request, source)
+        cost = (await asyncio.to_thread(cost_model.predict, operation, request.model_dump(), source))["seconds"]
+        try:
+            await asyncio.to_thread(admission.check, cost)
+        except AdmissionRejected as rejected:
+            ADMISSION_REJECTED.labels(operation).inc()
+            logger.warning("🚦 Rejecting %s job (%.1fs): %s", operation, cost, rejected)
+            raise HTTPException(
+                status_code=429,
+                detail=str(rejected),
+                headers={"Retry-After": str(rejected.retry_after)}
+            )
+    
+    if job_queue is None:
+        admission.track(processing_id, cost)
+        background_tasks.add_task(run_local_job, operation, processing_id, request)
+        return
+    await asyncio.to_thread(job_queue.enqueue, processing_id, operation, request.model_dump(mode="json"), cost=cost)
+    job_runner.notify()
+
+async def check_codec(request: BaseModel):
+    """400 for a codec profile this ffmpeg build can't encode or a container it can't go in
+    
+    Transform steps are compiled here too, so an invalid pipeline is
+    rejected before it is queued.
+    """
+    if isinstance(request, TransformRequest):
+        try:
+            TransformPlan(step.model_dump() for step in request.steps)
+        except TransformPlanError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    if isinstance(request, CodecOptions):
+        try:
+            await ffmpeg_processor.check_codec(request.codec, request.container)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+def check_target_size(request: BaseModel, source: Dict[str, Any]):
+    """400 for a target_size_bytes too small for the probed source's duration"""
+    if getattr(request, "target_size_bytes", None) and source.get("probed"):
+        try:
+            ffmpeg_processor.target_bitrates(
+                request.target_size_bytes, source["duration"], source.get("has_audio", True)
             )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+def check_source_url(video_url: str):
+    """400 for a source that isn't an http(s) URL, before anything fetches or probes it"""
+    if urlparse(video_url).scheme not in ("http", "https"):
+        raise HTTPException(status_code=400, detail="video_url must be an http or https URL")
+
+async def describe_source(video_url: str, probe: bool = False) -> Dict[str, Any]:
+    """Metadata of a source for the cost model: probed if asked, else a guess from its size"""
+    if probe:
+        source = await ffmpeg_processor.probe_source(
+            storage_manager.backend.local_path(video_url) or video_url,
+            PROBE_TIMEOUT_SECONDS
+        )
+        if source:
+            return {**source, "probed": True}
+    source_bytes = await storage_manager.get_remote_size(video_url)
+    return {**admission.assumed_source(source_bytes), "probed": False}
+
+async def reprice_job(operation: str, video_path: str):
+    """Replace the running job's size-based cost with one from its downloaded source"""
+    job = current_job.get()
+    if job is None or not (admission.enabled or (job_queue and job_queue.scheduling == "sjf")):
+        return
+    processing_id, params = job
+    source = await ffmpeg_processor.probe_source(video_path)
+    if not source:
+        return
+    cost = (await asyncio.to_thread(cost_model.predict, operation, params, source))["seconds"]
+    if job_queue:
+        await asyncio.to_thread(job_queue.set_cost, processing_id, cost)
+    else:
+        admission.track(processing_id, cost)
+
+async def run_local_job(operation: str, processing_id: str, request: BaseModel):
+    current_job.set((processing_id, request.model_dump()))
+    try:
+        await JOB_HANDLERS[operation][1](processing_id, request)
+    except Exception:
+        # Already logged and reported through the failure webhook; there is no queue row to mark
+        pass
+    finally:
+        admission.release(processing_id)
+
+async def run_queued_job(processing_id: str, operation: str, payload: Dict[str, Any]):
+    model, process = JOB_HANDLERS[operation]
+    request = model.model_validate(payload)
+    current_job.set((processing_id, request.model_dump()))
+    await process(processing_id, request)
+
+async def report_abandoned_job(job: Dict[str, Any]):
+    """Failure webhook for a job whose workers kept dying before finishing it"""
+    request = JOB_HANDLERS[job["operation"]][0].model_validate(job["payload"])
+    current_operation.set(job["operation"])
+    if request.webhook_url:
+        await webhook_manager.send_completion_webhook(
+            generation_id=request.generation_id,
+            processing_id=job["id"],
+            status="failed",
+            error=f"Job abandoned after {job['attempts']} attempts",
+            webhook_url=request.webhook_url
+        )
+
+job_runner = JobRunner(job_queue, run_queued_job, report_abandoned_job) if job_queue else None
 
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    logger.info(f"Starting server on port {port}")
+    logger.info("Starting server on port %s", port)
     uvicorn.run(app, host="0.0.0.0", port=port)
\ No newline at end of file
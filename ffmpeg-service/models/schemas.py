@@ -1,5 +1,13 @@
 ﻿from pydantic import BaseModel, Field
-from typing import Optional, Literal
+from typing import Optional, Literal, Union, Annotated
+
+class PreviewOptions(BaseModel):
+    start: float = Field(default=0.0, ge=0)
+    duration: float = Field(default=3.0, gt=0, le=10)
+    width: int = Field(default=320, ge=160, le=640)
+    fps: int = Field(default=12, gt=0, le=30)
+    formats: list[Literal["mp4", "webp"]] = ["mp4"]
+    max_bytes: int = Field(default=300_000, gt=0, le=5_000_000)
 
 class ThumbnailRequest(BaseModel):
     generation_id: str
@@ -8,9 +16,21 @@ class ThumbnailRequest(BaseModel):
     timestamp: float = Field(default=1.0, ge=0)
     width: Optional[int] = Field(None, gt=0, le=1920)
     height: Optional[int] = Field(None, gt=0, le=1080)
+    preview: Optional[PreviewOptions] = None  # Also build a hover preview from the same download
+    webhook_url: Optional[str] = None
+
+class PreviewRequest(PreviewOptions):
+    generation_id: str
+    video_url: str
+    user_id: str
     webhook_url: Optional[str] = None
 
-class WatermarkRequest(BaseModel):
+class CodecOptions(BaseModel):
+    codec: Literal["h264", "hevc", "av1", "vp9"] = "h264"
+    container: Optional[Literal["mp4", "webm", "mkv"]] = None  # Codec's default when unset
+    h264_fallback: bool = True    # Also deliver an H.264 MP4 when codec isn't h264
+
+class WatermarkRequest(CodecOptions):
     generation_id: str
     video_url: str
     user_id: str
@@ -19,24 +39,66 @@ class WatermarkRequest(BaseModel):
         "left-center",            # Left edge, centered
         "right-center"            # Right edge, centered
     ] = "bottom-center"           # ✅ SET AS DEFAULT
-    opacity: float = 0.9          # ✅ More visible
-    scale: float = 0.75           # ✅ Much bigger
+    opacity: float = Field(default=0.9, gt=0, le=1)    # ✅ More visible
+    scale: float = Field(default=0.75, gt=0, le=4)     # ✅ Much bigger
     watermark_url: Optional[str] = None
     webhook_url: Optional[str] = None
 
 class VideoMetadataRequest(BaseModel):
     video_url: str
 
-class ResizeVideoRequest(BaseModel):
+class ResizeVideoRequest(CodecOptions):
     generation_id: str
     video_url: str
     user_id: str
     width: Optional[int] = Field(None, gt=0, le=3840)
     height: Optional[int] = Field(None, gt=0, le=2160)
     bitrate: Optional[str] = None
+    target_size_bytes: Optional[int] = Field(None, gt=0)  # Hard cap per output file; replaces bitrate
     preserve_aspect_ratio: bool = True
     webhook_url: Optional[str] = None
 
+class TrimStep(BaseModel):
+    op: Literal["trim"]
+    start: float = Field(default=0.0, ge=0)
+    duration: Optional[float] = Field(None, gt=0)  # To the end when unset
+
+class ScaleStep(BaseModel):
+    op: Literal["scale"]
+    width: Optional[int] = Field(None, gt=0, le=3840)
+    height: Optional[int] = Field(None, gt=0, le=2160)
+    preserve_aspect_ratio: bool = True  # With both sides: fit and pad instead of stretching
+
+class WatermarkStep(BaseModel):
+    op: Literal["watermark"]
+    position: Literal["bottom-center", "left-center", "right-center"] = "bottom-center"
+    opacity: float = Field(default=0.9, gt=0, le=1)
+    scale: float = Field(default=0.75, gt=0, le=4)
+    watermark_url: Optional[str] = None
+
+class FpsStep(BaseModel):
+    op: Literal["fps"]
+    fps: float = Field(gt=0, le=120)
+
+class AudioStep(BaseModel):
+    op: Literal["audio"]
+    mode: Literal["keep", "mute", "normalize"] = "keep"
+    volume: Optional[float] = Field(None, ge=0, le=10)
+    bitrate: Optional[str] = None
+
+TransformStep = Annotated[
+    Union[TrimStep, ScaleStep, WatermarkStep, FpsStep, AudioStep],
+    Field(discriminator="op")
+]
+
+class TransformRequest(CodecOptions):
+    generation_id: str
+    video_url: str
+    user_id: str
+    steps: list[TransformStep] = Field(min_length=1, max_length=16)
+    bitrate: Optional[str] = None
+    webhook_url: Optional[str] = None
+
 class MergeVideosRequest(BaseModel):
     generation_id: str
     video_urls: list[str]
@@ -0,0 +1,70 @@
+"""ResumableUploader against the stand-in TUS server
+
+    cd ffmpeg-service
+    python -m pytest tests
+"""
+import os
+import asyncio
+
+from tests.tus_server import FakeTusServer, serve
+from utils.resumable_upload import ResumableUploader
+
+CHUNK_SIZE = 1024
+
+def write_file(tmp_path, size: int) -> tuple:
+    data = os.urandom(size)
+    path = tmp_path / "output.mp4"
+    path.write_bytes(data)
+    return str(path), data
+
+async def upload(server: FakeTusServer, path: str, parallel_parts: int = 1) -> ResumableUploader:
+    async with serve(server) as endpoint:
+        uploader = ResumableUploader(endpoint, chunk_size=CHUNK_SIZE, parallel_parts=parallel_parts, max_retries=3)
+        await uploader.upload(path, {"bucketName": "user-files", "objectName": "u1/output.mp4"})
+    return uploader
+
+def test_sequential_upload_resumes_from_server_offset(tmp_path):
+    path, data = write_file(tmp_path, 5 * CHUNK_SIZE + 100)
+    server = FakeTusServer()
+    # The third chunk drops after 300 bytes reached the server
+    server.failures[3] = 300
+
+    uploader = asyncio.run(upload(server, path))
+
+    assert server.completed() == [data]
+    offsets = [offset for _, offset, _, _ in server.patches]
+    assert offsets == [0, 1024, 2048, 2348, 3372, 4396]
+    # Only the bytes the server didn't already have were sent again
+    assert uploader.bytes_sent == len(data) - 300
+
+def test_failed_chunk_without_progress_is_resent(tmp_path):
+    path, data = write_file(tmp_path, 3 * CHUNK_SIZE)
+    server = FakeTusServer()
+    server.failures[2] = 0
+
+    uploader = asyncio.run(upload(server, path))
+
+    assert server.completed() == [data]
+    assert [(offset, status) for _, offset, _, status in server.patches] == [
+        (0, 204), (1024, 503), (1024, 204), (2048, 204)
+    ]
+    assert uploader.bytes_sent == len(data)
+
+def test_parallel_parts_are_concatenated(tmp_path):
+    path, data = write_file(tmp_path, 7 * CHUNK_SIZE + 10)
+    server = FakeTusServer(concatenation=True)
+    server.failures[4] = 512
+
+    asyncio.run(upload(server, path, parallel_parts=3))
+
+    assert server.completed() == [data]
+    assert sum(1 for upload in server.uploads.values() if upload["partial"]) == 3
+
+def test_without_concatenation_parts_are_sequential(tmp_path):
+    path, data = write_file(tmp_path, 7 * CHUNK_SIZE + 10)
+    server = FakeTusServer()
+
+    asyncio.run(upload(server, path, parallel_parts=3))
+
+    assert server.completed() == [data]
+    assert len(server.uploads) == 1
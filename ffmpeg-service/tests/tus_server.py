@@ -0,0 +1,115 @@
+"""Stand-in TUS 1.0 server for exercising ResumableUploader
+
+Implements creation, HEAD offsets, PATCH with offset checks and, when
+enabled, the concatenation extension (which Supabase does not offer).
+Failures can be injected per PATCH: the server keeps the first bytes of
+the chunk, as if the connection dropped mid-body, then answers 503.
+"""
+import socket
+import asyncio
+import contextlib
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request, Response
+
+class FakeTusServer:
+    """In-memory TUS uploads at /upload"""
+
+    def __init__(self, concatenation: bool = False):
+        self.concatenation = concatenation
+        self.uploads: Dict[str, Dict] = {}
+        # PATCH number (1-based) -> bytes of that chunk to keep before failing with 503
+        self.failures: Dict[int, int] = {}
+        # (upload id, Upload-Offset, body length, status) of every PATCH
+        self.patches: List[Tuple[str, int, int, int]] = []
+        self.app = self._build_app()
+
+    def completed(self) -> List[bytes]:
+        """Bytes of every finished upload that isn't a concatenation part"""
+        return [
+            bytes(upload["data"]) for upload in self.uploads.values()
+            if not upload["partial"] and len(upload["data"]) == upload["length"]
+        ]
+
+    def _build_app(self) -> FastAPI:
+        app = FastAPI()
+
+        @app.options("/upload")
+        async def options():
+            extensions = "creation,concatenation" if self.concatenation else "creation"
+            return Response(status_code=204, headers={"Tus-Version": "1.0.0", "Tus-Extension": extensions})
+
+        @app.post("/upload")
+        async def create(request: Request):
+            concat = request.headers.get("upload-concat", "")
+            upload_id = str(len(self.uploads) + 1)
+            if concat.startswith("final;"):
+                if not self.concatenation:
+                    return Response(status_code=400)
+                # Part URLs are absolute; the id is the last path segment
+                parts = [self.uploads[url.rstrip("/").rsplit("/", 1)[1]] for url in concat[6:].split()]
+                data = bytearray(b"".join(part["data"] for part in parts))
+                self.uploads[upload_id] = {"data": data, "length": len(data), "partial": False}
+            else:
+                self.uploads[upload_id] = {
+                    "data": bytearray(),
+                    "length": int(request.headers["upload-length"]),
+                    "partial": concat == "partial"
+                }
+            return Response(status_code=201, headers={"Location": f"/upload/{upload_id}"})
+
+        @app.head("/upload/{upload_id}")
+        async def head(upload_id: str):
+            if upload_id not in self.uploads:
+                return Response(status_code=404)
+            return Response(status_code=200, headers={"Upload-Offset": str(len(self.uploads[upload_id]["data"]))})
+
+        @app.patch("/upload/{upload_id}")
+        async def patch(upload_id: str, request: Request):
+            upload = self.uploads.get(upload_id)
+            if upload is None:
+                return Response(status_code=404)
+            body = await request.body()
+            offset = int(request.headers["upload-offset"])
+            number = len(self.patches) + 1
+
+            if offset != len(upload["data"]):
+                status = 409
+            elif number in self.failures:
+                upload["data"] += body[:self.failures[number]]
+                status = 503
+            else:
+                upload["data"] += body
+                status = 204
+            self.patches.append((upload_id, offset, len(body), status))
+            headers = {"Upload-Offset": str(len(upload["data"]))} if status == 204 else {}
+            return Response(status_code=status, headers=headers)
+
+        return app
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+@contextlib.asynccontextmanager
+async def serve(server: FakeTusServer, port: Optional[int] = None):
+    """Run the server on localhost for the duration of the block; yields its upload endpoint"""
+    port = port or free_port()
+    uvicorn_server = uvicorn.Server(uvicorn.Config(server.app, host="127.0.0.1", port=port, log_level="warning"))
+    task = asyncio.create_task(uvicorn_server.serve())
+    endpoint = f"http://127.0.0.1:{port}/upload"
+    try:
+        async with httpx.AsyncClient() as client:
+            for _ in range(100):
+                try:
+                    await client.options(endpoint)
+                    break
+                except httpx.TransportError:
+                    await asyncio.sleep(0.05)
+        yield endpoint
+    finally:
+        uvicorn_server.should_exit = True
+        await task
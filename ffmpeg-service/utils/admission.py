@@ -0,0 +1,94 @@
+import os
+import math
+import logging
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+class AdmissionRejected(Exception):
+    """The backlog is too large to accept a job now"""
+
+    def __init__(self, retry_after: int, cost: float, backlog: float):
+        super().__init__(f"Backlog of {backlog:.0f}s is over capacity, retry in {retry_after}s")
+        self.retry_after = retry_after
+        self.cost = cost
+        self.backlog = backlog
+
+class AdmissionController:
+    """Admits jobs while the estimated queue wait stays under ADMISSION_MAX_WAIT_SECONDS
+
+    Each job's cost is its predicted run time in work-seconds (seconds of
+    one worker slot), from the cost model. The backlog is the summed cost of
+    queued and running jobs, so the queue wait is backlog / worker slots.
+    """
+
+    def __init__(self, backlog: Callable[[], float]):
+        self.enabled = os.getenv("ADMISSION_CONTROL_ENABLED", "true").lower() != "false"
+        self.max_wait = float(os.getenv("ADMISSION_MAX_WAIT_SECONDS", "300"))
+        self.slots = int(os.getenv("ADMISSION_WORKER_SLOTS", os.getenv("JOB_WORKER_CONCURRENCY", "4")))
+        # Sources that can't be probed are guessed from their size
+        self.assumed_bitrate = float(os.getenv("ADMISSION_ASSUMED_BITRATE_MBPS", "5")) * 1e6
+        self.default_duration = float(os.getenv("ADMISSION_DEFAULT_DURATION_SECONDS", "10"))
+        width, _, height = os.getenv("ADMISSION_DEFAULT_RESOLUTION", "1280x720").partition("x")
+        self.default_width, self.default_height = int(width), int(height)
+
+        self._backlog = backlog
+        self._local: Dict[str, float] = {}
+        self.rejected = 0
+
+    @property
+    def budget(self) -> float:
+        """Backlog (work-seconds) at which new jobs are turned away"""
+        return self.max_wait * self.slots
+
+    def backlog(self) -> float:
+        return self._backlog() + sum(self._local.values())
+
+    def assumed_source(self, source_bytes: Optional[int]) -> Dict[str, Any]:
+        """Stand-in probe metadata for a source that couldn't be probed"""
+        return {
+            "duration": source_bytes * 8 / self.assumed_bitrate if source_bytes else self.default_duration,
+            "width": self.default_width,
+            "height": self.default_height,
+            "fps": 30.0,
+            "codec": "h264"
+        }
+
+    def retry_after(self, cost: float, backlog: Optional[float] = None) -> Optional[int]:
+        """Seconds to wait before a job of this cost fits the budget, None if it fits now"""
+        if not self.enabled:
+            return None
+        backlog = self.backlog() if backlog is None else backlog
+        # An idle instance takes any single job, however large
+        if backlog <= 0 or backlog + cost <= self.budget:
+            return None
+        retry_after = max(1, math.ceil((backlog + cost - self.budget) / self.slots))
+        return min(retry_after, int(self.max_wait))
+
+    def check(self, cost: float):
+        """Raise AdmissionRejected if a job of this cost would push the wait over the limit"""
+        backlog = self.backlog()
+        retry_after = self.retry_after(cost, backlog)
+        if retry_after is not None:
+            self.rejected += 1
+            raise AdmissionRejected(retry_after, cost, backlog)
+
+    def track(self, job_id: str, cost: float):
+        """Count an in-process job (no shared queue) until release()"""
+        self._local[job_id] = cost
+
+    def release(self, job_id: str):
+        self._local.pop(job_id, None)
+
+    def capacity(self) -> Dict[str, Any]:
+        backlog = self.backlog()
+        return {
+            "enabled": self.enabled,
+            "worker_slots": self.slots,
+            "max_wait_seconds": self.max_wait,
+            "budget_seconds": self.budget,
+            "backlog_seconds": round(backlog, 3),
+            "remaining_seconds": round(max(self.budget - backlog, 0.0), 3),
+            "estimated_wait_seconds": round(backlog / self.slots, 3),
+            "rejected_total": self.rejected
+        }
@@ -0,0 +1,173 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import tempfile
+from typing import Optional, Dict, Any
+from utils.stage_graph import StageGraphExit
+
+logger = logging.getLogger(__name__)
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+class ArtifactCacheHit(StageGraphExit):
+    """Raised mid-job when the downloaded content already has indexed artifacts"""
+
+    def __init__(self, artifacts: Dict[str, Any]):
+        super().__init__("artifacts already produced for this source")
+        self.artifacts = artifacts
+
+class ArtifactCache:
+    """Local index of derived artifacts keyed by source content hash + operation params + owner
+
+    The index is a SQLite file in WAL mode. lookup_url, get and put block on
+    it, so callers on the event loop run them through asyncio.to_thread.
+    """
+
+    def __init__(self, db_path: Optional[str] = None):
+        self.enabled = os.getenv("ARTIFACT_CACHE_ENABLED", "true").lower() != "false"
+        self.db_path = db_path or os.getenv(
+            "ARTIFACT_CACHE_PATH",
+            os.path.join(tempfile.gettempdir(), "ffmpeg_artifacts.db")
+        )
+        self.hits = 0
+        self.misses = 0
+
+        if self.enabled:
+            with self._connect() as conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS sources ("
+                    "url TEXT PRIMARY KEY, source_hash TEXT NOT NULL, "
+                    "size INTEGER, created_at REAL)"
+                )
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS artifacts ("
+                    "source_hash TEXT NOT NULL, artifact_key TEXT NOT NULL, "
+                    "result TEXT NOT NULL, created_at REAL, "
+                    "PRIMARY KEY (source_hash, artifact_key))"
+                )
+            logger.info("✅ Artifact cache index at: %s", self.db_path)
+        else:
+            logger.info("Artifact cache disabled")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=10.0)
+
+    @staticmethod
+    def artifact_key(operation: str, params: Dict[str, Any], owner: str) -> str:
+        """Hash of the operation, the params that affect its output and the owning user
+
+        Artifacts are stored under their owner's prefix, so identical content
+        from another user never resolves to them.
+        """
+        canonical = json.dumps(
+            {"operation": operation, "params": params, "owner": owner},
+            sort_keys=True,
+            separators=(',', ':'),
+            default=str
+        )
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def object_stem(source_hash: str, artifact_key: str) -> str:
+        """Deterministic storage filename (without extension) for an artifact"""
+        return f"{source_hash[:32]}-{artifact_key[:16]}"
+
+    @staticmethod
+    async def hash_file(file_path: str) -> str:
+        """SHA-256 of a file's content, computed off the event loop"""
+        def _hash() -> str:
+            digest = hashlib.sha256()
+            with open(file_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+            return digest.hexdigest()
+
+        return await asyncio.get_running_loop().run_in_executor(None, _hash)
+
+    async def register_source(self, url: str, file_path: str) -> str:
+        """Hash a downloaded source and remember which URL it came from"""
+        source_hash = await self.hash_file(file_path)
+        if self.enabled:
+            await asyncio.to_thread(self._insert_source, url, source_hash, os.path.getsize(file_path))
+        return source_hash
+
+    def _insert_source(self, url: str, source_hash: str, size: int):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sources (url, source_hash, size, created_at) "
+                "VALUES (?, ?, ?, ?)",
+                (url, source_hash, size, time.time())
+            )
+
+    def lookup_url(self, url: str, artifact_key: str) -> Optional[Dict[str, Any]]:
+        """Find artifacts for a source URL seen before, without downloading it.
+
+        Source URLs (generation outputs) are treated as immutable.
+        """
+        if not self.enabled:
+            return None
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT a.result FROM sources s JOIN artifacts a "
+                "ON a.source_hash = s.source_hash "
+                "WHERE s.url = ? AND a.artifact_key = ?",
+                (url, artifact_key)
+            ).fetchone()
+        return self._record(row)
+
+    def get(self, source_hash: str, artifact_key: str) -> Optional[Dict[str, Any]]:
+        """Find artifacts already produced from this source content"""
+        if not self.enabled:
+            return None
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT result FROM artifacts WHERE source_hash = ? AND artifact_key = ?",
+                (source_hash, artifact_key)
+            ).fetchone()
+        return self._record(row)
+
+    def put(self, source_hash: str, artifact_key: str, result: Dict[str, Any]) -> bool:
+        """Index produced artifacts; results with local fallback paths are not cached"""
+        if not self.enabled:
+            return False
+        urls = self._urls(result)
+        if not urls or not all(isinstance(url, str) and url.startswith('http') for url in urls):
+            logger.info("Artifact not cached - result has no public URLs")
+            return False
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO artifacts (source_hash, artifact_key, result, created_at) "
+                "VALUES (?, ?, ?, ?)",
+                (source_hash, artifact_key, json.dumps(result), time.time())
+            )
+        return True
+
+    def _urls(self, result: Dict[str, Any]) -> list:
+        urls = []
+        for key, value in result.items():
+            if isinstance(value, dict):
+                urls.extend(self._urls(value))
+            elif key.endswith('_url') and value is not None:
+                # Optional outputs (a skipped H.264 fallback) are None
+                urls.append(value)
+        return urls
+
+    def _record(self, row) -> Optional[Dict[str, Any]]:
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row[0])
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters for health reporting"""
+        return {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses
+        }
@@ -0,0 +1,302 @@
+import os
+import re
+import time
+import logging
+import sqlite3
+import tempfile
+from typing import Optional, Dict, Any, List, Tuple
+from utils.metrics import COST_MODEL_ERROR
+
+logger = logging.getLogger(__name__)
+
+MEGAPIXEL = 1_000_000
+
+# Decode effort per source frame relative to H.264
+DECODE_FACTORS = {"h264": 1.0, "hevc": 1.6, "vp9": 1.4, "av1": 2.0, "mpeg4": 0.8, "prores": 1.2}
+
+# Seeds per "operation/output codec": (seconds per megapixel-frame, output bits per pixel).
+# Measured on one core with the benchmark clips; replaced by measured runs as jobs complete.
+PRIORS = {
+    "thumbnail/mjpeg": (0.02, 0.8),
+    "preview/h264": (0.003, 0.08),
+    "preview/webp": (0.008, 0.37),
+    "watermark/h264": (0.018, 0.1),
+    "resize/h264": (0.015, 0.09),
+    "transform/h264": (0.018, 0.1)
+}
+DEFAULT_PRIOR = (0.02, 0.1)
+
+# Encode time and output size of each codec profile relative to H.264, for
+# pairs without a seed of their own ("resize/av1", "watermark/hevc+h264", ...)
+CODEC_FACTORS = {"h264": (1.0, 1.0), "hevc": (3.0, 0.65), "av1": (7.0, 0.75), "vp9": (4.5, 0.95)}
+
+# Process start, container parsing and muxing, paid once per ffmpeg run
+RUN_OVERHEAD_SECONDS = 0.05
+
+# Stream banner ffmpeg prints for its inputs and outputs (also what `ffmpeg -i` prints when probing)
+DURATION_PATTERN = re.compile(rb"Duration: (\d+):(\d+):([\d.]+)")
+VIDEO_STREAM_PATTERN = re.compile(rb"Stream #\d+:\d+[^\n]*?: Video: (\w+)[^\n]*?, (\d{2,5})x(\d{2,5})(?:[^\n]*?, ([\d.]+) fps)?")
+FRAME_PATTERN = re.compile(rb"frame=\s*(\d+)")
+TIME_PATTERN = re.compile(rb"time=\s*(\d+):(\d+):([\d.]+)")
+AUDIO_STREAM_PATTERN = re.compile(rb"Stream #\d+:\d+[^\n]*?: Audio: ")
+OUTPUT_SIZE_PATTERN = re.compile(rb"video:\s*(\d+)(?:KiB|kB)\s+audio:\s*(\d+)(?:KiB|kB)")
+SECOND_OUTPUT = b"Output #1"
+
+def _seconds(match: re.Match) -> float:
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+def parse_ffmpeg_log(stderr: bytes) -> Dict[str, Any]:
+    """Source and output features from ffmpeg's stderr
+
+    Source: duration, codec, width, height, fps, has_audio. Output (for finished runs):
+    output_codec, output_width, output_height, output_frames,
+    processed_seconds and output_bytes (summed over every output file).
+    """
+    source_log, _, output_log = (stderr or b"").partition(b"Output #0")
+    info: Dict[str, Any] = {}
+
+    duration = DURATION_PATTERN.search(source_log)
+    if duration:
+        info["duration"] = _seconds(duration)
+    video = VIDEO_STREAM_PATTERN.search(source_log)
+    if video:
+        codec, width, height, fps = video.groups()
+        info.update(codec=codec.decode(), width=int(width), height=int(height))
+        if fps:
+            info["fps"] = float(fps)
+        info["has_audio"] = AUDIO_STREAM_PATTERN.search(source_log) is not None
+
+    output = VIDEO_STREAM_PATTERN.search(output_log)
+    if output:
+        codec, width, height, _ = output.groups()
+        info.update(output_codec=codec.decode(), output_width=int(width), output_height=int(height))
+    frames = FRAME_PATTERN.findall(output_log)
+    if frames:
+        info["output_frames"] = int(frames[-1])
+    times = list(TIME_PATTERN.finditer(output_log))
+    if times:
+        info["processed_seconds"] = _seconds(times[-1])
+    sizes = OUTPUT_SIZE_PATTERN.findall(output_log)
+    if sizes:
+        info["output_bytes"] = sum(int(video) + int(audio) for video, audio in sizes) * 1024
+    return info
+
+def work_units(decoded_frames: float, source_pixels: int, codec: Optional[str],
+               output_frames: float, output_pixels: int) -> float:
+    """Megapixel-frames decoded (weighted by source codec) plus megapixel-frames encoded"""
+    decode = decoded_frames * source_pixels * DECODE_FACTORS.get(codec or "h264", 1.0)
+    return (decode + output_frames * output_pixels) / MEGAPIXEL
+
+def _even(value: float) -> int:
+    return max(2, int(value) // 2 * 2)
+
+def _prior(key: str) -> Tuple[float, float]:
+    """Seed coefficients of a pair; "op/a+b" runs (one decode, two encodes) add up their parts"""
+    if key in PRIORS:
+        return PRIORS[key]
+    operation, _, codecs = key.partition("/")
+    rate = bits_per_pixel = 0.0
+    for codec in codecs.split("+"):
+        base_rate, base_bpp = PRIORS.get(f"{operation}/h264", DEFAULT_PRIOR)
+        rate_factor, size_factor = CODEC_FACTORS.get(codec, (1.0, 1.0))
+        rate += base_rate * rate_factor
+        bits_per_pixel += base_bpp * size_factor
+    return rate, bits_per_pixel
+
+def codec_key(operation: str, codec: str = "h264", h264_fallback: bool = False) -> str:
+    """Cost model key of an encode, with "+h264" when an H.264 fallback is encoded alongside"""
+    return f"{operation}/{codec}+h264" if h264_fallback and codec != "h264" else f"{operation}/{codec}"
+
+def _fit(source_width: int, source_height: int, width: Optional[int], height: Optional[int]) -> Tuple[int, int]:
+    """Output size of a scale that keeps the source aspect ratio"""
+    aspect = source_width / source_height
+    if width and height:
+        return (width, _even(width / aspect)) if aspect > width / height else (_even(height * aspect), height)
+    if width:
+        return width, _even(width / aspect)
+    if height:
+        return _even(height * aspect), height
+    return source_width, source_height
+
+class CostModel:
+    """Predicts ffmpeg run time and output size per job, refined from measured runs
+
+    A run's work is counted in megapixel-frames decoded and encoded. Each
+    operation/output codec pair has a rate (seconds per megapixel-frame) and
+    an output density (bits per pixel), seeded from PRIORS and moved towards
+    every measured run by an exponentially weighted average. Coefficients
+    live in a small SQLite file so every worker process learns from the others.
+    predict, observe and stats may touch that file, so callers on the event
+    loop run them through asyncio.to_thread.
+    """
+
+    def __init__(self, db_path: Optional[str] = None):
+        self.db_path = db_path or os.getenv(
+            "COST_MODEL_PATH",
+            os.path.join(tempfile.gettempdir(), "ffmpeg_cost_model.db")
+        )
+        self.alpha = float(os.getenv("COST_MODEL_ALPHA", "0.2"))
+        self.refresh_seconds = float(os.getenv("COST_MODEL_REFRESH_SECONDS", "10"))
+        self._coefficients: Dict[str, Tuple[float, float, int]] = {}
+        self._loaded_at = 0.0
+
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS coefficients ("
+                "key TEXT PRIMARY KEY, rate REAL NOT NULL, bits_per_pixel REAL NOT NULL, "
+                "samples INTEGER NOT NULL DEFAULT 0, updated_at REAL)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=10.0)
+
+    def _refresh(self):
+        """Pick up coefficients learned by other processes"""
+        if time.time() - self._loaded_at > self.refresh_seconds:
+            try:
+                with self._connect() as conn:
+                    rows = conn.execute("SELECT key, rate, bits_per_pixel, samples FROM coefficients").fetchall()
+                self._coefficients = {row[0]: row[1:] for row in rows}
+                self._loaded_at = time.time()
+            except sqlite3.Error as e:
+                logger.warning("⚠️ Could not load cost model: %s", e)
+
+    def coefficients(self, key: str) -> Tuple[float, float, int]:
+        """(rate, bits per pixel, samples) for an operation/output codec pair"""
+        self._refresh()
+        if key in self._coefficients:
+            return self._coefficients[key]
+        return (*_prior(key), 0)
+
+    def predict_run(self, key: str, units: float, output_frames: float, output_pixels: int) -> Dict[str, Any]:
+        rate, bits_per_pixel, samples = self.coefficients(key)
+        return {
+            "key": key,
+            "seconds": round(RUN_OVERHEAD_SECONDS + rate * units, 3),
+            "output_bytes": int(bits_per_pixel * output_frames * output_pixels / 8),
+            "samples": samples
+        }
+
+    def predict(self, operation: str, params: Dict[str, Any], source: Dict[str, Any]) -> Dict[str, Any]:
+        """Predicted seconds and output bytes of a job, with one entry per ffmpeg run"""
+        runs = []
+        for key, decoded_frames, output_frames, (width, height), max_bytes in self._runs(operation, params, source):
+            run = self.predict_run(
+                key,
+                work_units(decoded_frames, source["width"] * source["height"], source.get("codec"),
+                           output_frames, width * height),
+                output_frames,
+                width * height
+            )
+            if max_bytes:
+                run["output_bytes"] = min(run["output_bytes"], max_bytes)
+            run["output_resolution"] = f"{width}x{height}"
+            runs.append(run)
+        return {
+            "seconds": round(sum(run["seconds"] for run in runs), 3),
+            "output_bytes": sum(run["output_bytes"] for run in runs),
+            "runs": runs
+        }
+
+    def _runs(self, operation: str, params: Dict[str, Any], source: Dict[str, Any]) -> List[tuple]:
+        """(key, decoded frames, output frames, output size, byte cap) of each ffmpeg run a job makes"""
+        width, height = source["width"], source["height"]
+        fps = source.get("fps") or 30.0
+        frames = source["duration"] * fps
+
+        if operation == "thumbnail":
+            runs = [("thumbnail/mjpeg", 1, 1, _fit(width, height, params.get("width"), params.get("height")), None)]
+            if params.get("preview"):
+                runs += self._runs("preview", params["preview"], source)
+            return runs
+        if operation == "preview":
+            clip = min(params.get("duration", 3.0), max(source["duration"] - params.get("start", 0.0), 0.1))
+            size = _fit(width, height, params.get("width", 320), None)
+            return [
+                (f"preview/{'h264' if fmt == 'mp4' else fmt}", clip * fps, clip * params.get("fps", 12),
+                 size, params.get("max_bytes"))
+                for fmt in params.get("formats") or ["mp4"]
+            ]
+        if operation == "resize":
+            if params.get("width") and params.get("height"):
+                size = (params["width"], params["height"])  # padded or stretched to the full box
+            else:
+                size = _fit(width, height, params.get("width"), params.get("height"))
+            key = codec_key("resize", params.get("codec", "h264"), params.get("h264_fallback", False))
+            # A byte target caps every output file of the run
+            cap = params.get("target_size_bytes") and params["target_size_bytes"] * (2 if "+" in key else 1)
+            return [(key, frames, frames, size, cap)]
+        if operation == "transform":
+            return [self._transform_run(params, width, height, fps, source["duration"])]
+        return [(codec_key(operation, params.get("codec", "h264"), params.get("h264_fallback", False)),
+                 frames, frames, (width, height), None)]
+
+    def _transform_run(self, params: Dict[str, Any], width: int, height: int, fps: float, duration: float) -> tuple:
+        """The single run of a transform pipeline: trimmed span, output fps and size after its scales"""
+        output_fps = fps
+        for step in params.get("steps") or []:
+            if step["op"] == "trim":
+                start = step.get("start") or 0.0
+                duration = min(step.get("duration") or duration, max(duration - start, 0.1))
+            elif step["op"] == "fps":
+                output_fps = step["fps"]
+            elif step["op"] == "scale":
+                if step.get("width") and step.get("height"):
+                    width, height = step["width"], step["height"]
+                else:
+                    width, height = _fit(width, height, step.get("width"), step.get("height"))
+        key = codec_key("transform", params.get("codec", "h264"), params.get("h264_fallback", False))
+        return (key, duration * fps, duration * output_fps, (width, height), None)
+
+    def observe(self, operation: str, stderr: Optional[bytes], elapsed: float):
+        """Fold a finished ffmpeg run into the coefficients of its operation/output codec"""
+        info = parse_ffmpeg_log(stderr)
+        if "width" not in info or "output_width" not in info or not info.get("output_frames"):
+            return
+        key = codec_key(operation, info["output_codec"], SECOND_OUTPUT in stderr)
+        output_pixels = info["output_width"] * info["output_height"]
+        decoded_frames = max(info.get("processed_seconds", 0.0) * info.get("fps", 30.0), 1.0)
+        units = work_units(decoded_frames, info["width"] * info["height"], info["codec"],
+                           info["output_frames"], output_pixels)
+        if units <= 0:
+            return
+
+        prior_rate, prior_bpp, _ = self.coefficients(key)
+        predicted = RUN_OVERHEAD_SECONDS + prior_rate * units
+        COST_MODEL_ERROR.labels(operation).observe(elapsed / predicted)
+        # Bound single outliers (a stalled disk, a paused VM) to 20x the current estimate
+        rate = min(max((elapsed - RUN_OVERHEAD_SECONDS) / units, prior_rate / 20), prior_rate * 20)
+        bits_per_pixel = prior_bpp
+        if info.get("output_bytes"):
+            bits_per_pixel = info["output_bytes"] * 8 / (info["output_frames"] * output_pixels)
+
+        seed_rate, seed_bpp = _prior(key)
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT OR IGNORE INTO coefficients (key, rate, bits_per_pixel, samples) VALUES (?, ?, ?, 0)",
+                    (key, seed_rate, seed_bpp)
+                )
+                # Early samples move the estimate more: weight 1/2, 1/3, ... down to COST_MODEL_ALPHA
+                conn.execute(
+                    "UPDATE coefficients SET "
+                    "rate = rate + MAX(?, 1.0 / (samples + 2)) * (? - rate), "
+                    "bits_per_pixel = bits_per_pixel + MAX(?, 1.0 / (samples + 2)) * (? - bits_per_pixel), "
+                    "samples = samples + 1, updated_at = ? WHERE key = ?",
+                    (self.alpha, rate, self.alpha, bits_per_pixel, time.time(), key)
+                )
+            self._loaded_at = 0.0
+        except sqlite3.Error as e:
+            logger.warning("⚠️ Could not update cost model: %s", e)
+
+    def stats(self) -> Dict[str, Any]:
+        self._refresh()
+        keys = sorted(set(PRIORS) | set(self._coefficients))
+        return {
+            key: dict(zip(("rate", "bits_per_pixel", "samples"), self.coefficients(key)))
+            for key in keys
+        }
+
+cost_model = CostModel()
@@ -0,0 +1,159 @@
+import os
+import json
+import asyncio
+import logging
+import httpx
+from typing import Optional, Dict, Any, List
+
+logger = logging.getLogger(__name__)
+
+class _PendingUpdate:
+    """Column changes for one generation waiting for the next flush"""
+
+    def __init__(self):
+        self.columns: Dict[str, Any] = {}
+        self.waiters: List[asyncio.Future] = []
+        self.return_representation = False
+
+class GenerationUpdateCoalescer:
+    """Merges ai_generations column updates and flushes them as bulk PATCH requests
+
+    All changes for one generation inside the window become a single PATCH.
+    Generations whose merged changes are identical share one PATCH filtered
+    with id=in.(...). Distinct payloads are sent concurrently over one pooled
+    connection. The server only returns rows when a caller asks for them.
+    """
+
+    def __init__(self, supabase_url: str, supabase_key: str, window: Optional[float] = None):
+        self.supabase_url = supabase_url
+        self.supabase_key = supabase_key
+        self.window = window if window is not None else int(os.getenv("DB_UPDATE_WINDOW_MS", "50")) / 1000
+        self.max_batch = int(os.getenv("DB_UPDATE_MAX_BATCH", "100"))
+        self._pending: Dict[str, _PendingUpdate] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self.requests_sent = 0
+        self.updates_merged = 0
+
+    async def update(
+        self,
+        generation_id: str,
+        columns: Dict[str, Any],
+        return_representation: bool = False
+    ) -> Any:
+        """Queue column changes; resolves to True/False, or the updated row when requested"""
+        pending = self._pending.get(generation_id)
+        if pending is None:
+            pending = self._pending[generation_id] = _PendingUpdate()
+        else:
+            self.updates_merged += 1
+
+        pending.columns.update(columns)
+        pending.return_representation = pending.return_representation or return_representation
+
+        waiter = asyncio.get_running_loop().create_future()
+        pending.waiters.append(waiter)
+
+        if len(self._pending) >= self.max_batch:
+            self._schedule_flush(0)
+        elif self._flush_task is None:
+            self._schedule_flush(self.window)
+
+        result = await waiter
+        if return_representation:
+            return result
+        return bool(result)
+
+    def _schedule_flush(self, delay: float):
+        if self._flush_task is not None:
+            if delay > 0:
+                return
+            # A full batch goes now; the window timer it replaces would only flush what comes after early.
+            # _flush_task is cleared before a flush starts, so this never cancels one in flight.
+            self._flush_task.cancel()
+        self._flush_task = asyncio.create_task(self._flush_after(delay))
+
+    async def _flush_after(self, delay: float):
+        if delay:
+            await asyncio.sleep(delay)
+        self._flush_task = None
+        batch, self._pending = self._pending, {}
+        if batch:
+            await self.flush(batch)
+
+    async def flush(self, batch: Dict[str, _PendingUpdate]):
+        """Send one PATCH per distinct column payload in the batch"""
+        groups: Dict[str, List[str]] = {}
+        for generation_id, pending in batch.items():
+            payload_key = json.dumps(pending.columns, sort_keys=True, default=str)
+            groups.setdefault(payload_key, []).append(generation_id)
+
+        await asyncio.gather(*(
+            self._patch_group(ids, batch) for ids in groups.values()
+        ))
+
+    async def _patch_group(self, generation_ids: List[str], batch: Dict[str, _PendingUpdate]):
+        columns = batch[generation_ids[0]].columns
+        want_rows = any(batch[gid].return_representation for gid in generation_ids)
+        results: Dict[str, Any] = {gid: False for gid in generation_ids}
+
+        headers = {
+            "apikey": self.supabase_key,
+            "Authorization": f"Bearer {self.supabase_key}",
+            "Content-Type": "application/json",
+            "Prefer": "return=representation" if want_rows else "return=minimal"
+        }
+
+        if len(generation_ids) == 1:
+            id_filter = f"eq.{generation_ids[0]}"
+        else:
+            id_filter = f"in.({','.join(generation_ids)})"
+
+        try:
+            client = self._get_client()
+            self.requests_sent += 1
+            response = await client.patch(
+                f"{self.supabase_url}/rest/v1/ai_generations",
+                params={"id": id_filter},
+                json=columns,
+                headers=headers
+            )
+
+            if response.status_code in [200, 204]:
+                logger.info(
+                    "✅ Database updated %s for %s generation(s)", sorted(columns), len(generation_ids)
+                )
+                if want_rows:
+                    rows = {str(row.get("id")): row for row in response.json()}
+                    results = {gid: rows.get(gid, {}) for gid in generation_ids}
+                else:
+                    results = {gid: True for gid in generation_ids}
+            else:
+                logger.error("❌ Database update failed with status %s: %s", response.status_code, response.text[:500])
+                logger.error("🔍 Generation IDs: %s", generation_ids)
+
+        except Exception as e:
+            logger.error("❌ Database update failed: %s", e)
+            logger.error("🔍 Generation IDs: %s", generation_ids)
+
+        for gid in generation_ids:
+            for waiter in batch[gid].waiters:
+                if not waiter.done():
+                    waiter.set_result(results[gid])
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=30.0)
+        return self._client
+
+    async def close(self):
+        """Flush anything still pending and close the pooled connection"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        if self._pending:
+            batch, self._pending = self._pending, {}
+            await self.flush(batch)
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
@@ -1,40 +1,193 @@
 import os
+import re
+import glob
+import json
+import time
 import logging
 import tempfile
+import importlib
+import importlib.util
 import subprocess
-from typing import Optional, Dict, Any
+from datetime import datetime
+from typing import Optional, Dict, Any, List, Tuple
 import asyncio
-from PIL import Image, ImageDraw, ImageFont
+from utils.metrics import ACTIVE_FFMPEG, ENCODE_SPEED, current_operation
+from utils.tracing import tracer
+from utils.cost_model import cost_model, parse_ffmpeg_log
+from utils.transform import TransformPlan, WATERMARK_POSITIONS
+from utils.keyframe_index import KeyframeIndex, parse_ffprobe_packets, parse_framecrc
 
-try:
-    import ffmpeg
-    FFMPEG_PYTHON_AVAILABLE = True
-except ImportError:
-    FFMPEG_PYTHON_AVAILABLE = False
+class _LazyModule:
+    """Imports a module on first attribute access, keeping it off the startup path"""
+    
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+    
+    def __getattr__(self, attribute: str):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
+
+# ffmpeg-python (and PIL, for the default watermark) load when a job first needs them
+FFMPEG_PYTHON_AVAILABLE = importlib.util.find_spec("ffmpeg") is not None
+if not FFMPEG_PYTHON_AVAILABLE:
     logging.warning("ffmpeg-python not available, using subprocess fallback")
+ffmpeg = _LazyModule("ffmpeg")
 
 logger = logging.getLogger(__name__)
 
+# What the service's commands need; anything missing is reported on /health
+REQUIRED_ENCODERS = ("libx264", "aac", "mjpeg", "libwebp")
+REQUIRED_FILTERS = ("scale", "pad", "fps", "overlay", "format", "colorchannelmixer")
+
+# " V....D libx264   libx264 H.264 ..." and " TSC scale   V->V   Scale the input ..."
+ENCODER_LINE = re.compile(r"^ [VAS][F.][S.][X.][B.][D.] ([\w-]+)", re.MULTILINE)
+FILTER_LINE = re.compile(r"^ [T.][S.][C.] (\S+)\s+\S*->\S*", re.MULTILINE)
+
+# Hover preview clips are re-encoded smaller until they fit the byte budget
+PREVIEW_MAX_ATTEMPTS = 3
+PREVIEW_MIN_WIDTH = 160
+PREVIEW_START_QUALITY = {"mp4": 28, "webp": 60}
+
+# Target-size resizes: capped CRF first, then two-pass encodes at a lower bitrate
+TARGET_SIZE_MAX_ATTEMPTS = 3
+TARGET_SIZE_MUX_OVERHEAD = 0.02       # Container headers and index, as a share of the target
+TARGET_SIZE_AUDIO_BITRATE = 96_000    # Lowered for small targets, down to the minimum
+TARGET_SIZE_MIN_AUDIO_BITRATE = 32_000
+TARGET_SIZE_MIN_VIDEO_BITRATE = 50_000
+
+DEFAULT_WATERMARK_PATH = "assets/default_watermark.png"
+
+# Output codec profiles. Encoders are in order of preference, each tuned for small
+# files at a workable speed (CRFs picked for similar quality to H.264 CRF 23).
+# The first container is the default.
+CODEC_PROFILES = {
+    "h264": {
+        "encoders": [("libx264", {"preset": "medium", "crf": 23})],
+        "containers": ["mp4", "mkv"]
+    },
+    "hevc": {
+        "encoders": [("libx265", {"preset": "medium", "crf": 28, "x265-params": "log-level=error"})],
+        "containers": ["mp4", "mkv"]
+    },
+    "av1": {
+        "encoders": [
+            ("libsvtav1", {"preset": 8, "crf": 35}),
+            ("libaom-av1", {"cpu-used": 6, "row-mt": 1, "crf": 35, "b:v": 0})
+        ],
+        "containers": ["mp4", "webm", "mkv"]
+    },
+    "vp9": {
+        "encoders": [("libvpx-vp9", {"deadline": "good", "cpu-used": 4, "row-mt": 1, "crf": 36, "b:v": 0})],
+        "containers": ["webm", "mp4", "mkv"]
+    }
+}
+
+# Final "speed=2.5x" from ffmpeg's progress output
+SPEED_PATTERN = re.compile(rb"speed=\s*([0-9.]+)x")
+# Banner of a run whose only output is the null muxer
+ANALYSIS_OUTPUT = b"Output #0, null,"
+
 class FFmpegProcessor:
     """Handles all FFmpeg operations"""
     
     def __init__(self):
         self.temp_dir = tempfile.gettempdir()
-        logger.info(f"FFmpeg processor initialized. Using temp dir: {self.temp_dir}")
+        self._capabilities: Optional[Dict[str, Any]] = None
+        self._discovery: Optional[asyncio.Task] = None
+        # Seeks within this many seconds of a keyframe land on it, decoding one frame instead of a GOP
+        self.keyframe_snap = float(os.getenv("KEYFRAME_SNAP_SECONDS", "0"))
+        # Per-encoder options over CODEC_PROFILES, e.g. {"libx265": {"crf": 26, "preset": "fast"}},
+        # as recommended by benchmarks/tune_quality.py
+        self.profile_overrides: Dict[str, Dict[str, Any]] = {}
+        try:
+            self.profile_overrides = json.loads(os.getenv("CODEC_PROFILE_OVERRIDES") or "{}")
+        except ValueError as e:
+            logger.error("❌ Ignoring CODEC_PROFILE_OVERRIDES, not valid JSON: %s", e)
+        logger.info("FFmpeg processor initialized. Using temp dir: %s", self.temp_dir)
     
     async def check_ffmpeg(self) -> bool:
-        """Check if FFmpeg is available"""
+        """Check if FFmpeg is available (from the cached capability discovery)"""
+        return (await self.capabilities())["available"]
+    
+    def start_discovery(self):
+        """Discover capabilities in the background so startup doesn't wait on it"""
+        if self._discovery is None:
+            self._discovery = asyncio.create_task(self.discover_capabilities())
+    
+    async def capabilities(self) -> Dict[str, Any]:
+        """Cached result of discover_capabilities(); the first caller runs it"""
+        if self._capabilities is None:
+            self.start_discovery()
+            self._capabilities = await asyncio.shield(self._discovery)
+        return self._capabilities
+    
+    async def discover_capabilities(self) -> Dict[str, Any]:
+        """ffmpeg version, encoders and filters, and whether ffprobe's JSON output works
+        
+        Spawns a handful of processes once; /health and the processor read
+        the cached result afterwards.
+        """
+        started = time.perf_counter()
+        version, encoders, filters, ffprobe = await asyncio.gather(
+            self._capture('ffmpeg', '-hide_banner', '-version'),
+            self._capture('ffmpeg', '-hide_banner', '-encoders'),
+            self._capture('ffmpeg', '-hide_banner', '-filters'),
+            self._capture('ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_program_version')
+        )
+        
+        ffprobe_version = None
         try:
-            result = await asyncio.create_subprocess_exec(
-                'ffmpeg', '-version',
+            ffprobe_version = json.loads(ffprobe)["program_version"]["version"] if ffprobe else None
+        except (ValueError, KeyError, TypeError):
+            pass
+        version_match = re.search(r"ffmpeg version (\S+)", version or "")
+        encoder_names = sorted(set(ENCODER_LINE.findall(encoders or "")))
+        filter_names = sorted(set(FILTER_LINE.findall(filters or "")))
+        
+        capabilities = {
+            "available": version is not None,
+            "version": version_match.group(1) if version_match else None,
+            "ffprobe_json": ffprobe_version is not None,
+            "ffprobe_version": ffprobe_version,
+            "ffmpeg_python": FFMPEG_PYTHON_AVAILABLE,
+            "missing": [name for name in REQUIRED_ENCODERS if name not in encoder_names]
+                       + [name for name in REQUIRED_FILTERS if name not in filter_names],
+            "encoders": encoder_names,
+            "filters": filter_names,
+            "discovered_at": datetime.utcnow().isoformat(),
+            "discovery_ms": round((time.perf_counter() - started) * 1000, 1)
+        }
+        if not capabilities["available"]:
+            logger.error("❌ FFmpeg not available")
+        else:
+            logger.info(
+                "🔎 FFmpeg %s: %s encoders, %s filters, ffprobe JSON %s (%.0fms)",
+                capabilities["version"], len(encoder_names), len(filter_names),
+                "ok" if capabilities["ffprobe_json"] else "unavailable", capabilities["discovery_ms"]
+            )
+        if capabilities["missing"]:
+            logger.warning("⚠️ FFmpeg is missing: %s", ", ".join(capabilities["missing"]))
+        return capabilities
+    
+    async def _capture(self, *cmd: str) -> Optional[str]:
+        """stdout of a short-lived command, or None if it can't run or fails"""
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
                 stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
+                stderr=asyncio.subprocess.DEVNULL
             )
-            await result.communicate()
-            return result.returncode == 0
+            stdout, _ = await asyncio.wait_for(process.communicate(), 10)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            return None
         except Exception as e:
-            logger.error(f"FFmpeg not available: {str(e)}")
-            return False
+            logger.debug("%s unavailable: %s", cmd[0], e)
+            return None
+        return stdout.decode(errors="replace") if process.returncode == 0 else None
     
     def create_default_watermark(self) -> str:
         """Create a default watermark image if none exists"""
@@ -74,12 +227,12 @@ class FFmpegProcessor:
             
             # Save the watermark
             img.save(watermark_path, 'PNG')
-            logger.info(f"✅ Created default watermark at: {watermark_path}")
+            logger.info("✅ Created default watermark at: %s", watermark_path)
             
             return watermark_path
             
         except Exception as e:
-            logger.error(f"Failed to create default watermark: {str(e)}")
+            logger.error("Failed to create default watermark: %s", e)
             # Create a very simple watermark using FFmpeg as fallback
             watermark_path = os.path.join(self.temp_dir, "default_watermark.png")
             cmd = [
@@ -98,295 +251,682 @@ class FFmpegProcessor:
         video_path: str,
         timestamp: float = 1.0,
         width: Optional[int] = None,
-        height: Optional[int] = None
+        height: Optional[int] = None,
+        work_dir: Optional[str] = None,
+        keyframes: Optional[KeyframeIndex] = None
     ) -> str:
         """Extract a thumbnail from video at specified timestamp"""
         try:
+            timestamp = self.seek_time(timestamp, keyframes)
             output_path = os.path.join(
-                self.temp_dir, 
+                work_dir or self.temp_dir,
                 f"thumb_{os.urandom(8).hex()}.jpg"
             )
             
             if FFMPEG_PYTHON_AVAILABLE:
                 # Get video info first to understand dimensions for aspect ratio preservation
                 try:
-                    probe = ffmpeg.probe(video_path)
-                    video_stream = next((stream for stream in probe['streams'] 
-                                       if stream['codec_type'] == 'video'), None)
-                    
-                    if video_stream:
-                        original_width = int(video_stream['width'])
-                        original_height = int(video_stream['height'])
-                        aspect_ratio = original_width / original_height
-                        logger.info(f"Original video: {original_width}x{original_height} (AR: {aspect_ratio:.2f})")
-                        
-                        # Calculate smart scaling to preserve aspect ratio
-                        if width and height:
-                            # Scale to fit within bounds while preserving AR
-                            target_ar = width / height
-                            if aspect_ratio > target_ar:
-                                # Video is wider - fit to width
-                                scale_width = width
-                                scale_height = int(width / aspect_ratio)
-                            else:
-                                # Video is taller - fit to height  
-                                scale_height = height
-                                scale_width = int(height * aspect_ratio)
-                            width, height = scale_width, scale_height
-                            logger.info(f"Smart scaled to: {width}x{height} (preserving AR)")
-                        elif width:
-                            # Only width provided - calculate height to preserve AR
-                            height = int(width / aspect_ratio)
-                            logger.info(f"Width scaled to: {width}x{height} (preserving AR)")
-                        elif height:
-                            # Only height provided - calculate width to preserve AR
-                            width = int(height * aspect_ratio)
-                            logger.info(f"Height scaled to: {width}x{height} (preserving AR)")
+                    original_width, original_height = await self._video_size(video_path)
+                    logger.info("Original video: %sx%s (AR: %.2f)", original_width, original_height, original_width / original_height)
+                    width, height = self._fit_thumbnail(original_width, original_height, width, height)
                 except Exception as probe_error:
-                    logger.warning(f"Could not probe video for AR: {probe_error}")
-                
-                # Use ffmpeg-python library
-                stream = ffmpeg.input(video_path, ss=timestamp)
-                
-                # Apply scaling if dimensions provided
-                if width and height:
-                    stream = ffmpeg.filter(stream, 'scale', width, height)
-                elif width:
-                    stream = ffmpeg.filter(stream, 'scale', width, -1)
-                elif height:
-                    stream = ffmpeg.filter(stream, 'scale', -1, height)
-                
-                stream = ffmpeg.output(
-                    stream,
-                    output_path,
-                    vframes=1,
-                    format='image2',
-                    vcodec='mjpeg',
-                    **{'q:v': 2}  # High quality JPEG
-                )
-                
-                # Run FFmpeg command
-                await self._run_ffmpeg_async(stream)
-            else:
-                # Fallback to subprocess with smart aspect ratio handling
-                cmd = [
-                    'ffmpeg',
-                    '-ss', str(timestamp),
-                    '-i', video_path,
-                    '-vframes', '1',
-                    '-f', 'image2',
-                    '-vcodec', 'mjpeg',
-                    '-q:v', '2'
-                ]
-                
-                # Build scale filter that preserves aspect ratio
-                if width and height:
-                    # Use scale filter with aspect ratio preservation
-                    cmd.extend(['-vf', f'scale={width}:{height}:force_original_aspect_ratio=decrease'])
-                elif width:
-                    cmd.extend(['-vf', f'scale={width}:-1'])
-                elif height:
-                    cmd.extend(['-vf', f'scale=-1:{height}'])
-                
-                cmd.append(output_path)
-                
-                await self._run_command_async(cmd)
+                    logger.warning("Could not probe video for AR: %s", probe_error)
+            
+            # Run FFmpeg command
+            await self._run(self.thumbnail_command(video_path, output_path, timestamp, width, height))
             
-            logger.info(f"✅ Thumbnail extracted: {output_path}")
+            logger.info("✅ Thumbnail extracted: %s", output_path)
             return output_path
             
         except Exception as e:
-            logger.error(f"❌ Thumbnail extraction failed: {str(e)}")
+            logger.error("❌ Thumbnail extraction failed: %s", e)
             raise
     
+    async def _video_size(self, video_path: str) -> Tuple[int, int]:
+        """Source resolution, from ffprobe when its JSON output works, else ffmpeg's banner"""
+        if (await self.capabilities())["ffprobe_json"]:
+            with tracer.span("ffprobe", path=os.path.basename(video_path)):
+                probe = ffmpeg.probe(video_path)
+            video_stream = next((stream for stream in probe['streams']
+                               if stream['codec_type'] == 'video'), None)
+            if video_stream is None:
+                raise ValueError("No video stream")
+            return int(video_stream['width']), int(video_stream['height'])
+        
+        source = await self.probe_source(video_path)
+        if source is None:
+            raise ValueError("Could not read the source resolution")
+        return source["width"], source["height"]
+    
+    def _fit_thumbnail(
+        self,
+        original_width: int,
+        original_height: int,
+        width: Optional[int],
+        height: Optional[int]
+    ) -> Tuple[Optional[int], Optional[int]]:
+        """Thumbnail size that keeps the source aspect ratio within the requested bounds"""
+        aspect_ratio = original_width / original_height
+        if width and height:
+            # Scale to fit within bounds while preserving AR
+            if aspect_ratio > width / height:
+                # Video is wider - fit to width
+                width, height = width, int(width / aspect_ratio)
+            else:
+                # Video is taller - fit to height
+                width, height = int(height * aspect_ratio), height
+        elif width:
+            # Only width provided - calculate height to preserve AR
+            height = int(width / aspect_ratio)
+        elif height:
+            # Only height provided - calculate width to preserve AR
+            width = int(height * aspect_ratio)
+        else:
+            return width, height
+        logger.info("Scaled to: %sx%s (preserving AR)", width, height)
+        return width, height
+    
+    def thumbnail_command(
+        self,
+        video_path: str,
+        output_path: str,
+        timestamp: float = 1.0,
+        width: Optional[int] = None,
+        height: Optional[int] = None
+    ):
+        """Thumbnail extraction: an ffmpeg-python stream, or argv for the subprocess fallback"""
+        if FFMPEG_PYTHON_AVAILABLE:
+            # Use ffmpeg-python library
+            stream = ffmpeg.input(video_path, ss=timestamp)
+            
+            # Apply scaling if dimensions provided
+            if width and height:
+                stream = ffmpeg.filter(stream, 'scale', width, height)
+            elif width:
+                stream = ffmpeg.filter(stream, 'scale', width, -1)
+            elif height:
+                stream = ffmpeg.filter(stream, 'scale', -1, height)
+            
+            return ffmpeg.output(
+                stream,
+                output_path,
+                vframes=1,
+                format='image2',
+                vcodec='mjpeg',
+                **{'q:v': 2}  # High quality JPEG
+            )
+        
+        # Fallback to subprocess with smart aspect ratio handling
+        cmd = [
+            'ffmpeg',
+            '-ss', str(timestamp),
+            '-i', video_path,
+            '-vframes', '1',
+            '-f', 'image2',
+            '-vcodec', 'mjpeg',
+            '-q:v', '2'
+        ]
+        
+        # Build scale filter that preserves aspect ratio
+        if width and height:
+            # Use scale filter with aspect ratio preservation
+            cmd.extend(['-vf', f'scale={width}:{height}:force_original_aspect_ratio=decrease'])
+        elif width:
+            cmd.extend(['-vf', f'scale={width}:-1'])
+        elif height:
+            cmd.extend(['-vf', f'scale=-1:{height}'])
+        
+        cmd.append(output_path)
+        return cmd
+    
     async def add_watermark(
         self,
         video_path: str,
         watermark_path: str,
         position: str = "bottom-center",
         opacity: float = 0.9,
-        scale: float = 0.5
+        scale: float = 0.5,
+        work_dir: Optional[str] = None,
+        codec: str = "h264",
+        container: Optional[str] = None,
+        h264_fallback: bool = False
     ) -> str:
-        """Add watermark to video"""
+        """Add watermark to video
+        
+        With h264_fallback (and a codec other than H.264) an H.264 MP4 is
+        encoded in the same pass, at fallback_path(output).
+        """
         try:
+            container = self.check_output(codec, container)
             output_path = os.path.join(
-                self.temp_dir,
-                f"watermarked_{os.urandom(8).hex()}.mp4"
+                work_dir or self.temp_dir,
+                f"watermarked_{os.urandom(8).hex()}.{container}"
             )
+            fallback = self.fallback_path(output_path) if h264_fallback and codec != "h264" else None
             
             # Check if watermark file exists, create default if not
             if not os.path.exists(watermark_path):
-                logger.warning(f"Watermark not found at {watermark_path}, creating default...")
+                logger.warning("Watermark not found at %s, creating default...", watermark_path)
                 watermark_path = self.create_default_watermark()
             
-            # Position mapping - Clean expressions without backslashes
-            positions = {
-                "bottom-center": "(W-w)/2:H-h-50",      # 50px from bottom, centered
-                "left-center": "10:(H-h)/2",        # Left edge, centered
-                "right-center": "W-w-10:(H-h)/2"    # Right edge, centered
-            }
+            logger.info("🎯 Watermark position: %s -> %s", position, WATERMARK_POSITIONS.get(position, WATERMARK_POSITIONS["bottom-center"]))
+            logger.info("📁 Using watermark file: %s", watermark_path)
+            logger.info("💧 Watermark settings: opacity=%s, scale=%s, codec=%s/%s", opacity, scale, codec, container)
             
-            overlay_position = positions.get(position, "(W-w)/2:H-h-50")
-            logger.info(f"🎯 Watermark position: {position} -> {overlay_position}")
-            logger.info(f"📁 Using watermark file: {watermark_path}")
-            logger.info(f"💧 Watermark settings: opacity={opacity}, scale={scale}")
+            await self._run(self.watermark_command(
+                video_path, watermark_path, output_path, position, opacity, scale,
+                codec, container, fallback
+            ))
             
-            if FFMPEG_PYTHON_AVAILABLE:
-                # Use ffmpeg-python library with FIXED overlay approach
-                video = ffmpeg.input(video_path)
-                watermark = ffmpeg.input(watermark_path)
-                
-                # Scale watermark
-                watermark = ffmpeg.filter(
-                    watermark,
-                    'scale',
-                    f'iw*{scale}',
-                    f'ih*{scale}'
-                )
-                
-                # Set opacity
-                watermark = ffmpeg.filter(watermark, 'format', 'rgba')
-                watermark = ffmpeg.filter(watermark, 'colorchannelmixer', aa=opacity)
-                
-                # FIXED: Split x:y coordinates and pass them separately to avoid colon escaping
-                x_expr, y_expr = overlay_position.split(':')
-                video = ffmpeg.filter(
-                    [video, watermark],
-                    'overlay',
-                    x=x_expr,
-                    y=y_expr
-                )
-                
-                # Output with same codec
-                stream = ffmpeg.output(
-                    video,
-                    output_path,
-                    vcodec='libx264',
-                    acodec='aac',
-                    preset='medium',
-                    crf=23,
-                    movflags='+faststart'
-                )
-                
-                await self._run_ffmpeg_async(stream)
-            else:
-                # Fallback to subprocess - this method works fine
-                filter_complex = (
-                    f"[1:v]scale=iw*{scale}:ih*{scale},"
-                    f"format=rgba,colorchannelmixer=aa={opacity}[watermark];"
-                    f"[0:v][watermark]overlay={overlay_position}"
-                )
-                
-                cmd = [
-                    'ffmpeg',
-                    '-i', video_path,
-                    '-i', watermark_path,
-                    '-filter_complex', filter_complex,
-                    '-vcodec', 'libx264',
-                    '-acodec', 'aac',
-                    '-preset', 'medium',
-                    '-crf', '23',
-                    '-movflags', '+faststart',
-                    output_path
-                ]
-                
-                await self._run_command_async(cmd)
+            logger.info("✅ Watermark added: %s", output_path)
+            return output_path
+            
+        except Exception as e:
+            logger.error("❌ Watermark addition failed: %s", e)
+            raise
+    
+    def watermark_command(
+        self,
+        video_path: str,
+        watermark_path: str,
+        output_path: str,
+        position: str = "bottom-center",
+        opacity: float = 0.9,
+        scale: float = 0.5,
+        codec: str = "h264",
+        container: str = "mp4",
+        fallback_path: Optional[str] = None
+    ):
+        """Watermark overlay: an ffmpeg-python stream, or argv for the subprocess fallback"""
+        plan = TransformPlan([{"op": "watermark", "position": position, "opacity": opacity, "scale": scale}])
+        return self.transform_command(
+            video_path, output_path, plan, [watermark_path], codec, container, None, fallback_path
+        )
+    
+    async def transform(
+        self,
+        video_path: str,
+        plan: TransformPlan,
+        watermark_paths: Optional[List[str]] = None,
+        bitrate: Optional[str] = None,
+        work_dir: Optional[str] = None,
+        codec: str = "h264",
+        container: Optional[str] = None,
+        h264_fallback: bool = False
+    ) -> str:
+        """Run a transform plan as one decode, one filtergraph and one encode
+        
+        watermark_paths are the plan's watermark images, in order; missing
+        ones are replaced by the default watermark.
+        """
+        try:
+            container = self.check_output(codec, container)
+            output_path = os.path.join(
+                work_dir or self.temp_dir,
+                f"transformed_{os.urandom(8).hex()}.{container}"
+            )
+            fallback = self.fallback_path(output_path) if h264_fallback and codec != "h264" else None
+            
+            watermark_paths = list(watermark_paths or [])
+            for index in range(len(plan.watermarks)):
+                if index >= len(watermark_paths) or not os.path.exists(watermark_paths[index]):
+                    watermark_paths[index:index + 1] = [self.create_default_watermark()]
             
-            logger.info(f"✅ Watermark added: {output_path}")
+            logger.info("🧩 Transform: %s -> %s/%s", [step["op"] for step in plan.steps], codec, container)
+            await self._run(self.transform_command(
+                video_path, output_path, plan, watermark_paths, codec, container, bitrate, fallback
+            ))
+            
+            logger.info("✅ Transform done: %s", output_path)
             return output_path
             
         except Exception as e:
-            logger.error(f"❌ Watermark addition failed: {str(e)}")
+            logger.error("❌ Transform failed: %s", e)
             raise
     
+    def transform_command(
+        self,
+        video_path: str,
+        output_path: str,
+        plan: TransformPlan,
+        watermark_paths: Optional[List[str]] = None,
+        codec: str = "h264",
+        container: str = "mp4",
+        bitrate: Optional[str] = None,
+        fallback_path: Optional[str] = None,
+        target: Optional[Dict[str, Any]] = None,
+        fallback_target: Optional[Dict[str, Any]] = None
+    ):
+        """A transform plan as an ffmpeg-python stream, or argv for the subprocess fallback
+        
+        Every builder goes through here. With a fallback path the filtered
+        video is split into both encodes. target/fallback_target set rate
+        control for a byte target (see output_args).
+        """
+        watermark_paths = watermark_paths or []
+        outputs = [self._pass_output(
+            output_path, {**self.output_args(codec, container, bitrate, target), **plan.audio_options}
+        )]
+        if fallback_path:
+            outputs.append(self._pass_output(
+                fallback_path, {**self.output_args("h264", "mp4", bitrate, fallback_target), **plan.audio_options}
+            ))
+        
+        if FFMPEG_PYTHON_AVAILABLE:
+            stream = ffmpeg.input(video_path, **plan.input_options).video
+            for step in plan.video_filters:
+                if step[0] == "overlay":
+                    watermark = plan.watermarks[step[1]]
+                    image = ffmpeg.input(watermark_paths[step[1]])
+                    for name, args, kwargs in watermark["filters"]:
+                        image = ffmpeg.filter(image, name, *args, **kwargs)
+                    # x and y as keywords - ffmpeg-python escapes ':' inside positional args
+                    stream = ffmpeg.filter([stream, image], 'overlay', x=watermark["x"], y=watermark["y"])
+                else:
+                    _, name, args, kwargs = step
+                    stream = ffmpeg.filter(stream, name, *args, **kwargs)
+            
+            if len(outputs) == 1:
+                return ffmpeg.output(stream, outputs[0][0], **outputs[0][1])
+            split = stream.filter_multi_output('split')
+            return ffmpeg.merge_outputs(*(
+                ffmpeg.output(split[index], path, **args)
+                for index, (path, args) in enumerate(outputs)
+            ))
+        
+        # Fallback to subprocess - overwriting, as target-size retries reuse the output paths
+        cmd = ['ffmpeg', '-y']
+        for option, value in plan.input_options.items():
+            cmd.extend([f'-{option}', str(value)])
+        cmd.extend(['-i', video_path])
+        for watermark_path in watermark_paths[:len(plan.watermarks)]:
+            cmd.extend(['-i', watermark_path])
+        
+        graph, labels = plan.filter_complex(len(outputs))
+        cmd.extend(['-filter_complex', graph])
+        for label, (path, args) in zip(labels, outputs):
+            cmd.extend(['-map', label, *self._arg_list(args), path])
+        return cmd
+    
     async def resize_video(
         self,
         video_path: str,
         width: Optional[int] = None,
         height: Optional[int] = None,
         bitrate: Optional[str] = None,
-        preserve_aspect_ratio: bool = True
+        preserve_aspect_ratio: bool = True,
+        work_dir: Optional[str] = None,
+        codec: str = "h264",
+        container: Optional[str] = None,
+        h264_fallback: bool = False,
+        target_size_bytes: Optional[int] = None
     ) -> str:
-        """Resize/compress video"""
+        """Resize/compress video
+        
+        With h264_fallback (and a codec other than H.264) an H.264 MP4 is
+        encoded in the same pass, at fallback_path(output). With
+        target_size_bytes every output is kept under that size (bitrate is
+        then ignored); ValueError if it can't be.
+        """
         try:
+            container = self.check_output(codec, container)
             output_path = os.path.join(
-                self.temp_dir,
-                f"resized_{os.urandom(8).hex()}.mp4"
+                work_dir or self.temp_dir,
+                f"resized_{os.urandom(8).hex()}.{container}"
             )
+            fallback = self.fallback_path(output_path) if h264_fallback and codec != "h264" else None
             
-            if FFMPEG_PYTHON_AVAILABLE:
-                stream = ffmpeg.input(video_path)
-                
-                # Apply scaling
-                if width and height:
-                    if preserve_aspect_ratio:
-                        scale_filter = f'{width}:{height}:force_original_aspect_ratio=decrease'
-                        stream = ffmpeg.filter(stream, 'scale', scale_filter)
-                        stream = ffmpeg.filter(stream, 'pad', width, height, '(ow-iw)/2', '(oh-ih)/2')
-                    else:
-                        stream = ffmpeg.filter(stream, 'scale', width, height)
-                elif width:
-                    stream = ffmpeg.filter(stream, 'scale', width, -1)
-                elif height:
-                    stream = ffmpeg.filter(stream, 'scale', -1, height)
-                
-                # Output parameters
-                output_args = {
-                    'vcodec': 'libx264',
-                    'acodec': 'aac',
-                    'preset': 'medium',
-                    'crf': 23,
-                    'movflags': '+faststart'
-                }
-                
-                if bitrate:
-                    output_args['video_bitrate'] = bitrate
-                
-                stream = ffmpeg.output(stream, output_path, **output_args)
-                await self._run_ffmpeg_async(stream)
+            if target_size_bytes:
+                await self._resize_to_size(
+                    video_path, output_path, width, height, preserve_aspect_ratio,
+                    codec, container, fallback, target_size_bytes
+                )
             else:
-                # Fallback to subprocess
-                cmd = ['ffmpeg', '-i', video_path]
-                
-                if width and height:
-                    if preserve_aspect_ratio:
-                        cmd.extend([
-                            '-vf', f'scale={width}:{height}:force_original_aspect_ratio=decrease,pad={width}:{height}:(ow-iw)/2:(oh-ih)/2'
-                        ])
-                    else:
-                        cmd.extend(['-vf', f'scale={width}:{height}'])
-                elif width:
-                    cmd.extend(['-vf', f'scale={width}:-1'])
-                elif height:
-                    cmd.extend(['-vf', f'scale=-1:{height}'])
+                await self._run(self.resize_command(
+                    video_path, output_path, width, height, bitrate, preserve_aspect_ratio,
+                    codec, container, fallback
+                ))
+            
+            logger.info("✅ Video resized: %s", output_path)
+            return output_path
+            
+        except Exception as e:
+            logger.error("❌ Video resize failed: %s", e)
+            raise
+    
+    async def _resize_to_size(
+        self,
+        video_path: str,
+        output_path: str,
+        width: Optional[int],
+        height: Optional[int],
+        preserve_aspect_ratio: bool,
+        codec: str,
+        container: str,
+        fallback_path: Optional[str],
+        target_size_bytes: int
+    ):
+        """Resize with every output under target_size_bytes
+        
+        The first attempt is capped CRF: the profile's CRF with the bitrate
+        budget as its ceiling, so simple content comes out smaller. Outputs
+        that overshoot are re-encoded two-pass at a bitrate lowered by the
+        overshoot.
+        """
+        source = await self.probe_source(video_path)
+        if not source or not source.get("duration"):
+            raise ValueError("Can't encode to a target size without the source duration")
+        video_bitrate, audio_bitrate = self.target_bitrates(
+            target_size_bytes, source["duration"], source.get("has_audio", True)
+        )
+        paths = [output_path] + ([fallback_path] if fallback_path else [])
+        targets = [{"video_bitrate": video_bitrate, "audio_bitrate": audio_bitrate} for _ in paths]
+        passlogfile = os.path.join(os.path.dirname(output_path), f"passlog_{os.urandom(4).hex()}")
+        
+        try:
+            for attempt in range(1, TARGET_SIZE_MAX_ATTEMPTS + 1):
+                if attempt == 1:
+                    await self._run(self.resize_command(
+                        video_path, output_path, width, height, None, preserve_aspect_ratio,
+                        codec, container, fallback_path, *targets
+                    ))
+                else:
+                    for number in (1, 2):
+                        passes = [
+                            {**target, "pass": number, "passlogfile": f"{passlogfile}-{index}"}
+                            for index, target in enumerate(targets)
+                        ]
+                        await self._run(self.resize_command(
+                            video_path, output_path, width, height, None, preserve_aspect_ratio,
+                            codec, container, fallback_path, *passes
+                        ))
                 
-                cmd.extend([
-                    '-vcodec', 'libx264',
-                    '-acodec', 'aac',
-                    '-preset', 'medium',
-                    '-crf', '23',
-                    '-movflags', '+faststart'
-                ])
+                sizes = [os.path.getsize(path) for path in paths]
+                logger.info("🎯 Target size attempt %s (%s): %s bytes (target %s)",
+                            attempt, "capped CRF" if attempt == 1 else "two-pass", sizes, target_size_bytes)
+                if max(sizes) <= target_size_bytes:
+                    return
                 
-                if bitrate:
-                    cmd.extend(['-b:v', bitrate])
+                # Over the cap - lower each overshooting output's bitrate by its overshoot plus a margin
+                for target, size in zip(targets, sizes):
+                    if size > target_size_bytes:
+                        target["video_bitrate"] = int(target["video_bitrate"] * target_size_bytes / size * 0.95)
+                if min(target["video_bitrate"] for target in targets) < TARGET_SIZE_MIN_VIDEO_BITRATE:
+                    break
+        finally:
+            for log in glob.glob(f"{passlogfile}*"):
+                os.remove(log)
+        
+        raise ValueError(f"Couldn't fit the output under {target_size_bytes} bytes (got {max(sizes)})")
+    
+    def target_bitrates(self, target_size_bytes: int, duration: float, has_audio: bool = True) -> Tuple[int, int]:
+        """(video, audio) bits per second that fill target_size_bytes over duration
+        
+        Raises ValueError when the target leaves too little for the video.
+        """
+        total = target_size_bytes * 8 * (1 - TARGET_SIZE_MUX_OVERHEAD) / max(duration, 0.1)
+        audio_bitrate = 0
+        if has_audio:
+            # Audio gets at most a tenth of a small budget
+            audio_bitrate = int(min(TARGET_SIZE_AUDIO_BITRATE, max(TARGET_SIZE_MIN_AUDIO_BITRATE, total * 0.1)))
+        video_bitrate = int(total - audio_bitrate)
+        if video_bitrate < TARGET_SIZE_MIN_VIDEO_BITRATE:
+            raise ValueError(
+                f"target_size_bytes {target_size_bytes} is too small for {duration:.1f}s of video "
+                f"(needs at least {self.min_target_size(duration, has_audio)} bytes)"
+            )
+        return video_bitrate, audio_bitrate
+    
+    def min_target_size(self, duration: float, has_audio: bool = True) -> int:
+        bitrate = TARGET_SIZE_MIN_VIDEO_BITRATE + (TARGET_SIZE_MIN_AUDIO_BITRATE if has_audio else 0)
+        return int(bitrate * max(duration, 0.1) / 8 / (1 - TARGET_SIZE_MUX_OVERHEAD)) + 1
+    
+    def resize_command(
+        self,
+        video_path: str,
+        output_path: str,
+        width: Optional[int] = None,
+        height: Optional[int] = None,
+        bitrate: Optional[str] = None,
+        preserve_aspect_ratio: bool = True,
+        codec: str = "h264",
+        container: str = "mp4",
+        fallback_path: Optional[str] = None,
+        target: Optional[Dict[str, Any]] = None,
+        fallback_target: Optional[Dict[str, Any]] = None
+    ):
+        """Resize/compress: an ffmpeg-python stream, or argv for the subprocess fallback
+        
+        target/fallback_target set rate control for a byte target: video and
+        audio bitrates, plus pass and passlogfile for two-pass encodes.
+        """
+        steps = []
+        if width or height:
+            steps.append({"op": "scale", "width": width, "height": height, "preserve_aspect_ratio": preserve_aspect_ratio})
+        return self.transform_command(
+            video_path, output_path, TransformPlan(steps), [], codec, container, bitrate,
+            fallback_path, target, fallback_target
+        )
+    
+    def check_output(self, codec: str, container: Optional[str] = None) -> str:
+        """Validate a codec/container pair; returns the container (the profile's default if none)"""
+        profile = CODEC_PROFILES.get(codec)
+        if profile is None:
+            raise ValueError(f"Unknown codec: {codec}")
+        if container is None:
+            return profile["containers"][0]
+        if container not in profile["containers"]:
+            raise ValueError(f"{codec} can't be stored in {container}; use one of {', '.join(profile['containers'])}")
+        return container
+    
+    async def check_codec(self, codec: str, container: Optional[str] = None) -> Dict[str, str]:
+        """Validate a codec/container pair against this ffmpeg build; raises ValueError"""
+        container = self.check_output(codec, container)
+        await self.capabilities()
+        encoder = self.encoder_for(codec)
+        if encoder is None:
+            wanted = ", ".join(encoder for encoder, _ in CODEC_PROFILES[codec]["encoders"])
+            raise ValueError(f"No {codec} encoder in this ffmpeg build (needs {wanted})")
+        return {"codec": codec, "container": container, "encoder": encoder}
+    
+    def encoder_for(self, codec: str) -> Optional[str]:
+        """First encoder of a codec's profile that this ffmpeg build has (first choice before discovery)"""
+        encoders = [encoder for encoder, _ in CODEC_PROFILES[codec]["encoders"]]
+        if self._capabilities is None:
+            return encoders[0]
+        return next((encoder for encoder in encoders if encoder in self._capabilities["encoders"]), None)
+    
+    def output_args(
+        self,
+        codec: str = "h264",
+        container: str = "mp4",
+        bitrate: Optional[str] = None,
+        target: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        """Encoder and muxer options for a codec profile, rate-controlled for a byte target if given"""
+        encoder = self.encoder_for(codec)
+        if encoder is None:
+            raise ValueError(f"No {codec} encoder in this ffmpeg build")
+        args = {
+            'vcodec': encoder,
+            **dict(CODEC_PROFILES[codec]["encoders"])[encoder],
+            **self.profile_overrides.get(encoder, {})
+        }
+        args['acodec'] = 'libopus' if container == 'webm' else 'aac'
+        if codec != "h264":
+            args['pix_fmt'] = 'yuv420p'
+        if codec == "hevc" and container == "mp4":
+            # hvc1 tagging is what Apple players expect
+            args['tag:v'] = 'hvc1'
+        if container == "mp4":
+            args['movflags'] = '+faststart'
+        if bitrate:
+            args['b:v'] = bitrate
+        if target:
+            self._apply_target(args, target)
+        return args
+    
+    def _apply_target(self, args: Dict[str, Any], target: Dict[str, Any]):
+        video_bitrate = target["video_bitrate"]
+        if target.get("pass"):
+            # Two-pass average bitrate
+            args.pop('crf', None)
+            args.update({'b:v': video_bitrate, 'pass': target["pass"], 'passlogfile': target["passlogfile"]})
+        elif args['vcodec'] in ('libvpx-vp9', 'libaom-av1'):
+            # Constrained quality: CRF, with b:v as the ceiling
+            args['b:v'] = video_bitrate
+        else:
+            # Capped CRF: a one-second VBV buffer at the budget bitrate
+            args.update({'maxrate': video_bitrate, 'bufsize': video_bitrate})
+        if target["audio_bitrate"]:
+            args['b:a'] = target["audio_bitrate"]
+        else:
+            args['an'] = None
+    
+    def _pass_output(self, output_path: str, args: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+        """A first pass only writes its stats file; its output goes nowhere
+        
+        Audio is kept: stats files are named by stream index, which has to
+        match between the passes.
+        """
+        if args.get('pass') != 1:
+            return output_path, args
+        args = {key: value for key, value in args.items() if key not in ('movflags', 'tag:v')}
+        return os.devnull, {**args, 'f': 'null'}
+    
+    def fallback_path(self, output_path: str) -> str:
+        """Where the H.264 fallback of an output is written"""
+        return f"{os.path.splitext(output_path)[0]}_h264.mp4"
+    
+    def _arg_list(self, args: Dict[str, Any]) -> List[str]:
+        cmd = []
+        for key, value in args.items():
+            # None marks a flag without a value, as in ffmpeg-python
+            cmd.extend([f'-{key}'] if value is None else [f'-{key}', str(value)])
+        return cmd
+    
+    async def create_preview_clip(
+        self,
+        video_path: str,
+        start: float = 0.0,
+        duration: float = 3.0,
+        width: int = 320,
+        fps: int = 12,
+        formats: Optional[List[str]] = None,
+        max_bytes: int = 300_000,
+        work_dir: Optional[str] = None,
+        keyframes: Optional[KeyframeIndex] = None
+    ) -> Dict[str, str]:
+        """Create short, muted, low-res hover preview clips (MP4 and/or animated WebP)"""
+        formats = formats or ["mp4"]
+        start = self.seek_time(start, keyframes)
+        outputs = {}
+        created = []
+        
+        try:
+            for fmt in formats:
+                clip_width = width
+                quality = PREVIEW_START_QUALITY[fmt]
+                output_path = None
                 
-                cmd.append(output_path)
+                # Re-encode smaller until the clip fits the byte budget
+                for attempt in range(1, PREVIEW_MAX_ATTEMPTS + 1):
+                    output_path = os.path.join(
+                        work_dir or self.temp_dir,
+                        f"preview_{os.urandom(8).hex()}.{fmt}"
+                    )
+                    created.append(output_path)
+                    
+                    await self._run(self.preview_command(
+                        video_path, output_path, fmt, start, duration,
+                        clip_width, fps, quality, max_bytes
+                    ))
+                    
+                    size = os.path.getsize(output_path)
+                    logger.info("🎞️ Preview %s attempt %s: %spx, %s bytes (budget %s)", fmt, attempt, clip_width, size, max_bytes)
+                    
+                    if size <= max_bytes or attempt == PREVIEW_MAX_ATTEMPTS:
+                        break
+                    
+                    # Over budget - drop resolution and quality for the next attempt
+                    os.remove(output_path)
+                    created.remove(output_path)
+                    clip_width = max(PREVIEW_MIN_WIDTH, int(clip_width * 0.75) // 2 * 2)
+                    quality = quality + 4 if fmt == "mp4" else max(20, quality - 15)
                 
-                await self._run_command_async(cmd)
+                outputs[fmt] = output_path
             
-            logger.info(f"✅ Video resized: {output_path}")
-            return output_path
+            logger.info("✅ Preview clips created: %s", list(outputs.values()))
+            return outputs
             
         except Exception as e:
-            logger.error(f"❌ Video resize failed: {str(e)}")
+            logger.error("❌ Preview clip creation failed: %s", e)
+            for path in created:
+                if os.path.exists(path):
+                    os.remove(path)
             raise
     
+    def preview_command(
+        self,
+        video_path: str,
+        output_path: str,
+        fmt: str,
+        start: float,
+        duration: float,
+        width: int,
+        fps: int,
+        quality: int,
+        max_bytes: int
+    ):
+        """One preview clip in the requested format: an ffmpeg-python stream, or argv"""
+        scale_filter = f"fps={fps},scale={width}:-2:flags=bilinear"
+        
+        if fmt == "mp4":
+            # Cap the bitrate so the clip lands inside the byte budget
+            max_kbps = max(50, int(max_bytes * 8 * 0.9 / max(duration, 0.1) / 1000))
+            codec_args = {
+                'vcodec': 'libx264',
+                'preset': 'veryfast',
+                'crf': quality,
+                'maxrate': f'{max_kbps}k',
+                'bufsize': f'{max_kbps * 2}k',
+                'pix_fmt': 'yuv420p',
+                'movflags': '+faststart'
+            }
+        else:
+            codec_args = {
+                'vcodec': 'libwebp',
+                'loop': 0,
+                'q:v': quality,
+                'compression_level': 4,
+                'preset': 'default'
+            }
+        
+        if FFMPEG_PYTHON_AVAILABLE:
+            stream = ffmpeg.input(video_path, ss=start, t=duration)
+            stream = ffmpeg.filter(stream, 'fps', fps)
+            stream = ffmpeg.filter(stream, 'scale', width, -2, flags='bilinear')
+            return ffmpeg.output(stream, output_path, an=None, **codec_args)
+        
+        cmd = [
+            'ffmpeg', '-y',
+            '-ss', str(start),
+            '-t', str(duration),
+            '-i', video_path,
+            '-vf', scale_filter,
+            '-an'
+        ]
+        for key, value in codec_args.items():
+            cmd.extend([f'-{key}', str(value)])
+        cmd.append(output_path)
+        return cmd
+    
     async def get_video_metadata(self, video_path: str) -> Dict[str, Any]:
         """Extract video metadata using ffprobe"""
         try:
             if FFMPEG_PYTHON_AVAILABLE:
-                probe = ffmpeg.probe(video_path)
+                with tracer.span("ffprobe", path=os.path.basename(video_path)):
+                    probe = ffmpeg.probe(video_path)
                 
                 video_stream = next(
                     (stream for stream in probe['streams'] if stream['codec_type'] == 'video'),
@@ -432,13 +972,14 @@ class FFmpegProcessor:
                     video_path
                 ]
                 
-                result = await asyncio.create_subprocess_exec(
-                    *cmd,
-                    stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE
-                )
-                
-                stdout, _ = await result.communicate()
+                with tracer.span("ffprobe", path=os.path.basename(video_path)):
+                    result = await asyncio.create_subprocess_exec(
+                        *cmd,
+                        stdout=asyncio.subprocess.PIPE,
+                        stderr=asyncio.subprocess.PIPE
+                    )
+                    
+                    stdout, _ = await result.communicate()
                 import json
                 probe_data = json.loads(stdout)
                 
@@ -451,39 +992,272 @@ class FFmpegProcessor:
             return metadata
             
         except Exception as e:
-            logger.error(f"❌ Metadata extraction failed: {str(e)}")
+            logger.error("❌ Metadata extraction failed: %s", e)
             return {'error': str(e)}
     
+    async def keyframe_index(self, video_path: str) -> KeyframeIndex:
+        """Keyframe/GOP index of the first video stream, read from its packets without decoding
+        
+        Uses ffprobe's packet listing when ffprobe works, else ffmpeg's framecrc
+        muxer over a stream copy, which has the same timestamps, sizes and
+        flags but no byte offsets.
+        """
+        if (await self.capabilities())["ffprobe_json"]:
+            output = await self._run_command_async([
+                'ffprobe', '-v', 'error', '-select_streams', 'v:0',
+                '-show_entries', 'packet=pts_time,size,pos,flags', '-of', 'csv=p=0', video_path
+            ])
+            packets = parse_ffprobe_packets(output.decode())
+        else:
+            output = await self._run_command_async([
+                'ffmpeg', '-v', 'error', '-i', video_path,
+                '-map', '0:v:0', '-c', 'copy', '-f', 'framecrc', 'pipe:1'
+            ])
+            packets = parse_framecrc(output.decode())
+        
+        index = KeyframeIndex.from_packets(packets)
+        logger.info("🗂️ Keyframe index: %s packets, %s keyframes, GOPs up to %s packets",
+                    len(packets), len(index.keyframe_times), int(index.gop_lengths.max()))
+        return index
+    
+    def seek_time(self, timestamp: float, keyframes: Optional[KeyframeIndex]) -> float:
+        """Where to seek for a frame at timestamp: a nearby keyframe when the index has one"""
+        if keyframes is None:
+            return timestamp
+        seek = keyframes.seek_time(timestamp, self.keyframe_snap)
+        if seek != timestamp:
+            logger.info("🎯 Seeking to keyframe at %.3fs instead of %.3fs", seek, timestamp)
+        return seek
+    
+    async def sample_frames(self, video_path: str, duration: float, count: int = 8, size: int = 32) -> bytes:
+        """count size x size grayscale frames, evenly spaced over the video, as raw bytes
+        
+        One ffmpeg run with an input seek per frame, so only a GOP's worth
+        of frames is decoded for each sample rather than the whole video.
+        """
+        cmd = ['ffmpeg', '-v', 'error']
+        for index in range(count):
+            cmd.extend(['-ss', f"{duration * (index + 0.5) / count:.3f}", '-i', video_path])
+        graph = ";".join(
+            f"[{index}:v]trim=end_frame=1,scale={size}:{size}:flags=area,format=gray,setsar=1[f{index}]"
+            for index in range(count)
+        )
+        graph += ";" + "".join(f"[f{index}]" for index in range(count)) + f"concat=n={count}:v=1:a=0[frames]"
+        # Each sample is a single frame, so keep every one rather than retiming to a frame rate
+        cmd.extend(['-filter_complex', graph, '-map', '[frames]', '-fps_mode', 'passthrough',
+                    '-f', 'rawvideo', 'pipe:1'])
+        
+        frames = await self._run_command_async(cmd)
+        if len(frames) != count * size * size:
+            raise ValueError(f"Expected {count} sampled frames, got {len(frames) / (size * size):.1f}")
+        return frames
+    
+    async def probe_source(self, source: str, timeout: float = 5.0) -> Optional[Dict[str, Any]]:
+        """Duration, resolution, fps and codec of a file or URL, from ffmpeg's input banner
+        
+        ffmpeg only reads the container header. URLs may only be fetched
+        over HTTP(S) and local files may only read local files, so a
+        playlist can't make ffmpeg open other protocols or paths. None if
+        the source can't be read.
+        """
+        protocols = "http,https,tls,tcp" if "://" in source else "file"
+        try:
+            with tracer.span("ffmpeg.probe", source=os.path.basename(source)):
+                process = await asyncio.create_subprocess_exec(
+                    'ffmpeg', '-hide_banner', '-protocol_whitelist', protocols, '-i', source,
+                    stdout=asyncio.subprocess.DEVNULL,
+                    stderr=asyncio.subprocess.PIPE
+                )
+                try:
+                    # Exits non-zero without an output file; the banner is all that's needed
+                    _, stderr = await asyncio.wait_for(process.communicate(), timeout)
+                except asyncio.TimeoutError:
+                    process.kill()
+                    await process.wait()
+                    logger.warning("⚠️ Probing %s timed out after %ss", source, timeout)
+                    return None
+        except Exception as e:
+            logger.warning("⚠️ Could not probe %s: %s", source, e)
+            return None
+        
+        info = parse_ffmpeg_log(stderr)
+        if "width" not in info or "duration" not in info:
+            return None
+        return {key: info[key] for key in ("duration", "width", "height", "fps", "codec", "has_audio") if key in info}
+    
+    def plan_commands(
+        self,
+        operation: str,
+        params: Dict[str, Any],
+        source: Optional[Dict[str, Any]] = None,
+        video_path: str = "$SOURCE",
+        work_dir: str = "$WORKSPACE"
+    ) -> List[List[str]]:
+        """Command lines a job would run, without running them
+        
+        Previews list their first attempt per format; smaller re-encodes only
+        happen when a clip misses its byte budget.
+        """
+        def output(prefix: str, extension: str) -> str:
+            return os.path.join(work_dir, f"{prefix}_{os.urandom(8).hex()}.{extension}")
+        
+        if operation == "thumbnail":
+            width, height = params.get("width"), params.get("height")
+            if FFMPEG_PYTHON_AVAILABLE and source:
+                width, height = self._fit_thumbnail(source["width"], source["height"], width, height)
+            lines = [self.command_line(
+                self.thumbnail_command(video_path, output("thumb", "jpg"), params.get("timestamp", 1.0), width, height)
+            )]
+            # The hover preview is encoded from the same download
+            if params.get("preview"):
+                lines += self.plan_commands("preview", params["preview"], source, video_path, work_dir)
+            return lines
+        elif operation == "preview":
+            commands = [
+                self.preview_command(
+                    video_path, output("preview", fmt), fmt,
+                    params.get("start", 0.0), params.get("duration", 3.0), params.get("width", 320),
+                    params.get("fps", 12), PREVIEW_START_QUALITY[fmt], params.get("max_bytes", 300_000)
+                )
+                for fmt in params.get("formats") or ["mp4"]
+            ]
+        elif operation in ("watermark", "resize", "transform"):
+            codec = params.get("codec", "h264")
+            container = self.check_output(codec, params.get("container"))
+            output_path = output({"watermark": "watermarked", "resize": "resized", "transform": "transformed"}[operation], container)
+            fallback = self.fallback_path(output_path) if params.get("h264_fallback") and codec != "h264" else None
+            if operation == "watermark":
+                commands = [self.watermark_command(
+                    video_path,
+                    "$WATERMARK" if params.get("watermark_url") else DEFAULT_WATERMARK_PATH,
+                    output_path,
+                    params.get("position", "bottom-center"),
+                    params.get("opacity", 0.9),
+                    params.get("scale", 0.5),
+                    codec, container, fallback
+                )]
+            elif operation == "transform":
+                plan = TransformPlan(params.get("steps") or [])
+                commands = [self.transform_command(
+                    video_path,
+                    output_path,
+                    plan,
+                    [
+                        f"$WATERMARK{index}" if watermark["watermark_url"] else DEFAULT_WATERMARK_PATH
+                        for index, watermark in enumerate(plan.watermarks)
+                    ],
+                    codec, container, params.get("bitrate"), fallback
+                )]
+            else:
+                # Byte targets list the capped-CRF first attempt
+                targets = []
+                if params.get("target_size_bytes") and source:
+                    video_bitrate, audio_bitrate = self.target_bitrates(
+                        params["target_size_bytes"], source["duration"], source.get("has_audio", True)
+                    )
+                    targets = [{"video_bitrate": video_bitrate, "audio_bitrate": audio_bitrate}] * 2
+                commands = [self.resize_command(
+                    video_path,
+                    output_path,
+                    params.get("width"),
+                    params.get("height"),
+                    None if targets else params.get("bitrate"),
+                    params.get("preserve_aspect_ratio", True),
+                    codec, container, fallback, *targets
+                )]
+        else:
+            raise ValueError(f"Unknown operation: {operation}")
+        return [self.command_line(command) for command in commands]
+    
+    def command_line(self, command) -> List[str]:
+        """argv of a command built by one of the *_command methods"""
+        if isinstance(command, list):
+            return command
+        return ffmpeg.compile(command, overwrite_output=True)
+    
+    async def _run(self, command):
+        """Run a command built by one of the *_command methods"""
+        if isinstance(command, list):
+            return await self._run_command_async(command)
+        return await self._run_ffmpeg_async(command)
+    
     async def _run_ffmpeg_async(self, stream):
         """Run FFmpeg command asynchronously using ffmpeg-python"""
+        ACTIVE_FFMPEG.inc()
         try:
-            loop = asyncio.get_event_loop()
-            await loop.run_in_executor(
-                None,
-                lambda: ffmpeg.run(stream, overwrite_output=True, capture_stdout=True, capture_stderr=True)
-            )
+            with tracer.span("ffmpeg", operation=current_operation.get()) as span:
+                loop = asyncio.get_event_loop()
+                started = time.perf_counter()
+                process = ffmpeg.run_async(stream, overwrite_output=True, pipe_stdout=True, pipe_stderr=True)
+                try:
+                    stdout, stderr = await loop.run_in_executor(None, process.communicate)
+                except asyncio.CancelledError:
+                    # Job cancelled (drain/shutdown): don't leave the encode running
+                    process.kill()
+                    raise
+                if process.returncode != 0:
+                    raise ffmpeg.Error('ffmpeg', stdout, stderr)
+                span.set_attribute("speed", self._record_encode_speed(stderr))
+                await self._observe_cost(stderr, time.perf_counter() - started)
         except Exception as e:
             if hasattr(e, 'stderr'):
                 error_message = e.stderr.decode() if e.stderr else "Unknown FFmpeg error"
-                logger.error(f"FFmpeg error: {error_message}")
+                logger.error("FFmpeg error: %s", error_message)
             raise Exception(f"ffmpeg error (see stderr output for detail)")
+        finally:
+            ACTIVE_FFMPEG.dec()
     
     async def _run_command_async(self, cmd):
         """Run command asynchronously using subprocess"""
+        ACTIVE_FFMPEG.inc()
         try:
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            
-            stdout, stderr = await process.communicate()
-            
-            if process.returncode != 0:
-                logger.error(f"Command failed: {stderr.decode()}")
-                raise Exception(f"FFmpeg command failed: {stderr.decode()}")
-            
+            with tracer.span(os.path.basename(cmd[0]), operation=current_operation.get()) as span:
+                started = time.perf_counter()
+                process = await asyncio.create_subprocess_exec(
+                    *cmd,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE
+                )
+                
+                try:
+                    stdout, stderr = await process.communicate()
+                except asyncio.CancelledError:
+                    process.kill()
+                    await process.wait()
+                    raise
+                span.set_attribute("returncode", process.returncode)
+                
+                if process.returncode != 0:
+                    logger.error("Command failed: %s", stderr.decode())
+                    raise Exception(f"FFmpeg command failed: {stderr.decode()}")
+                
+                span.set_attribute("speed", self._record_encode_speed(stderr))
+                await self._observe_cost(stderr, time.perf_counter() - started)
             return stdout
         except Exception as e:
-            logger.error(f"Command execution failed: {str(e)}")
-            raise
\ No newline at end of file
+            logger.error("Command execution failed: %s", e)
+            raise
+        finally:
+            ACTIVE_FFMPEG.dec()
+    
+    async def _observe_cost(self, stderr: Optional[bytes], elapsed: float):
+        """Feed a finished run to the cost model, off the event loop
+        
+        Analysis-only runs (the null-muxer first pass of a two-pass encode)
+        write no output, so they would skew the rate of the encode they precede.
+        """
+        if ANALYSIS_OUTPUT in (stderr or b""):
+            return
+        await asyncio.to_thread(cost_model.observe, current_operation.get(), stderr, elapsed)
+    
+    def _record_encode_speed(self, stderr: Optional[bytes]) -> Optional[float]:
+        """Record the realtime multiple ffmpeg reported for the finished run"""
+        matches = SPEED_PATTERN.findall(stderr or b"")
+        if matches:
+            try:
+                speed = float(matches[-1])
+            except ValueError:
+                return None
+            ENCODE_SPEED.labels(current_operation.get()).observe(speed)
+            return speed
+        return None
@@ -0,0 +1,172 @@
+import os
+import time
+import logging
+import sqlite3
+import tempfile
+import threading
+from typing import Optional, Dict, Any, List, Tuple
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Frames are sampled as FRAME_SIZE x FRAME_SIZE grayscale; the lowest
+# HASH_SIZE x HASH_SIZE DCT coefficients give a 64-bit hash per frame
+FRAME_SIZE = 32
+HASH_SIZE = 8
+
+def _dct_matrix(n: int) -> np.ndarray:
+    """Orthonormal DCT-II basis, so the 2-D transform is D @ X @ D.T"""
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    basis = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    basis[0] /= np.sqrt(2)
+    return basis.astype(np.float32)
+
+_DCT = _dct_matrix(FRAME_SIZE)
+# Set bits per byte value; np.bitwise_count needs NumPy 2
+_POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+def frame_hashes(frames) -> np.ndarray:
+    """64-bit perceptual hash of each frame: (n, 32, 32) uint8 or raw gray bytes -> (n,) uint64
+
+    A bit is set where a low-frequency DCT coefficient is above the
+    block's median. Re-encoding, rescaling and small brightness changes
+    flip few bits; different content flips about half.
+    """
+    if isinstance(frames, bytes):
+        frames = np.frombuffer(frames, dtype=np.uint8).reshape(-1, FRAME_SIZE, FRAME_SIZE)
+    coefficients = _DCT @ frames.astype(np.float32) @ _DCT.T
+    low = coefficients[:, :HASH_SIZE, :HASH_SIZE].reshape(len(frames), -1)
+    # The DC term only carries mean brightness, so it is left out of the median
+    bits = low > np.median(low[:, 1:], axis=1, keepdims=True)
+    return np.packbits(bits, axis=1).view(">u8").ravel().astype(np.uint64)
+
+def hamming(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Differing bits between uint64 hashes, over the last axis' elements"""
+    differing = np.ascontiguousarray(a ^ b)
+    return _POPCOUNT[differing.view(np.uint8)].reshape(*differing.shape, 8).sum(axis=-1)
+
+class FingerprintIndex:
+    """Perceptual fingerprints of sources, for near-duplicate lookups
+
+    A fingerprint is the hashes of FINGERPRINT_FRAMES frames sampled at the
+    same relative positions of every video, so a re-encoded or rescaled
+    copy lines up frame by frame. Fingerprints live in SQLite, shared by
+    every process, and are mirrored into NumPy arrays that are scanned in
+    one vectorized pass per lookup. get, add and nearest read SQLite, so
+    callers on the event loop run them through asyncio.to_thread; stats
+    only reports what is already in memory.
+    """
+
+    def __init__(self, db_path: Optional[str] = None):
+        self.enabled = os.getenv("FINGERPRINT_ENABLED", "true").lower() != "false"
+        self.db_path = db_path or os.getenv(
+            "FINGERPRINT_INDEX_PATH",
+            os.path.join(tempfile.gettempdir(), "ffmpeg_fingerprints.db")
+        )
+        self.frames = int(os.getenv("FINGERPRINT_FRAMES", "8"))
+        # Mean differing bits per frame hash (of 64) still counted as the same video
+        self.max_distance = float(os.getenv("FINGERPRINT_MAX_DISTANCE", "6"))
+        self.near_hits = 0
+
+        self._sources: List[str] = []
+        self._durations = np.zeros(0, dtype=np.float64)
+        self._hashes = np.zeros((0, self.frames), dtype=np.uint64)
+        self._last_rowid = 0
+        # Lookups run in worker threads; one at a time may extend the arrays
+        self._lock = threading.Lock()
+
+        if self.enabled:
+            with self._connect() as conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS fingerprints ("
+                    "source_hash TEXT PRIMARY KEY, duration REAL NOT NULL, "
+                    "hashes BLOB NOT NULL, created_at REAL)"
+                )
+            logger.info("✅ Fingerprint index at: %s", self.db_path)
+        else:
+            logger.info("Fingerprint index disabled")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=10.0)
+
+    def _load(self):
+        """Append fingerprints added since the last load, by this or any other process"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT rowid, source_hash, duration, hashes FROM fingerprints WHERE rowid > ? ORDER BY rowid",
+                (self._last_rowid,)
+            ).fetchall()
+        if not rows:
+            return
+        self._last_rowid = rows[-1][0]
+        # Fingerprints taken with another FINGERPRINT_FRAMES can't be compared
+        rows = [row for row in rows if len(row[3]) == self.frames * 8]
+        if rows:
+            self._sources.extend(row[1] for row in rows)
+            self._durations = np.concatenate([self._durations, [row[2] for row in rows]])
+            self._hashes = np.concatenate([
+                self._hashes,
+                np.frombuffer(b"".join(row[3] for row in rows), dtype=np.uint64).reshape(len(rows), self.frames)
+            ])
+
+    def get(self, source_hash: str) -> Optional[Tuple[float, np.ndarray]]:
+        """(duration, frame hashes) of an indexed source"""
+        if not self.enabled:
+            return None
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT duration, hashes FROM fingerprints WHERE source_hash = ?", (source_hash,)
+            ).fetchone()
+        if row is None or len(row[1]) != self.frames * 8:
+            return None
+        return row[0], np.frombuffer(row[1], dtype=np.uint64)
+
+    def add(self, source_hash: str, duration: float, hashes: np.ndarray):
+        if not self.enabled:
+            return
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO fingerprints (source_hash, duration, hashes, created_at) VALUES (?, ?, ?, ?)",
+                (source_hash, duration, hashes.astype(np.uint64).tobytes(), time.time())
+            )
+
+    def nearest(self, duration: float, hashes: np.ndarray, exclude: Optional[str] = None,
+                limit: int = 5) -> List[Tuple[str, float]]:
+        """Indexed sources within max_distance, closest first, as (source_hash, mean distance)"""
+        if not self.enabled:
+            return []
+        with self._lock:
+            self._load()
+            sources, durations, indexed = self._sources[:], self._durations, self._hashes
+        if not sources:
+            return []
+        distances = hamming(indexed, hashes[None, :]).mean(axis=1)
+        # Trims and extended cuts aren't duplicates, whatever their frames look like
+        same_length = np.abs(durations - duration) <= max(0.1, duration * 0.02)
+        candidates = np.flatnonzero(same_length & (distances <= self.max_distance))
+        matches = []
+        for index in candidates[np.argsort(distances[candidates], kind="stable")]:
+            if sources[index] != exclude:
+                matches.append((sources[index], round(float(distances[index]), 2)))
+                if len(matches) == limit:
+                    break
+        return matches
+
+    def near_duplicates(self, source_hash: str) -> List[Tuple[str, float]]:
+        """Other sources that look like an indexed source, closest first"""
+        fingerprint = self.get(source_hash)
+        if fingerprint is None:
+            return []
+        return self.nearest(*fingerprint, exclude=source_hash)
+
+    def stats(self) -> Dict[str, Any]:
+        """Counters held in memory; "indexed" is as of this process's last lookup"""
+        return {
+            "enabled": self.enabled,
+            "indexed": len(self._sources),
+            "frames": self.frames,
+            "max_distance": self.max_distance,
+            "near_duplicate_hits": self.near_hits
+        }
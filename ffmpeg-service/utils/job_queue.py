@@ -0,0 +1,350 @@
+import os
+import json
+import time
+import socket
+import asyncio
+import logging
+import sqlite3
+import tempfile
+from typing import Optional, Dict, Any, List, Callable, Awaitable
+
+logger = logging.getLogger(__name__)
+
+JOB_COLUMNS = (
+    "id", "operation", "payload", "status", "attempts", "lease_owner",
+    "lease_expires_at", "created_at", "started_at", "finished_at", "last_error", "cost"
+)
+
+class JobQueue:
+    """Durable job queue on a SQLite file in WAL mode, shared by every process on the host
+
+    Workers claim jobs atomically and hold them under a lease that they
+    renew with heartbeats. A job whose lease runs out (its worker crashed or
+    hung) is claimed again by the next worker, up to JOB_MAX_ATTEMPTS times.
+
+    With JOB_SCHEDULING=sjf (the default) the cheapest job by predicted cost
+    is claimed first. Waiting jobs age: every second in the queue takes
+    JOB_SJF_AGING work-seconds off their cost, so large jobs still start.
+    """
+
+    def __init__(self, db_path: Optional[str] = None):
+        self.db_path = db_path or os.getenv(
+            "JOB_QUEUE_PATH",
+            os.path.join(tempfile.gettempdir(), "ffmpeg_jobs.db")
+        )
+        self.lease_seconds = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+        self.max_attempts = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+        self.retention = float(os.getenv("JOB_QUEUE_RETENTION_HOURS", "24")) * 3600
+        self.scheduling = os.getenv("JOB_SCHEDULING", "sjf").lower()
+        self.sjf_aging = float(os.getenv("JOB_SJF_AGING", "0.5"))
+
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, operation TEXT NOT NULL, payload TEXT NOT NULL, "
+                "status TEXT NOT NULL DEFAULT 'queued', "
+                "attempts INTEGER NOT NULL DEFAULT 0, "
+                "lease_owner TEXT, lease_expires_at REAL, "
+                "created_at REAL NOT NULL, started_at REAL, finished_at REAL, last_error TEXT, "
+                "cost REAL NOT NULL DEFAULT 0)"
+            )
+            try:
+                # Queues created before admission control
+                conn.execute("ALTER TABLE jobs ADD COLUMN cost REAL NOT NULL DEFAULT 0")
+            except sqlite3.OperationalError:
+                pass
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_claimable ON jobs (status, created_at)")
+        logger.info("✅ Job queue at: %s", self.db_path)
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=10.0)
+
+    def enqueue(self, job_id: str, operation: str, payload: Dict[str, Any], cost: float = 0.0):
+        """Persist a job for any worker to claim; cost is its estimated work-seconds"""
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, operation, payload, created_at, cost) VALUES (?, ?, ?, ?, ?)",
+                (job_id, operation, json.dumps(payload), time.time(), cost)
+            )
+
+    def claim(self, worker_id: str, limit: int = 1) -> List[Dict[str, Any]]:
+        """Atomically lease up to `limit` queued or abandoned jobs
+
+        Abandoned jobs that have used all their attempts are marked failed
+        and returned with `exhausted` set, so the caller can report them.
+        """
+        now = time.time()
+        conn = sqlite3.connect(self.db_path, timeout=10.0, isolation_level=None)
+        try:
+            # IMMEDIATE takes the write lock up front, so two workers never claim the same row
+            conn.execute("BEGIN IMMEDIATE")
+            if self.scheduling == "sjf":
+                order, order_args = "cost - (? - created_at) * ?, created_at", (now, self.sjf_aging)
+            else:
+                order, order_args = "created_at", ()
+            rows = conn.execute(
+                f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs "
+                "WHERE status = 'queued' OR (status = 'running' AND lease_expires_at < ?) "
+                f"ORDER BY {order} LIMIT ?",
+                (now, *order_args, limit)
+            ).fetchall()
+            jobs = []
+            for row in rows:
+                job = dict(zip(JOB_COLUMNS, row))
+                if job["status"] == "running" and job["attempts"] >= self.max_attempts:
+                    conn.execute(
+                        "UPDATE jobs SET status = 'failed', finished_at = ?, lease_owner = NULL, last_error = ? "
+                        "WHERE id = ?",
+                        (now, f"Lease expired after {job['attempts']} attempts", job["id"])
+                    )
+                    job["exhausted"] = True
+                else:
+                    if job["status"] == "running":
+                        logger.warning("♻️ Reclaiming job %s from %s", job["id"], job["lease_owner"])
+                    conn.execute(
+                        "UPDATE jobs SET status = 'running', attempts = attempts + 1, lease_owner = ?, "
+                        "lease_expires_at = ?, started_at = ? WHERE id = ?",
+                        (worker_id, now + self.lease_seconds, now, job["id"])
+                    )
+                    job["attempts"] += 1
+                    job["exhausted"] = False
+                job["payload"] = json.loads(job["payload"])
+                jobs.append(job)
+            conn.execute("COMMIT")
+            return jobs
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def heartbeat(self, job_id: str, worker_id: str) -> bool:
+        """Extend a job's lease; False if this worker no longer holds it"""
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET lease_expires_at = ? WHERE id = ? AND lease_owner = ? AND status = 'running'",
+                (time.time() + self.lease_seconds, job_id, worker_id)
+            )
+            return cursor.rowcount == 1
+
+    def complete(self, job_id: str, worker_id: str, error: Optional[str] = None):
+        """Mark a leased job done (or failed when an error is given)"""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, finished_at = ?, lease_owner = NULL, last_error = ? "
+                "WHERE id = ? AND lease_owner = ?",
+                ("failed" if error else "done", time.time(), error, job_id, worker_id)
+            )
+
+    def set_cost(self, job_id: str, cost: float):
+        """Replace a job's estimated cost, e.g. once its source has been probed"""
+        with self._connect() as conn:
+            conn.execute("UPDATE jobs SET cost = ? WHERE id = ?", (cost, job_id))
+
+    def release(self, job_id: str, worker_id: str, reason: str) -> bool:
+        """Put a leased job back in the queue without counting the attempt"""
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = 'queued', attempts = MAX(attempts - 1, 0), lease_owner = NULL, "
+                "lease_expires_at = NULL, last_error = ? WHERE id = ? AND lease_owner = ? AND status = 'running'",
+                (reason, job_id, worker_id)
+            )
+            return cursor.rowcount == 1
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._connect() as conn:
+            row = conn.execute(
+                f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(JOB_COLUMNS, row))
+        job["payload"] = json.loads(job["payload"])
+        return job
+
+    def purge(self):
+        """Drop finished jobs older than the retention period"""
+        with self._connect() as conn:
+            conn.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ?",
+                (time.time() - self.retention,)
+            )
+
+    def backlog(self) -> float:
+        """Estimated work-seconds left: full cost of queued jobs, unelapsed cost of running ones"""
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT COALESCE(SUM(CASE WHEN status = 'queued' THEN cost "
+                "ELSE MAX(cost - (? - started_at), 0) END), 0) "
+                "FROM jobs WHERE status IN ('queued', 'running')",
+                (time.time(),)
+            ).fetchone()[0]
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.time()
+        with self._connect() as conn:
+            counts = dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+            oldest = conn.execute("SELECT MIN(created_at) FROM jobs WHERE status = 'queued'").fetchone()[0]
+            expired = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'running' AND lease_expires_at < ?", (now,)
+            ).fetchone()[0]
+        return {
+            "queued": counts.get("queued", 0),
+            "running": counts.get("running", 0),
+            "done": counts.get("done", 0),
+            "failed": counts.get("failed", 0),
+            "expired_leases": expired,
+            "oldest_queued_age_seconds": round(now - oldest, 3) if oldest else 0.0
+        }
+
+class JobRunner:
+    """Claims jobs from the queue and runs them, renewing their leases while they run
+
+    Every process that should do work (each uvicorn worker, or worker.py)
+    runs one of these against the shared queue file. Queue calls run in a
+    worker thread so a locked database never stalls the event loop.
+    """
+
+    def __init__(
+        self,
+        queue: JobQueue,
+        handler: Callable[[str, str, Dict[str, Any]], Awaitable[None]],
+        on_exhausted: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None
+    ):
+        self.queue = queue
+        self.handler = handler
+        self.on_exhausted = on_exhausted
+        self.concurrency = int(os.getenv("JOB_WORKER_CONCURRENCY", "4"))
+        self.poll_interval = float(os.getenv("JOB_QUEUE_POLL_SECONDS", "0.5"))
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{os.urandom(3).hex()}"
+
+        self.draining = False
+        self._requeue_on_cancel = False
+        self._running: Dict[str, asyncio.Task] = {}
+        self._tasks: set = set()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._loop_task: Optional[asyncio.Task] = None
+
+    def notify(self):
+        """Claim right away instead of waiting for the next poll (same-process enqueues)"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def start(self):
+        if self._loop_task is None:
+            self._wakeup = asyncio.Event()
+            self._loop_task = asyncio.create_task(self._run())
+            logger.info("🏭 Job worker %s started (concurrency %s)", self.worker_id, self.concurrency)
+            temp_dir = os.path.realpath(tempfile.gettempdir())
+            if os.path.realpath(self.queue.db_path).startswith(temp_dir + os.sep):
+                logger.warning(
+                    "⚠️ Job queue is in the temp dir (%s); jobs requeued on drain are lost if it doesn't "
+                    "survive a redeploy. Set JOB_QUEUE_PATH to a persistent volume", self.queue.db_path
+                )
+
+    async def stop(self, grace: float = 0.0) -> Dict[str, int]:
+        """Drain: stop claiming, give running jobs `grace` seconds, then requeue the rest
+
+        Requeued jobs go back to the shared queue for the next worker or
+        instance; their workspaces are removed as the cancelled jobs unwind.
+        """
+        self.draining = True
+        if self._loop_task is not None:
+            self._loop_task.cancel()
+            try:
+                await self._loop_task
+            except asyncio.CancelledError:
+                pass
+            self._loop_task = None
+
+        finished, unfinished = set(), set(self._running.values())
+        if unfinished and grace > 0:
+            logger.info("🚰 Waiting up to %ss for %s running job(s)", grace, len(unfinished))
+            finished, unfinished = await asyncio.wait(unfinished, timeout=grace)
+        self._requeue_on_cancel = True
+        for task in unfinished:
+            task.cancel()
+        if unfinished:
+            await asyncio.wait(unfinished)
+        logger.info(
+            "🏭 Job worker %s stopped (%s finished, %s requeued)",
+            self.worker_id, len(finished), len(unfinished)
+        )
+        return {"finished": len(finished), "requeued": len(unfinished)}
+
+    async def _run(self):
+        last_purge = 0.0
+        while True:
+            try:
+                free = self.concurrency - len(self._running)
+                if free > 0 and not self.draining:
+                    for job in await asyncio.to_thread(self.queue.claim, self.worker_id, free):
+                        if job["exhausted"]:
+                            logger.error("❌ Job %s abandoned after %s attempts", job["id"], job["attempts"])
+                            if self.on_exhausted:
+                                task = asyncio.create_task(self.on_exhausted(job))
+                                self._tasks.add(task)
+                                task.add_done_callback(self._tasks.discard)
+                        else:
+                            self._start_job(job)
+                if time.time() - last_purge > 3600:
+                    await asyncio.to_thread(self.queue.purge)
+                    last_purge = time.time()
+            except Exception as e:
+                logger.error("❌ Job claim failed: %s", e)
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def _start_job(self, job: Dict[str, Any]):
+        task = asyncio.create_task(self._run_job(job))
+        self._running[job["id"]] = task
+
+        def finished(_):
+            self._running.pop(job["id"], None)
+            self.notify()
+
+        task.add_done_callback(finished)
+
+    async def _run_job(self, job: Dict[str, Any]):
+        job_task = asyncio.current_task()
+        heartbeat = asyncio.create_task(self._heartbeat(job["id"], job_task))
+        error = None
+        try:
+            await self.handler(job["id"], job["operation"], job["payload"])
+        except asyncio.CancelledError:
+            # Draining: hand the job to the next worker. Lease lost: the new holder owns the row
+            if self._requeue_on_cancel:
+                await asyncio.to_thread(self.queue.release, job["id"], self.worker_id, "Requeued while draining")
+            raise
+        except Exception as e:
+            error = str(e)
+            logger.error("❌ Job %s raised: %s", job["id"], e)
+        finally:
+            heartbeat.cancel()
+        await asyncio.to_thread(self.queue.complete, job["id"], self.worker_id, error)
+
+    async def _heartbeat(self, job_id: str, job_task: asyncio.Task):
+        while True:
+            await asyncio.sleep(self.queue.lease_seconds / 3)
+            try:
+                if not await asyncio.to_thread(self.queue.heartbeat, job_id, self.worker_id):
+                    logger.warning("⚠️ Lost lease on job %s, cancelling it", job_id)
+                    job_task.cancel()
+                    return
+            except Exception as e:
+                logger.warning("⚠️ Heartbeat for job %s failed: %s", job_id, e)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "worker_id": self.worker_id,
+            "running": len(self._running),
+            "concurrency": self.concurrency,
+            "draining": self.draining,
+            "worker_running": self._loop_task is not None
+        }
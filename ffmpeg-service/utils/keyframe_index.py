@@ -0,0 +1,224 @@
+import io
+import os
+import time
+import logging
+import sqlite3
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Optional, Dict, Any
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Packets of the first video stream, in decode order
+PACKET_DTYPE = np.dtype([("time", np.float64), ("size", np.int32), ("pos", np.int64), ("key", np.bool_)])
+
+def parse_ffprobe_packets(text: str) -> np.ndarray:
+    """Packets from `ffprobe -show_entries packet=pts_time,size,pos,flags -of csv=p=0`
+
+    Rows are "pts_time,size,pos,flags"; ffprobe writes N/A for unknown
+    timestamps and positions.
+    """
+    rows = [line.split(",") for line in text.splitlines() if line]
+    packets = np.zeros(len(rows), dtype=PACKET_DTYPE)
+    if not rows:
+        return packets
+    columns = list(zip(*rows))
+    packets["time"] = np.array([np.nan if value == "N/A" else value for value in columns[0]], dtype=np.float64)
+    packets["size"] = np.array(columns[1], dtype=np.int32)
+    packets["pos"] = np.array([-1 if value == "N/A" else value for value in columns[2]], dtype=np.int64)
+    packets["key"] = np.char.startswith(np.array(columns[3]), "K")
+    return packets
+
+def parse_framecrc(text: str) -> np.ndarray:
+    """Packets from ffmpeg's framecrc muxer (`-map 0:v:0 -c copy -f framecrc -`)
+
+    Used when ffprobe isn't installed. Rows are "stream, dts, pts, duration,
+    size, crc[, F=flags]" in the "#tb" time base; flags are only written when
+    they aren't just the keyframe flag. framecrc has no byte positions.
+    """
+    time_base = 1.0
+    rows = []
+    for line in text.splitlines():
+        if line.startswith("#tb 0:"):
+            numerator, _, denominator = line.split(":", 1)[1].strip().partition("/")
+            time_base = int(numerator) / int(denominator)
+        elif line and not line.startswith("#"):
+            rows.append(line.split(","))
+    packets = np.zeros(len(rows), dtype=PACKET_DTYPE)
+    if not rows:
+        return packets
+    packets["time"] = np.array([row[2] for row in rows], dtype=np.int64) * time_base
+    packets["size"] = np.array([row[4] for row in rows], dtype=np.int32)
+    packets["pos"] = -1
+    packets["key"] = [len(row) < 7 or int(row[6].strip()[2:], 16) & 1 for row in rows]
+    return packets
+
+class KeyframeIndex:
+    """Keyframe times and byte offsets, GOP lengths and bitrate profile of a video stream
+
+    Times are seconds from the first presented frame, which is what ffmpeg's
+    -ss counts from. Offsets are -1 where the container doesn't report them.
+    """
+
+    def __init__(self, keyframe_times: np.ndarray, keyframe_offsets: np.ndarray,
+                 gop_lengths: np.ndarray, bitrate: np.ndarray, duration: float):
+        self.keyframe_times = keyframe_times
+        self.keyframe_offsets = keyframe_offsets
+        self.gop_lengths = gop_lengths
+        self.bitrate = bitrate
+        self.duration = duration
+
+    @classmethod
+    def from_packets(cls, packets: np.ndarray) -> "KeyframeIndex":
+        packets = packets[~np.isnan(packets["time"])]
+        if not len(packets) or not packets["key"].any():
+            raise ValueError("No keyframes in the video stream")
+        times = packets["time"] - packets["time"].min()
+        # Packets are in decode order, so each GOP runs from one keyframe packet to the next
+        keyframes = np.flatnonzero(packets["key"])
+        gop_lengths = np.diff(np.append(keyframes, len(packets))).astype(np.int32)
+        order = np.argsort(times[keyframes], kind="stable")
+
+        # One frame's duration past the last timestamp is the end of the stream
+        frame_duration = float(np.median(np.diff(np.sort(times)))) if len(times) > 1 else 0.0
+        duration = float(times.max()) + frame_duration
+        bitrate = np.bincount(
+            times.astype(np.int64), weights=packets["size"] * 8.0, minlength=int(np.ceil(duration))
+        ).astype(np.float32)
+        # The last, partial second is scaled up to a per-second rate
+        if duration % 1:
+            bitrate[-1] /= duration % 1
+        return cls(times[keyframes][order], packets["pos"][keyframes][order], gop_lengths[order], bitrate, duration)
+
+    def seek_time(self, timestamp: float, snap: float) -> float:
+        """Time to seek to for a frame near timestamp
+
+        A keyframe within snap seconds is used as is, so only that frame is
+        decoded rather than the GOP up to timestamp. Times past the last
+        keyframe's GOP are pulled back to it, where there is a frame to show.
+        """
+        if timestamp >= self.duration:
+            return float(self.keyframe_times[-1])
+        index = np.searchsorted(self.keyframe_times, timestamp)
+        nearest = self.keyframe_times[max(index - 1, 0):index + 1]
+        closest = float(nearest[np.argmin(np.abs(nearest - timestamp))])
+        return closest if abs(closest - timestamp) <= snap else timestamp
+
+    def to_bytes(self) -> bytes:
+        buffer = io.BytesIO()
+        np.savez(
+            buffer,
+            keyframe_times=self.keyframe_times,
+            keyframe_offsets=self.keyframe_offsets,
+            gop_lengths=self.gop_lengths,
+            bitrate=self.bitrate,
+            duration=np.float64(self.duration)
+        )
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "KeyframeIndex":
+        with np.load(io.BytesIO(data), allow_pickle=False) as arrays:
+            return cls(
+                arrays["keyframe_times"],
+                arrays["keyframe_offsets"],
+                arrays["gop_lengths"],
+                arrays["bitrate"],
+                float(arrays["duration"])
+            )
+
+    def summary(self) -> Dict[str, Any]:
+        """JSON-friendly view of the index"""
+        gop_seconds = np.diff(np.append(self.keyframe_times, self.duration))
+        return {
+            "duration": round(self.duration, 3),
+            "keyframes": len(self.keyframe_times),
+            "keyframe_times": np.round(self.keyframe_times, 3).tolist(),
+            "keyframe_offsets": self.keyframe_offsets.tolist(),
+            "gop_lengths": self.gop_lengths.tolist(),
+            "max_gop_seconds": round(float(gop_seconds.max()), 3),
+            "mean_gop_seconds": round(float(gop_seconds.mean()), 3),
+            "bitrate_profile": np.round(self.bitrate).astype(np.int64).tolist(),
+            "peak_bitrate": int(self.bitrate.max()) if len(self.bitrate) else 0
+        }
+
+class KeyframeIndexCache:
+    """Keyframe indexes per source content hash, in SQLite and an in-process LRU
+
+    A source's index is read once from its packets, then shared by every
+    job and process that seeks in the same content. get and put block on
+    SQLite, so callers on the event loop run them through asyncio.to_thread.
+    """
+
+    def __init__(self, db_path: Optional[str] = None):
+        self.enabled = os.getenv("KEYFRAME_INDEX_ENABLED", "true").lower() != "false"
+        self.db_path = db_path or os.getenv(
+            "KEYFRAME_INDEX_PATH",
+            os.path.join(tempfile.gettempdir(), "ffmpeg_keyframes.db")
+        )
+        self.memory_entries = int(os.getenv("KEYFRAME_INDEX_MEMORY_ENTRIES", "64"))
+        self._memory: "OrderedDict[str, KeyframeIndex]" = OrderedDict()
+        # get/put run on worker threads
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        if self.enabled:
+            with self._connect() as conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS keyframe_indexes ("
+                    "source_hash TEXT PRIMARY KEY, data BLOB NOT NULL, created_at REAL)"
+                )
+            logger.info("✅ Keyframe index cache at: %s", self.db_path)
+        else:
+            logger.info("Keyframe index cache disabled")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=10.0)
+
+    def _remember(self, source_hash: str, index: KeyframeIndex):
+        with self._lock:
+            self._memory[source_hash] = index
+            self._memory.move_to_end(source_hash)
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+
+    def get(self, source_hash: str) -> Optional[KeyframeIndex]:
+        if not self.enabled:
+            return None
+        index = self._memory.get(source_hash)
+        if index is None:
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT data FROM keyframe_indexes WHERE source_hash = ?", (source_hash,)
+                ).fetchone()
+            if row is None:
+                with self._lock:
+                    self.misses += 1
+                return None
+            index = KeyframeIndex.from_bytes(row[0])
+        self._remember(source_hash, index)
+        with self._lock:
+            self.hits += 1
+        return index
+
+    def put(self, source_hash: str, index: KeyframeIndex):
+        if not self.enabled:
+            return
+        self._remember(source_hash, index)
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO keyframe_indexes (source_hash, data, created_at) VALUES (?, ?, ?)",
+                (source_hash, index.to_bytes(), time.time())
+            )
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "in_memory": len(self._memory),
+            "hits": self.hits,
+            "misses": self.misses
+        }
@@ -0,0 +1,87 @@
+import os
+import sys
+import json
+import queue
+import random
+import logging
+import logging.handlers
+from datetime import datetime, timezone
+from typing import Optional
+
+from utils.tracing import tracer
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Attributes every LogRecord has; anything else came from `extra=`
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "taskName"}
+
+_verbose_sample_rate = float(os.getenv("LOG_VERBOSE_SAMPLE_RATE", "0.01"))
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, with `extra=` fields and the current trace ids"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage()
+        }
+        trace_id = getattr(record, "trace_id", None)
+        if trace_id:
+            entry["trace_id"] = trace_id
+            entry["span_id"] = record.span_id
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and key not in entry and key != "span_id":
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that leaves formatting to the listener thread
+
+    The stock handler formats the message before enqueueing, which keeps the
+    formatting cost on the event loop. Records only carry the trace ids of the
+    span they were logged in; args are formatted later, so callers must not
+    mutate them after logging.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        span = tracer.current_span()
+        if span is not None:
+            record.trace_id = span.trace_id
+            record.span_id = span.span_id
+        return record
+
+def configure_logging() -> Optional[logging.handlers.QueueListener]:
+    """Set up root logging from LOG_FORMAT/LOG_LEVEL/LOG_QUEUE; returns the queue listener to stop"""
+    log_format = os.getenv("LOG_FORMAT", "text").lower()
+    level = getattr(logging, os.getenv("LOG_LEVEL", "INFO").upper(), logging.INFO)
+
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JsonFormatter() if log_format == "json" else logging.Formatter(TEXT_FORMAT))
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+
+    if os.getenv("LOG_QUEUE", "true").lower() == "false":
+        root.addHandler(handler)
+        return None
+
+    # Writes happen on a listener thread; the event loop only enqueues records
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    root.addHandler(DeferredQueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+def verbose_enabled(logger: logging.Logger) -> bool:
+    """Whether to log a verbose debug dump (headers, bodies, payloads) this time
+
+    Needs DEBUG enabled for the logger, and then only a sample of calls
+    (LOG_VERBOSE_SAMPLE_RATE) pay for building the dump.
+    """
+    return logger.isEnabledFor(logging.DEBUG) and random.random() < _verbose_sample_rate
@@ -0,0 +1,266 @@
+import math
+import threading
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# Operation (job type) of the stage currently running, set by StageGraph
+current_operation: ContextVar[str] = ContextVar("current_operation", default="none")
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+SPEED_BUCKETS = (0.25, 0.5, 1, 2, 4, 8, 16, 32, 64)
+RATIO_BUCKETS = (0.25, 0.5, 0.67, 0.8, 0.9, 1.1, 1.25, 1.5, 2, 4)
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+class _Metric:
+    """Base for metrics with a fixed set of label names"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children: Dict[Tuple[str, ...], object] = {}
+
+    def labels(self, *values: str):
+        """Child metric for one combination of label values (cached)"""
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _label_text(self, values: Tuple[str, ...], extra: Optional[Tuple[str, str]] = None) -> str:
+        pairs = list(zip(self.labelnames, values))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in sorted(self._children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+    def _render_child(self, values, child) -> List[str]:
+        return [f"{self.name}{self._label_text(values)} {_format_value(child.value)}"]
+
+class _Value:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self, lock: threading.Lock):
+        self.value = 0.0
+        self._lock = lock
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+class Counter(_Metric):
+    """Monotonically increasing count"""
+
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value(self._lock)
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+class Gauge(_Metric):
+    """Value that goes up and down, or is read from a callback at scrape time"""
+
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Iterable[str] = (),
+        function: Optional[Callable[[], float]] = None
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def _new_child(self):
+        return _Value(self._lock)
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def dec(self, amount: float = 1):
+        self.labels().dec(amount)
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+    def set_function(self, function: Callable[[], float]):
+        self.function = function
+
+    def render(self) -> List[str]:
+        if self.function is not None:
+            self.labels().set(self.function())
+        return super().render()
+
+class _HistogramValue:
+    __slots__ = ("bounds", "counts", "sum", "_lock")
+
+    def __init__(self, bounds: Tuple[float, ...], lock: threading.Lock):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self._lock = lock
+
+    def observe(self, value: float):
+        index = bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+class Histogram(_Metric):
+    """Bucketed distribution; observing is a bisect and two additions"""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Iterable[str] = (),
+        buckets: Iterable[float] = LATENCY_BUCKETS
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets, self._lock)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def _render_child(self, values, child) -> List[str]:
+        with self._lock:
+            counts = list(child.counts)
+            total = child.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), counts):
+            cumulative += count
+            le = ("le", _format_value(bound))
+            lines.append(f"{self.name}_bucket{self._label_text(values, le)} {cumulative}")
+        lines.append(f"{self.name}_sum{self._label_text(values)} {_format_value(total)}")
+        lines.append(f"{self.name}_count{self._label_text(values)} {cumulative}")
+        return lines
+
+class MetricsRegistry:
+    """Collection of metrics rendered in the Prometheus text exposition format"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "ffmpeg_stage_duration_seconds",
+    "Wall time of each job stage",
+    ["operation", "stage"]
+))
+STAGE_ERRORS = REGISTRY.register(Counter(
+    "ffmpeg_stage_errors_total",
+    "Job stages that raised an error",
+    ["operation", "stage"]
+))
+TRANSFER_BYTES = REGISTRY.register(Counter(
+    "ffmpeg_transfer_bytes_total",
+    "Bytes downloaded (in) and uploaded (out)",
+    ["operation", "direction"]
+))
+ENCODE_SPEED = REGISTRY.register(Histogram(
+    "ffmpeg_encode_speed_ratio",
+    "ffmpeg encode speed as a multiple of realtime",
+    ["operation"],
+    buckets=SPEED_BUCKETS
+))
+ACTIVE_FFMPEG = REGISTRY.register(Gauge(
+    "ffmpeg_active_processes",
+    "ffmpeg processes currently running"
+))
+JOBS_IN_FLIGHT = REGISTRY.register(Gauge(
+    "ffmpeg_jobs_in_flight",
+    "Distinct jobs currently running"
+))
+JOBS_WAITING = REGISTRY.register(Gauge(
+    "ffmpeg_jobs_waiting",
+    "Jobs waiting for workspace disk budget"
+))
+JOBS_QUEUED = REGISTRY.register(Gauge(
+    "ffmpeg_jobs_queued",
+    "Jobs in the shared queue waiting for a worker"
+))
+BACKLOG_SECONDS = REGISTRY.register(Gauge(
+    "ffmpeg_backlog_seconds",
+    "Estimated work-seconds of queued and running jobs"
+))
+COST_MODEL_ERROR = REGISTRY.register(Histogram(
+    "ffmpeg_cost_model_error_ratio",
+    "Measured over predicted ffmpeg run time",
+    ["operation"],
+    buckets=RATIO_BUCKETS
+))
+ADMISSION_REJECTED = REGISTRY.register(Counter(
+    "ffmpeg_admission_rejected_total",
+    "Jobs turned away with 429 because the backlog was over capacity",
+    ["operation"]
+))
+NEAR_DUPLICATE_HITS = REGISTRY.register(Counter(
+    "ffmpeg_near_duplicate_hits_total",
+    "Jobs answered with artifacts of a perceptually identical source",
+    ["operation"]
+))
+WEBHOOK_OUTBOX_PENDING = REGISTRY.register(Gauge(
+    "ffmpeg_webhook_outbox_pending",
+    "Webhooks queued for delivery"
+))
+WEBHOOK_SECONDS = REGISTRY.register(Histogram(
+    "ffmpeg_webhook_delivery_seconds",
+    "Duration of webhook POSTs",
+    ["outcome"]
+))
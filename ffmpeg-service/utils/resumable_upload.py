@@ -0,0 +1,194 @@
+import os
+import base64
+import asyncio
+import logging
+import httpx
+from typing import Optional, Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+TUS_VERSION = "1.0.0"
+
+# Supabase requires 6MB chunks for every chunk except the last one
+DEFAULT_CHUNK_SIZE = 6 * 1024 * 1024
+
+class ResumableUploadError(Exception):
+    """Upload could not be completed after retrying"""
+
+class ResumableUploader:
+    """Chunked TUS uploads that resume from the server's offset after transient errors
+
+    When the server advertises the TUS concatenation extension the file is
+    split into parts uploaded in parallel and joined with a final request.
+    Otherwise chunks are sent sequentially. Either way a retry first asks the
+    server for its current offset (HEAD) and only resends the missing bytes.
+    """
+
+    def __init__(
+        self,
+        endpoint: str,
+        headers: Optional[Dict[str, str]] = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        parallel_parts: int = 4,
+        max_retries: int = 5,
+        timeout: float = 60.0
+    ):
+        self.endpoint = endpoint
+        self.headers = {**(headers or {}), "Tus-Resumable": TUS_VERSION}
+        self.chunk_size = chunk_size
+        self.parallel_parts = max(1, parallel_parts)
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.bytes_sent = 0
+
+    async def upload(self, file_path: str, metadata: Dict[str, str]) -> str:
+        """Upload a file and return the TUS upload URL"""
+        file_size = os.path.getsize(file_path)
+        self.bytes_sent = 0
+
+        async with httpx.AsyncClient(timeout=self.timeout) as client:
+            extensions = await self._server_extensions(client)
+            parts = self._plan_parts(file_size)
+
+            if len(parts) > 1 and "concatenation" in extensions:
+                logger.info("📤 Resumable upload: %s bytes in %s parallel parts", file_size, len(parts))
+                part_urls = await asyncio.gather(*(
+                    self._upload_part(client, file_path, start, end, metadata)
+                    for start, end in parts
+                ))
+                location = await self._create(
+                    client,
+                    metadata=metadata,
+                    concat="final;" + " ".join(part_urls)
+                )
+            else:
+                logger.info("📤 Resumable upload: %s bytes in %s-byte chunks", file_size, self.chunk_size)
+                location = await self._create(client, length=file_size, metadata=metadata)
+                await self._send_range(client, location, file_path, 0, file_size)
+
+        logger.info("✅ Resumable upload complete: %s bytes sent for %s byte file", self.bytes_sent, file_size)
+        return location
+
+    def _plan_parts(self, file_size: int) -> List[Tuple[int, int]]:
+        """Split the file into chunk-aligned ranges, one per parallel part"""
+        chunks = max(1, -(-file_size // self.chunk_size))
+        chunks_per_part = max(1, -(-chunks // self.parallel_parts))
+        part_size = chunks_per_part * self.chunk_size
+        return [
+            (start, min(start + part_size, file_size))
+            for start in range(0, file_size, part_size)
+        ] or [(0, 0)]
+
+    async def _server_extensions(self, client: httpx.AsyncClient) -> set:
+        try:
+            response = await client.options(self.endpoint, headers=self.headers)
+            return {
+                ext.strip() for ext in response.headers.get("Tus-Extension", "").split(",") if ext.strip()
+            }
+        except httpx.HTTPError as e:
+            logger.warning("⚠️ TUS OPTIONS failed, assuming no extensions: %s", e)
+            return set()
+
+    async def _upload_part(
+        self,
+        client: httpx.AsyncClient,
+        file_path: str,
+        start: int,
+        end: int,
+        metadata: Dict[str, str]
+    ) -> str:
+        location = await self._create(client, length=end - start, metadata=metadata, concat="partial")
+        await self._send_range(client, location, file_path, start, end)
+        return location
+
+    async def _create(
+        self,
+        client: httpx.AsyncClient,
+        metadata: Dict[str, str],
+        length: Optional[int] = None,
+        concat: Optional[str] = None
+    ) -> str:
+        headers = {**self.headers, "Upload-Metadata": self._encode_metadata(metadata)}
+        if length is not None:
+            headers["Upload-Length"] = str(length)
+        if concat:
+            headers["Upload-Concat"] = concat
+
+        response = await self._with_retries(lambda: client.post(self.endpoint, headers=headers))
+        if response.status_code not in [200, 201]:
+            raise ResumableUploadError(f"Upload creation failed: {response.status_code} - {response.text}")
+
+        return str(httpx.URL(self.endpoint).join(response.headers["Location"]))
+
+    async def _send_range(
+        self,
+        client: httpx.AsyncClient,
+        location: str,
+        file_path: str,
+        start: int,
+        end: int
+    ):
+        """PATCH bytes [start, end) to an upload, resuming from the server offset on errors"""
+        offset = 0
+        length = end - start
+        failures = 0
+
+        with open(file_path, 'rb') as f:
+            while offset < length:
+                f.seek(start + offset)
+                chunk = f.read(min(self.chunk_size, length - offset))
+                headers = {
+                    **self.headers,
+                    "Upload-Offset": str(offset),
+                    "Content-Type": "application/offset+octet-stream"
+                }
+
+                try:
+                    response = await client.patch(location, content=chunk, headers=headers)
+                    if response.status_code == 204:
+                        self.bytes_sent += len(chunk)
+                        offset = int(response.headers.get("Upload-Offset", offset + len(chunk)))
+                        failures = 0
+                        continue
+                    if response.status_code < 500 and response.status_code not in [409, 423, 429]:
+                        raise ResumableUploadError(f"Chunk rejected: {response.status_code} - {response.text}")
+                    error = f"HTTP {response.status_code}"
+                except httpx.TransportError as e:
+                    error = str(e) or type(e).__name__
+
+                failures += 1
+                if failures > self.max_retries:
+                    raise ResumableUploadError(f"Upload stalled at offset {offset}: {error}")
+
+                delay = min(30.0, 0.5 * (2 ** (failures - 1)))
+                logger.warning("⚠️ Chunk at offset %s failed (%s), resuming in %.1fs", offset, error, delay)
+                await asyncio.sleep(delay)
+                offset = await self._server_offset(client, location, offset)
+
+    async def _server_offset(self, client: httpx.AsyncClient, location: str, fallback: int) -> int:
+        """Ask the server how many bytes it already has"""
+        try:
+            response = await client.head(location, headers=self.headers)
+            if response.status_code in [200, 204]:
+                return int(response.headers["Upload-Offset"])
+        except (httpx.HTTPError, KeyError, ValueError) as e:
+            logger.warning("⚠️ Could not read upload offset: %s", e)
+        return fallback
+
+    async def _with_retries(self, request):
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = await request()
+                if response.status_code < 500 or attempt == self.max_retries:
+                    return response
+            except httpx.TransportError:
+                if attempt == self.max_retries:
+                    raise
+            await asyncio.sleep(min(30.0, 0.5 * (2 ** attempt)))
+
+    @staticmethod
+    def _encode_metadata(metadata: Dict[str, str]) -> str:
+        return ",".join(
+            f"{key} {base64.b64encode(str(value).encode('utf-8')).decode('ascii')}"
+            for key, value in metadata.items()
+        )
@@ -0,0 +1,63 @@
+import json
+import asyncio
+import hashlib
+import logging
+from typing import Any, Awaitable, Callable, Dict
+from utils.tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+class SingleFlight:
+    """Coalesces identical in-flight jobs so duplicates share one result"""
+
+    def __init__(self):
+        self._in_flight: Dict[str, asyncio.Future] = {}
+        self.coalesced_count = 0
+
+    @staticmethod
+    def make_key(video_url: str, operation: str, params: Dict[str, Any]) -> str:
+        """Canonical hash of (video_url, operation, normalized params)"""
+        canonical = json.dumps(
+            {
+                "video_url": video_url.strip(),
+                "operation": operation,
+                "params": params
+            },
+            sort_keys=True,
+            separators=(',', ':'),
+            default=str
+        )
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def in_flight(self) -> int:
+        """Number of distinct jobs currently running"""
+        return len(self._in_flight)
+
+    async def run(self, key: str, job: Callable[[], Awaitable[Any]]) -> Any:
+        """Run job once per key; concurrent callers with the same key attach to it"""
+        existing = self._in_flight.get(key)
+        if existing is not None:
+            self.coalesced_count += 1
+            logger.info("🔗 Attaching to in-flight job %s", key[:12])
+            # Shield so a cancelled follower cannot cancel the shared job;
+            # the work itself is traced under the leader's processing_id
+            with tracer.span("singleflight.attach", key=key[:12]):
+                return await asyncio.shield(existing)
+
+        future = asyncio.get_running_loop().create_future()
+        # Mark the exception as retrieved when nobody else attached
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._in_flight[key] = future
+
+        try:
+            result = await job()
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            self._in_flight.pop(key, None)
@@ -0,0 +1,165 @@
+import time
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional
+from utils.metrics import STAGE_SECONDS, STAGE_ERRORS, current_operation
+from utils.tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+class StageGraphError(Exception):
+    """The graph is invalid (missing inputs, duplicate outputs or a cycle)"""
+
+class StageGraphExit(Exception):
+    """Raised by a stage to stop the graph early; not counted as a stage error"""
+
+    traced_as_error = False
+
+class Stage:
+    """One step of a job: named inputs in, named outputs out"""
+
+    def __init__(
+        self,
+        name: str,
+        fn: Callable[..., Awaitable[Any]],
+        inputs: Iterable[str] = (),
+        outputs: Iterable[str] = ()
+    ):
+        self.name = name
+        self.fn = fn
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+
+    async def execute(self, context: Dict[str, Any]) -> Dict[str, Any]:
+        """Call the stage with its inputs and map its return value onto its outputs"""
+        value = await self.fn(**{name: context[name] for name in self.inputs})
+        if not self.outputs:
+            return {}
+        if len(self.outputs) == 1:
+            return {self.outputs[0]: value}
+        if not isinstance(value, dict) or set(value) != set(self.outputs):
+            raise StageGraphError(f"Stage '{self.name}' must return a dict with keys {self.outputs}")
+        return value
+
+class StageGraph:
+    """Declarative job stages that run as soon as their inputs are available
+
+    Only the stages needed to produce the targets are run, and stages whose
+    outputs are already in the initial context are skipped. Independent stages
+    run concurrently. Per-stage wall time is recorded in `timings` and in the
+    stage duration histogram, labeled with the graph name as the operation.
+    Each stage also runs in its own tracing span.
+    """
+
+    def __init__(self, name: str, targets: Iterable[str]):
+        self.name = name
+        self.targets = list(targets)
+        self.stages: List[Stage] = []
+        self.context: Dict[str, Any] = {}
+        self.timings: Dict[str, float] = {}
+
+    def add(
+        self,
+        name: str,
+        fn: Callable[..., Awaitable[Any]],
+        inputs: Iterable[str] = (),
+        outputs: Iterable[str] = ()
+    ) -> "StageGraph":
+        self.stages.append(Stage(name, fn, inputs, outputs))
+        return self
+
+    def plan(self, available: Iterable[str]) -> List[Stage]:
+        """Stages required to produce the targets from what is already available"""
+        available = set(available)
+        producers: Dict[str, Stage] = {}
+        for stage in self.stages:
+            for output in stage.outputs:
+                if output in producers:
+                    raise StageGraphError(f"Output '{output}' is produced by both '{producers[output].name}' and '{stage.name}'")
+                producers[output] = stage
+
+        needed: Dict[str, Stage] = {}
+        visiting = set()
+
+        def require(key: str):
+            if key in available:
+                return
+            stage = producers.get(key)
+            if stage is None:
+                raise StageGraphError(f"Nothing in graph '{self.name}' produces '{key}'")
+            if stage.name in needed:
+                return
+            if stage.name in visiting:
+                raise StageGraphError(f"Cycle in graph '{self.name}' at stage '{stage.name}'")
+            visiting.add(stage.name)
+            for name in stage.inputs:
+                require(name)
+            visiting.discard(stage.name)
+            needed[stage.name] = stage
+
+        for target in self.targets:
+            require(target)
+        return list(needed.values())
+
+    async def run(self, initial: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Run the planned stages; returns the full context of inputs and outputs"""
+        self.context = dict(initial or {})
+        pending = self.plan(self.context)
+        running: Dict[asyncio.Task, Stage] = {}
+        started = time.perf_counter()
+
+        try:
+            while pending or running:
+                for stage in [s for s in pending if all(name in self.context for name in s.inputs)]:
+                    pending.remove(stage)
+                    running[asyncio.create_task(self._timed(stage))] = stage
+
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    running.pop(task)
+                    self.context.update(task.result())
+        finally:
+            # On failure, cancel whatever is still running before propagating
+            for task in running:
+                task.cancel()
+            if running:
+                await asyncio.gather(*running, return_exceptions=True)
+
+        total = time.perf_counter() - started
+        if logger.isEnabledFor(logging.INFO):
+            summary = ", ".join(f"{name}={seconds:.2f}s" for name, seconds in self.timings.items())
+            logger.info(
+                "⏱️ %s stages (%.2fs total): %s", self.name, total, summary,
+                extra={"operation": self.name, "duration_ms": round(total * 1000, 1)}
+            )
+        return self.context
+
+    async def _timed(self, stage: Stage) -> Dict[str, Any]:
+        # Each stage runs in its own task, so this only labels work done by this stage
+        current_operation.set(self.name)
+        started = time.perf_counter()
+        status = "ok"
+        try:
+            with tracer.span(f"stage.{stage.name}", operation=self.name):
+                return await stage.execute(self.context)
+        except StageGraphExit:
+            status = "exit"
+            raise
+        except Exception:
+            status = "error"
+            STAGE_ERRORS.labels(self.name, stage.name).inc()
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            self.timings[stage.name] = elapsed
+            STAGE_SECONDS.labels(self.name, stage.name).observe(elapsed)
+            # One summary record per stage; fields are structured in JSON log mode
+            logger.info(
+                "⏱️ %s.%s %s in %.3fs", self.name, stage.name, status, elapsed,
+                extra={
+                    "operation": self.name,
+                    "stage": stage.name,
+                    "status": status,
+                    "duration_ms": round(elapsed * 1000, 1)
+                }
+            )
@@ -0,0 +1,458 @@
+import os
+import re
+import hmac
+import json
+import shutil
+import asyncio
+import hashlib
+import logging
+import tempfile
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.parse import quote
+
+import httpx
+
+from utils.resumable_upload import ResumableUploader
+from utils.tracing import tracer
+from utils.log_config import verbose_enabled
+
+logger = logging.getLogger(__name__)
+
+# Content-addressed outputs never change, so caches may keep them forever
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Filenames from ArtifactCache.object_stem: <32 hex of source hash>-<16 hex of artifact key>.<ext>
+CONTENT_ADDRESSED_NAME = re.compile(r"[0-9a-f]{32}-[0-9a-f]{16}\.\w+")
+
+CONTENT_TYPES = {
+    '.mp4': 'video/mp4',
+    '.webm': 'video/webm',
+    '.mov': 'video/quicktime',
+    '.avi': 'video/x-msvideo',
+    '.mkv': 'video/x-matroska',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.png': 'image/png',
+    '.gif': 'image/gif',
+    '.bmp': 'image/bmp',
+    '.webp': 'image/webp'
+}
+
+def content_type_for(extension: str) -> str:
+    """MIME type for a file extension"""
+    return CONTENT_TYPES.get(extension.lower(), 'application/octet-stream')
+
+class StorageBackend:
+    """Where processed outputs are stored and how they are addressed
+
+    Backends upload a finished file under a key (`user_id/folder/filename`)
+    and return the URL callers receive.
+    """
+
+    name = "base"
+
+    def is_configured(self) -> bool:
+        return True
+
+    async def put(self, file_path: str, key: str, content_type: str, immutable: bool) -> str:
+        """Store a file under key and return its public URL"""
+        raise NotImplementedError
+
+    def local_path(self, url: str) -> Optional[str]:
+        """Filesystem path behind one of this backend's URLs, if it has one"""
+        return None
+
+    def describe(self) -> Dict[str, str]:
+        return {"backend": self.name}
+
+class SupabaseStorageBackend(StorageBackend):
+    """Supabase Storage through its REST and TUS endpoints"""
+
+    name = "supabase"
+
+    def __init__(self, supabase_url: str, supabase_key: str, resumable_threshold: int, parallel_parts: int):
+        self.supabase_url = supabase_url
+        self.supabase_key = supabase_key
+        self.bucket = os.getenv("SUPABASE_STORAGE_BUCKET", "user-files")
+        self.resumable_threshold = resumable_threshold
+        self.parallel_parts = parallel_parts
+
+    def is_configured(self) -> bool:
+        return bool(self.supabase_url and self.supabase_key)
+
+    def describe(self) -> Dict[str, str]:
+        return {"backend": self.name, "url": self.supabase_url, "bucket": self.bucket}
+
+    def _auth_headers(self) -> Dict[str, str]:
+        return {"apikey": self.supabase_key, "Authorization": f"Bearer {self.supabase_key}"}
+
+    async def put(self, file_path: str, key: str, content_type: str, immutable: bool) -> str:
+        # Large outputs go through resumable chunked uploads
+        if os.path.getsize(file_path) >= self.resumable_threshold:
+            await self._upload_resumable(file_path, key, content_type, immutable)
+        else:
+            await self._upload_single_request(file_path, key, {
+                **self._auth_headers(),
+                "Content-Type": content_type,
+                "Cache-Control": IMMUTABLE_CACHE_CONTROL if immutable else "3600"
+            })
+
+        public_url = f"{self.supabase_url}/storage/v1/object/public/{self.bucket}/{key}"
+        logger.debug("🔗 Generated public URL: %s", public_url)
+
+        # FIXED: Verify upload worked by checking if file exists in storage
+        with tracer.span("storage.verify", path=key):
+            await self._verify_upload_success(key, public_url)
+        return public_url
+
+    async def _upload_single_request(self, file_path: str, storage_path: str, headers: Dict[str, str]):
+        """Upload a whole file with one POST"""
+        # Read file
+        with open(file_path, 'rb') as f:
+            file_data = f.read()
+
+        logger.debug("📖 Read %s bytes from file", len(file_data))
+
+        # Upload URL - FIXED: Use upsert parameter
+        upload_url = f"{self.supabase_url}/storage/v1/object/{self.bucket}/{storage_path}?upsert=true"
+        logger.debug("🌐 Upload URL: %s", upload_url)
+
+        # Upload file
+        logger.debug("📡 Starting upload request...")
+        async with httpx.AsyncClient(timeout=120.0) as client:
+            response = await client.post(
+                upload_url,
+                content=file_data,
+                headers=headers
+            )
+
+            logger.info("📊 Upload response status: %s", response.status_code)
+            if verbose_enabled(logger):
+                logger.debug("📊 Upload response text: %s", response.text)
+
+            # FIXED: Check for both 200 and 201 (created)
+            if response.status_code in [200, 201]:
+                logger.info("✅ Upload successful: %s", storage_path)
+
+                try:
+                    response_data = response.json()
+                    if verbose_enabled(logger):
+                        logger.debug("📋 Upload response data: %s", json.dumps(response_data))
+
+                    # Check if response indicates success
+                    if 'error' in response_data:
+                        raise Exception(f"Supabase error: {response_data['error']}")
+
+                except Exception as json_error:
+                    logger.debug("📋 Upload response (non-JSON): %s", response.text)
+            else:
+                logger.error("❌ Upload failed with status %s", response.status_code)
+                logger.error("❌ Upload response: %s", response.text)
+                raise Exception(f"Upload failed: {response.status_code} - {response.text}")
+
+    async def _upload_resumable(self, file_path: str, storage_path: str, content_type: str, immutable: bool):
+        """Upload a large file through Supabase's TUS endpoint, resuming after transient errors"""
+        uploader = ResumableUploader(
+            endpoint=f"{self.supabase_url}/storage/v1/upload/resumable",
+            headers={**self._auth_headers(), "x-upsert": "true"},
+            parallel_parts=self.parallel_parts
+        )
+        await uploader.upload(
+            file_path,
+            metadata={
+                "bucketName": self.bucket,
+                "objectName": storage_path,
+                "contentType": content_type,
+                "cacheControl": "31536000" if immutable else "3600"
+            }
+        )
+        logger.info("✅ Resumable upload successful: %s", storage_path)
+
+    async def _verify_upload_success(self, storage_path: str, public_url: str):
+        """Verify that upload actually worked by checking storage API"""
+        try:
+            logger.info("🔍 Verifying upload success for: %s", storage_path)
+
+            # Check using Supabase storage API
+            verify_url = f"{self.supabase_url}/storage/v1/object/info/{self.bucket}/{storage_path}"
+
+            async with httpx.AsyncClient(timeout=10.0) as client:
+                response = await client.get(verify_url, headers=self._auth_headers())
+
+                logger.info("🔍 Verification response status: %s", response.status_code)
+
+                if response.status_code == 200:
+                    try:
+                        logger.info("✅ Upload verified - file exists in storage")
+                        if verbose_enabled(logger):
+                            logger.debug("📊 File info: %s", json.dumps(response.json()))
+                    except:
+                        logger.info("✅ Upload verified - got 200 response")
+                else:
+                    logger.warning("⚠️ Upload verification failed: %s", response.status_code)
+                    logger.warning("⚠️ Response: %s", response.text)
+
+                    # Also try the public URL
+                    public_response = await client.head(public_url)
+                    logger.info("🔍 Public URL test: %s", public_response.status_code)
+
+        except Exception as verify_error:
+            logger.warning("⚠️ Upload verification failed: %s", verify_error)
+            logger.warning("File may still be uploaded correctly")
+
+class LocalStorageBackend(StorageBackend):
+    """Files in a local directory, served by the service's /files route"""
+
+    name = "local"
+
+    def __init__(self):
+        self.root = os.path.realpath(
+            os.getenv("STORAGE_LOCAL_DIR", os.path.join(tempfile.gettempdir(), "ffmpeg-storage"))
+        )
+        port = os.getenv("PORT", "8000")
+        self.public_base = os.getenv("STORAGE_PUBLIC_URL", f"http://localhost:{port}").rstrip("/") + "/files/"
+        os.makedirs(self.root, exist_ok=True)
+        logger.info("✅ Local storage at %s, served from %s", self.root, self.public_base)
+
+    def describe(self) -> Dict[str, str]:
+        return {"backend": self.name, "root": self.root, "public_url": self.public_base}
+
+    def resolve(self, key: str) -> Optional[str]:
+        """Path of a stored key, or None if it is missing or escapes the root"""
+        path = os.path.realpath(os.path.join(self.root, key))
+        if not path.startswith(self.root + os.sep) or not os.path.isfile(path):
+            return None
+        return path
+
+    @staticmethod
+    def cache_control(key: str) -> str:
+        """Cache-Control for a stored key, matching what the other backends set at upload"""
+        if CONTENT_ADDRESSED_NAME.fullmatch(os.path.basename(key)):
+            return IMMUTABLE_CACHE_CONTROL
+        return "public, max-age=3600"
+
+    def local_path(self, url: str) -> Optional[str]:
+        if not url.startswith(self.public_base):
+            return None
+        return self.resolve(url[len(self.public_base):].split("?", 1)[0])
+
+    async def put(self, file_path: str, key: str, content_type: str, immutable: bool) -> str:
+        destination = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        staging = f"{destination}.{os.urandom(4).hex()}.tmp"
+        try:
+            # Hard link when the workspace shares the filesystem, otherwise copy
+            os.link(file_path, staging)
+        except OSError:
+            await asyncio.to_thread(shutil.copyfile, file_path, staging)
+        os.replace(staging, destination)
+        return self.public_base + quote(key)
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """Inclusive byte range requested by a single-range Range header
+
+    Returns None when the whole file should be served (no header, other
+    units, multiple ranges or bad syntax); raises ValueError when the
+    range cannot be satisfied.
+    """
+    if not header:
+        return None
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, _, last = (part.strip() for part in spec.strip().partition("-"))
+    if not all(part == "" or part.isdigit() for part in (first, last)) or not (first or last):
+        return None
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    else:
+        # Suffix range: the last N bytes
+        start, end = max(0, size - int(last)), size - 1
+    if start >= size or start > end:
+        raise ValueError(f"Range {header} not satisfiable for {size} bytes")
+    return start, end
+
+def iter_file_range(path: str, start: int, end: int, chunk_size: int = 256 * 1024) -> Iterator[bytes]:
+    """Read bytes start..end (inclusive) of a file in chunks"""
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+class S3StorageBackend(StorageBackend):
+    """Any S3-compatible object store (AWS S3, MinIO, R2, ...) with SigV4-signed requests
+
+    Files at or above the resumable threshold use multipart uploads with
+    parts sent in parallel.
+    """
+
+    name = "s3"
+
+    def __init__(self, resumable_threshold: int, parallel_parts: int):
+        self.endpoint = os.getenv("S3_ENDPOINT_URL", "https://s3.amazonaws.com").rstrip("/")
+        self.bucket = os.getenv("S3_BUCKET", "")
+        self.region = os.getenv("S3_REGION", "us-east-1")
+        self.access_key = os.getenv("S3_ACCESS_KEY_ID", "")
+        self.secret_key = os.getenv("S3_SECRET_ACCESS_KEY", "")
+        self.virtual_hosted = os.getenv("S3_ADDRESSING", "path").lower() == "virtual"
+        self.part_size = max(5, int(os.getenv("S3_PART_SIZE_MB", "8"))) * 1024 * 1024
+        self.multipart_threshold = resumable_threshold
+        self.parallel_parts = parallel_parts
+
+        if self.virtual_hosted:
+            scheme, _, host = self.endpoint.partition("://")
+            self.bucket_url = f"{scheme}://{self.bucket}.{host}"
+        else:
+            self.bucket_url = f"{self.endpoint}/{self.bucket}"
+        self.public_base = os.getenv("S3_PUBLIC_URL", self.bucket_url).rstrip("/")
+
+        if not self.is_configured():
+            logger.warning("⚠️ S3 storage selected but S3_BUCKET/S3_ACCESS_KEY_ID/S3_SECRET_ACCESS_KEY are not all set")
+
+    def is_configured(self) -> bool:
+        return bool(self.bucket and self.access_key and self.secret_key)
+
+    def describe(self) -> Dict[str, str]:
+        return {"backend": self.name, "endpoint": self.endpoint, "bucket": self.bucket}
+
+    def _sign(self, method: str, url: httpx.URL, payload_hash: str) -> Dict[str, str]:
+        """AWS Signature Version 4 headers for one request"""
+        now = datetime.now(timezone.utc)
+        amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+        scope = f"{now.strftime('%Y%m%d')}/{self.region}/s3/aws4_request"
+        host = url.host if url.port is None else f"{url.host}:{url.port}"
+
+        query = sorted(
+            (quote(name, safe="-_.~"), quote(value, safe="-_.~"))
+            for name, value in url.params.multi_items()
+        )
+        canonical_request = "\n".join([
+            method,
+            url.raw_path.split(b"?", 1)[0].decode("ascii"),
+            "&".join(f"{name}={value}" for name, value in query),
+            f"host:{host}\nx-amz-content-sha256:{payload_hash}\nx-amz-date:{amz_date}\n",
+            "host;x-amz-content-sha256;x-amz-date",
+            payload_hash
+        ])
+        string_to_sign = "\n".join([
+            "AWS4-HMAC-SHA256",
+            amz_date,
+            scope,
+            hashlib.sha256(canonical_request.encode("utf-8")).hexdigest()
+        ])
+
+        key = ("AWS4" + self.secret_key).encode("utf-8")
+        for part in scope.split("/"):
+            key = hmac.new(key, part.encode("utf-8"), hashlib.sha256).digest()
+        signature = hmac.new(key, string_to_sign.encode("utf-8"), hashlib.sha256).hexdigest()
+
+        return {
+            "x-amz-date": amz_date,
+            "x-amz-content-sha256": payload_hash,
+            "Authorization": (
+                f"AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, "
+                f"SignedHeaders=host;x-amz-content-sha256;x-amz-date, Signature={signature}"
+            )
+        }
+
+    async def _request(
+        self,
+        client: httpx.AsyncClient,
+        method: str,
+        key: str,
+        params: Optional[Dict[str, str]] = None,
+        content: bytes = b"",
+        headers: Optional[Dict[str, str]] = None
+    ) -> httpx.Response:
+        # Query encoded exactly as SigV4 canonicalizes it, so the wire URL matches the signature
+        query = "&".join(
+            f"{quote(name, safe='-_.~')}={quote(value, safe='-_.~')}" for name, value in sorted((params or {}).items())
+        )
+        url = httpx.URL(f"{self.bucket_url}/{quote(key, safe='/-_.~')}" + (f"?{query}" if query else ""))
+        signed = self._sign(method, url, hashlib.sha256(content).hexdigest())
+        response = await client.request(method, url, content=content, headers={**(headers or {}), **signed})
+        if response.status_code >= 300:
+            raise Exception(f"S3 {method} {key} failed: {response.status_code} - {response.text[:500]}")
+        return response
+
+    async def put(self, file_path: str, key: str, content_type: str, immutable: bool) -> str:
+        headers = {
+            "Content-Type": content_type,
+            "Cache-Control": IMMUTABLE_CACHE_CONTROL if immutable else "max-age=3600"
+        }
+        async with httpx.AsyncClient(timeout=120.0) as client:
+            if os.path.getsize(file_path) >= self.multipart_threshold:
+                await self._put_multipart(client, file_path, key, headers)
+            else:
+                with open(file_path, "rb") as f:
+                    data = f.read()
+                await self._request(client, "PUT", key, content=data, headers=headers)
+        logger.info("✅ S3 upload successful: %s", key)
+        return f"{self.public_base}/{quote(key)}"
+
+    async def _put_multipart(self, client: httpx.AsyncClient, file_path: str, key: str, headers: Dict[str, str]):
+        response = await self._request(client, "POST", key, params={"uploads": ""}, headers=headers)
+        match = re.search(r"<UploadId>([^<]+)</UploadId>", response.text)
+        if not match:
+            raise Exception(f"S3 did not return an UploadId for {key}")
+        upload_id = match.group(1)
+
+        file_size = os.path.getsize(file_path)
+        part_count = (file_size + self.part_size - 1) // self.part_size
+        semaphore = asyncio.Semaphore(self.parallel_parts)
+        etags: List[Optional[str]] = [None] * part_count
+
+        async def upload_part(index: int):
+            async with semaphore:
+                with open(file_path, "rb") as f:
+                    f.seek(index * self.part_size)
+                    data = f.read(self.part_size)
+                part = await self._request(
+                    client, "PUT", key,
+                    params={"partNumber": str(index + 1), "uploadId": upload_id},
+                    content=data
+                )
+                etags[index] = part.headers["etag"]
+
+        try:
+            await asyncio.gather(*(upload_part(index) for index in range(part_count)))
+            body = "<CompleteMultipartUpload>" + "".join(
+                f"<Part><PartNumber>{index + 1}</PartNumber><ETag>{etag}</ETag></Part>"
+                for index, etag in enumerate(etags)
+            ) + "</CompleteMultipartUpload>"
+            response = await self._request(
+                client, "POST", key, params={"uploadId": upload_id}, content=body.encode("utf-8")
+            )
+            # CompleteMultipartUpload can fail with a 200 and an error body
+            if "<Error>" in response.text:
+                raise Exception(f"S3 multipart completion failed: {response.text[:500]}")
+            logger.info("✅ Multipart upload of %s parts complete: %s", part_count, key)
+        except Exception:
+            try:
+                await self._request(client, "DELETE", key, params={"uploadId": upload_id})
+            except Exception as abort_error:
+                logger.warning("⚠️ Could not abort multipart upload %s: %s", upload_id, abort_error)
+            raise
+
+def create_storage_backend(
+    supabase_url: str,
+    supabase_key: str,
+    resumable_threshold: int,
+    parallel_parts: int
+) -> StorageBackend:
+    """Backend named by STORAGE_BACKEND; defaults to Supabase when configured, else local files"""
+    name = os.getenv("STORAGE_BACKEND", "supabase" if supabase_url and supabase_key else "local").lower()
+    if name == "supabase":
+        return SupabaseStorageBackend(supabase_url, supabase_key, resumable_threshold, parallel_parts)
+    if name == "local":
+        return LocalStorageBackend()
+    if name == "s3":
+        return S3StorageBackend(resumable_threshold, parallel_parts)
+    raise ValueError(f"Unknown STORAGE_BACKEND '{name}' (expected supabase, local or s3)")
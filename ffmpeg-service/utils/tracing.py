@@ -0,0 +1,199 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional, Dict, Any, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+class Span:
+    """One timed unit of work inside a trace"""
+
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "start_time", "end_time",
+                 "attributes", "status", "error", "_started")
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], attributes: Dict[str, Any]):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.start_time = time.time()
+        self.end_time: Optional[float] = None
+        self.attributes = attributes
+        self.status = "ok"
+        self.error: Optional[str] = None
+        self._started = time.perf_counter()
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def record_error(self, error: BaseException):
+        self.status = "error"
+        self.error = f"{type(error).__name__}: {error}"
+
+    @property
+    def duration(self) -> Optional[float]:
+        return None if self.end_time is None else self.end_time - self.start_time
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_time": self.start_time,
+            "duration_ms": round(self.duration * 1000, 3) if self.duration is not None else None,
+            "status": self.status,
+            "error": self.error,
+            "attributes": self.attributes
+        }
+
+class InMemoryExporter:
+    """Keeps the most recent traces in memory for the traces endpoint"""
+
+    def __init__(self, max_traces: int = 200):
+        self.max_traces = max_traces
+        self._traces: "OrderedDict[str, List[Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def export(self, span: Span):
+        with self._lock:
+            spans = self._traces.get(span.trace_id)
+            if spans is None:
+                spans = self._traces[span.trace_id] = []
+                while len(self._traces) > self.max_traces:
+                    self._traces.popitem(last=False)
+            spans.append(span.to_dict())
+
+    def get_trace(self, trace_id: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            return sorted(self._traces.get(trace_id, []), key=lambda span: span["start_time"])
+
+class JsonlExporter:
+    """Appends finished spans to a JSON-lines file"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, "a", buffering=1, encoding="utf-8")
+
+    def export(self, span: Span):
+        line = json.dumps(span.to_dict(), default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+
+    def close(self):
+        self._file.close()
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+class Tracer:
+    """Minimal tracer: spans nest through a context variable and go to pluggable exporters
+
+    A trace starts per job, keyed by its processing_id. Exporters are any
+    object with an `export(span)` method.
+    """
+
+    def __init__(self):
+        self.enabled = os.getenv("TRACING_ENABLED", "true").lower() != "false"
+        self.exporters: List[Any] = []
+        self.memory: Optional[InMemoryExporter] = None
+
+        if self.enabled:
+            for name in os.getenv("TRACE_EXPORTERS", "memory").split(","):
+                name = name.strip()
+                if name == "memory":
+                    self.memory = InMemoryExporter(int(os.getenv("TRACE_MEMORY_MAX_TRACES", "200")))
+                    self.add_exporter(self.memory)
+                elif name == "jsonl":
+                    path = os.getenv("TRACE_JSONL_PATH", os.path.join(tempfile.gettempdir(), "ffmpeg_traces.jsonl"))
+                    self.add_exporter(JsonlExporter(path))
+                    logger.info("✅ Writing trace spans to: %s", path)
+                elif name:
+                    logger.warning("⚠️ Unknown trace exporter: %s", name)
+
+    def add_exporter(self, exporter: Any):
+        self.exporters.append(exporter)
+
+    @staticmethod
+    def trace_id_for(processing_id: str) -> str:
+        """W3C trace id (32 hex chars) for a processing_id"""
+        trace_id = processing_id.replace("-", "").lower()
+        if len(trace_id) == 32 and all(c in "0123456789abcdef" for c in trace_id):
+            return trace_id
+        return hashlib.sha256(processing_id.encode("utf-8")).hexdigest()[:32]
+
+    @contextmanager
+    def start_trace(self, processing_id: str, name: str, **attributes):
+        """Root span of a job's trace"""
+        with self._span(name, self.trace_id_for(processing_id), None, attributes) as span:
+            yield span
+
+    @contextmanager
+    def span(self, name: str, traceparent: Optional[str] = None, **attributes):
+        """Child of the current span, or of a remote parent given as a traceparent header"""
+        parent = _current_span.get()
+        remote = self.parse_traceparent(traceparent) if traceparent else None
+        if remote:
+            trace_id, parent_id = remote
+        elif parent is not None:
+            trace_id, parent_id = parent.trace_id, parent.span_id
+        else:
+            trace_id, parent_id = os.urandom(16).hex(), None
+        with self._span(name, trace_id, parent_id, attributes) as span:
+            yield span
+
+    @contextmanager
+    def _span(self, name: str, trace_id: str, parent_id: Optional[str], attributes: Dict[str, Any]):
+        if not self.enabled:
+            yield Span(name, trace_id, parent_id, attributes)
+            return
+
+        span = Span(name, trace_id, parent_id, attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            # Control-flow exceptions can opt out with traced_as_error = False
+            if getattr(e, "traced_as_error", True):
+                span.record_error(e)
+            raise
+        finally:
+            _current_span.reset(token)
+            span.end_time = span.start_time + (time.perf_counter() - span._started)
+            for exporter in self.exporters:
+                try:
+                    exporter.export(span)
+                except Exception as e:
+                    logger.warning("⚠️ Span export failed: %s", e)
+
+    def current_span(self) -> Optional[Span]:
+        return _current_span.get()
+
+    def record_error(self, error: BaseException):
+        """Mark the current span as failed for errors handled without re-raising"""
+        span = _current_span.get()
+        if span is not None:
+            span.record_error(error)
+
+    def traceparent(self) -> Optional[str]:
+        """W3C traceparent header for the current span"""
+        span = _current_span.get()
+        if span is None or not self.enabled:
+            return None
+        return f"00-{span.trace_id}-{span.span_id}-01"
+
+    @staticmethod
+    def parse_traceparent(header: str) -> Optional[Tuple[str, str]]:
+        parts = header.strip().split("-")
+        if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+            return None
+        return parts[1], parts[2]
+
+tracer = Tracer()
@@ -0,0 +1,168 @@
+import logging
+from typing import Any, Dict, Iterable, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Overlay x:y per watermark position
+WATERMARK_POSITIONS = {
+    "bottom-center": "(W-w)/2:H-h-50",      # 50px from bottom, centered
+    "left-center": "10:(H-h)/2",        # Left edge, centered
+    "right-center": "W-w-10:(H-h)/2"    # Right edge, centered
+}
+
+TRANSFORM_OPS = ("trim", "scale", "watermark", "fps", "audio")
+# Steps that may appear at most once
+SINGLE_OPS = ("trim", "fps", "audio")
+MAX_STEPS = 16
+MAX_WATERMARKS = 4
+
+class TransformPlanError(ValueError):
+    """The steps can't be compiled into a filtergraph"""
+
+def render_filter(name: str, args: Iterable[Any] = (), kwargs: Dict[str, Any] = None) -> str:
+    """One filter in filtergraph syntax: name=arg:arg:key=value"""
+    options = [str(arg) for arg in args] + [f"{key}={value}" for key, value in (kwargs or {}).items()]
+    return f"{name}={':'.join(options)}" if options else name
+
+class TransformPlan:
+    """Ordered transform steps compiled into one filtergraph and one encode
+
+    Steps are dicts with an "op": trim, scale, watermark, fps or audio.
+    Scale, fps and watermark overlays form one video filter chain in the
+    order given, each watermark image being an extra input. Trim becomes
+    input options, so only the kept span is decoded; audio becomes output
+    options. Both of FFmpegProcessor's command builders render a plan, so
+    invalid steps are rejected here, before anything runs.
+    """
+
+    def __init__(self, steps: Iterable[Dict[str, Any]]):
+        self.steps = [dict(step) for step in steps]
+        self.input_options: Dict[str, Any] = {}
+        # ("filter", name, args, kwargs) or ("overlay", watermark index)
+        self.video_filters: List[tuple] = []
+        # Per watermark: its source URL (None for the default), image filters and overlay x/y
+        self.watermarks: List[Dict[str, Any]] = []
+        self.audio_options: Dict[str, Any] = {"map": "0:a?"}
+        self._compile()
+
+    def _compile(self):
+        if len(self.steps) > MAX_STEPS:
+            raise TransformPlanError(f"At most {MAX_STEPS} steps per transform")
+        seen = set()
+        for index, step in enumerate(self.steps):
+            op = step.get("op")
+            if op not in TRANSFORM_OPS:
+                raise TransformPlanError(f"Step {index}: unknown op '{op}'")
+            if op in SINGLE_OPS and op in seen:
+                raise TransformPlanError(f"Step {index}: only one '{op}' step is allowed")
+            seen.add(op)
+            getattr(self, f"_compile_{op}")(index, step)
+
+    def _compile_trim(self, index: int, step: Dict[str, Any]):
+        if index != 0:
+            raise TransformPlanError(f"Step {index}: trim must be the first step")
+        start, duration = step.get("start") or 0.0, step.get("duration")
+        if start < 0 or (duration is not None and duration <= 0):
+            raise TransformPlanError(f"Step {index}: trim needs start >= 0 and duration > 0")
+        if start:
+            self.input_options["ss"] = start
+        if duration:
+            self.input_options["t"] = duration
+
+    def _compile_scale(self, index: int, step: Dict[str, Any]):
+        width, height = step.get("width"), step.get("height")
+        if not width and not height:
+            raise TransformPlanError(f"Step {index}: scale needs a width or a height")
+        if width and height:
+            if step.get("preserve_aspect_ratio", True):
+                # Fit inside the box, then pad to it
+                self.video_filters.append(("filter", "scale", (width, height), {"force_original_aspect_ratio": "decrease"}))
+                self.video_filters.append(("filter", "pad", (width, height, "(ow-iw)/2", "(oh-ih)/2"), {}))
+            else:
+                self.video_filters.append(("filter", "scale", (width, height), {}))
+        else:
+            # -2 keeps the other side even, which 4:2:0 encoders need
+            self.video_filters.append(("filter", "scale", (width or -2, height or -2), {}))
+
+    def _compile_watermark(self, index: int, step: Dict[str, Any]):
+        if len(self.watermarks) == MAX_WATERMARKS:
+            raise TransformPlanError(f"Step {index}: at most {MAX_WATERMARKS} watermarks per transform")
+        position = step.get("position", "bottom-center")
+        if position not in WATERMARK_POSITIONS:
+            raise TransformPlanError(f"Step {index}: unknown watermark position '{position}'")
+        opacity, scale = step.get("opacity", 0.9), step.get("scale", 0.5)
+        if not 0 < opacity <= 1 or not 0 < scale <= 4:
+            raise TransformPlanError(f"Step {index}: watermark needs 0 < opacity <= 1 and 0 < scale <= 4")
+        x, y = WATERMARK_POSITIONS[position].split(":")
+        self.video_filters.append(("overlay", len(self.watermarks)))
+        self.watermarks.append({
+            "watermark_url": step.get("watermark_url"),
+            "filters": [
+                ("scale", (f"iw*{scale}", f"ih*{scale}"), {}),
+                ("format", ("rgba",), {}),
+                ("colorchannelmixer", (), {"aa": opacity})
+            ],
+            "x": x,
+            "y": y
+        })
+
+    def _compile_fps(self, index: int, step: Dict[str, Any]):
+        fps = step.get("fps")
+        if not fps or not 0 < fps <= 120:
+            raise TransformPlanError(f"Step {index}: fps must be between 0 and 120")
+        self.video_filters.append(("filter", "fps", (fps,), {}))
+
+    def _compile_audio(self, index: int, step: Dict[str, Any]):
+        mode = step.get("mode", "keep")
+        if mode == "mute":
+            self.audio_options = {"an": None}
+            return
+        if mode not in ("keep", "normalize"):
+            raise TransformPlanError(f"Step {index}: unknown audio mode '{mode}'")
+        # loudnorm resamples to 192 kHz internally; bring it back to a normal rate
+        filters = ["loudnorm", "aresample=48000"] if mode == "normalize" else []
+        if step.get("volume") is not None:
+            filters.append(render_filter("volume", (step["volume"],)))
+        if filters:
+            self.audio_options["af"] = ",".join(filters)
+        if step.get("bitrate"):
+            self.audio_options["b:a"] = step["bitrate"]
+
+    @property
+    def duration(self):
+        """Output duration set by trim, None when the whole source is kept"""
+        return self.input_options.get("t")
+
+    @property
+    def start(self) -> float:
+        return self.input_options.get("ss", 0.0)
+
+    def filter_complex(self, outputs: int = 1) -> Tuple[str, List[str]]:
+        """-filter_complex graph of the video chain and the labels of its outputs
+
+        Watermark images are inputs 1..n. With several outputs the chain
+        ends in a split, so every encode shares one decode and filter pass.
+        """
+        chains = []
+        inputs = "[0:v]"
+        pending: List[str] = []
+        for step in self.video_filters:
+            if step[0] != "overlay":
+                pending.append(render_filter(*step[1:]))
+                continue
+            index = step[1]
+            watermark = self.watermarks[index]
+            image = ",".join(render_filter(*spec) for spec in watermark["filters"])
+            chains.append(f"[{index + 1}:v]{image}[wm{index}]")
+            if pending:
+                label = f"[v{len(chains)}]"
+                chains.append(f"{inputs}{','.join(pending)}{label}")
+                inputs = label
+            inputs += f"[wm{index}]"
+            pending = [render_filter("overlay", kwargs={"x": watermark["x"], "y": watermark["y"]})]
+
+        labels = [f"[out{number}]" for number in range(outputs)]
+        if outputs > 1:
+            pending.append(f"split={outputs}")
+        chains.append(f"{inputs}{','.join(pending) or 'null'}{''.join(labels)}")
+        return ";".join(chains), labels
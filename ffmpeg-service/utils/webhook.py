@@ -1,9 +1,14 @@
 import os
+import time
 import logging
 import httpx
 import json
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, List
 from datetime import datetime
+from utils.webhook_outbox import WebhookOutbox
+from utils.metrics import WEBHOOK_SECONDS, STAGE_SECONDS, STAGE_ERRORS, current_operation
+from utils.tracing import tracer
+from utils.log_config import verbose_enabled
 
 logger = logging.getLogger(__name__)
 
@@ -18,11 +23,17 @@ class WebhookManager:
         
         # Log configuration
         if self.supabase_anon_key:
-            logger.info(f"✅ Webhook manager configured with anon key: {self.supabase_anon_key[:20]}...")
+            logger.info("✅ Webhook manager configured with anon key: %s...", self.supabase_anon_key[:20])
         elif self.supabase_service_key:
-            logger.info(f"✅ Webhook manager using service role key: {self.supabase_service_key[:20]}...")
+            logger.info("✅ Webhook manager using service role key: %s...", self.supabase_service_key[:20])
         else:
             logger.warning("⚠️ No Supabase keys configured for webhook authentication")
+        
+        # Durable outbox so jobs never wait on (or lose) webhook delivery
+        if os.getenv("WEBHOOK_OUTBOX_ENABLED", "true").lower() != "false":
+            self.outbox = WebhookOutbox(self.deliver)
+        else:
+            self.outbox = None
     
     async def send_completion_webhook(
         self,
@@ -33,110 +44,175 @@ class WebhookManager:
         error: Optional[str] = None,
         webhook_url: Optional[str] = None
     ):
-        """Send completion webhook with proper JSON formatting and authentication"""
+        """Queue a completion webhook in the outbox, or send it directly if the outbox is off"""
+        operation = current_operation.get()
+        started = time.perf_counter()
         try:
             url = webhook_url or self.default_webhook
+            payload = self.build_completion_payload(generation_id, processing_id, status, result, error)
             
-            # Build payload step by step
-            payload = {}
-            payload["generation_id"] = generation_id
-            payload["processing_id"] = processing_id
-            payload["status"] = status
-            payload["timestamp"] = datetime.utcnow().isoformat()
+            if self.outbox:
+                # The delivery span joins this job's trace via the stored traceparent
+                outbox_id = await self.outbox.enqueue(url, payload, traceparent=tracer.traceparent())
+                logger.info("📮 Webhook queued for delivery (#%s) to: %s", outbox_id, url)
+                return
             
-            # Clean and add result URLs
-            if result:
-                cleaned_result = {}
-                
-                # Clean each URL individually
-                for key, value in result.items():
-                    if isinstance(value, str) and value.startswith('http'):
-                        # Remove any quotes, semicolons, or extra characters
-                        cleaned_value = value.strip().strip('"').strip("'").strip(';').strip(',')
-                        cleaned_result[key] = cleaned_value
-                        logger.info(f"🧹 Cleaned {key}: {cleaned_value}")
-                    else:
-                        cleaned_result[key] = value
-                
-                # Add to payload
-                if "thumbnail_url" in cleaned_result:
-                    payload["thumbnail_url"] = cleaned_result["thumbnail_url"]
-                
-                if "watermarked_url" in cleaned_result:
-                    payload["watermarked_url"] = cleaned_result["watermarked_url"]
-                    payload["result_url"] = cleaned_result["watermarked_url"]
-                
-                if "resized_url" in cleaned_result:
-                    payload["resized_url"] = cleaned_result["resized_url"]
-                    payload["result_url"] = cleaned_result["resized_url"]
-                
-                # Add db_updated flag if present
-                if "db_updated" in cleaned_result:
-                    payload["db_updated"] = cleaned_result["db_updated"]
-                
-                # Store cleaned result
-                payload["result"] = cleaned_result
+            if not await self.deliver(url, [payload]):
+                STAGE_ERRORS.labels(operation, "webhook").inc()
+                    
+        except Exception as e:
+            STAGE_ERRORS.labels(operation, "webhook").inc()
+            logger.error("❌ Webhook failed: %s", e)
+            import traceback
+            logger.error("Traceback: %s", traceback.format_exc())
+        finally:
+            STAGE_SECONDS.labels(operation, "webhook").observe(time.perf_counter() - started)
+    
+    def build_completion_payload(
+        self,
+        generation_id: str,
+        processing_id: str,
+        status: str,
+        result: Optional[Dict[str, Any]] = None,
+        error: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """Build the completion payload with cleaned result URLs"""
+        # Build payload step by step
+        payload = {}
+        payload["generation_id"] = generation_id
+        payload["processing_id"] = processing_id
+        payload["status"] = status
+        payload["timestamp"] = datetime.utcnow().isoformat()
+        
+        # Clean and add result URLs
+        if result:
+            cleaned_result = {}
             
-            if error:
-                payload["error"] = error
+            # Clean each URL individually
+            for key, value in result.items():
+                if isinstance(value, str) and value.startswith('http'):
+                    # Remove any quotes, semicolons, or extra characters
+                    cleaned_value = value.strip().strip('"').strip("'").strip(';').strip(',')
+                    cleaned_result[key] = cleaned_value
+                    logger.debug("🧹 Cleaned %s: %s", key, cleaned_value)
+                else:
+                    cleaned_result[key] = value
             
-            logger.info(f"Sending webhook to: {url}")
+            # Add to payload
+            if "thumbnail_url" in cleaned_result:
+                payload["thumbnail_url"] = cleaned_result["thumbnail_url"]
             
-            # FIXED: Use json.dumps with proper settings to avoid semicolons
-            try:
-                clean_json_str = json.dumps(payload, indent=2, separators=(',', ': '), ensure_ascii=False)
-                logger.info(f"Webhook payload:\n{clean_json_str}")
-            except Exception as log_error:
-                logger.warning(f"Could not format payload for logging: {log_error}")
-                logger.info(f"Webhook payload keys: {list(payload.keys())}")
+            if "preview_url" in cleaned_result:
+                payload["preview_url"] = cleaned_result["preview_url"]
             
-            # Prepare headers with authentication
-            headers = {
-                "Content-Type": "application/json",
-                "User-Agent": "FFmpeg-Service/1.0"
-            }
+            if "watermarked_url" in cleaned_result:
+                payload["watermarked_url"] = cleaned_result["watermarked_url"]
+                payload["result_url"] = cleaned_result["watermarked_url"]
             
-            # Add authentication headers for Supabase edge functions
-            if url.startswith(self.supabase_url) and "/functions/" in url:
-                # This is a Supabase edge function - add auth headers
-                auth_key = self.supabase_anon_key or self.supabase_service_key
-                if auth_key:
-                    headers["Authorization"] = f"Bearer {auth_key}"
-                    headers["apikey"] = auth_key  # Some edge functions check this too
-                    logger.info("🔐 Added Supabase authentication headers for edge function")
-                else:
-                    logger.warning("⚠️ No Supabase key available for edge function authentication")
+            if "resized_url" in cleaned_result:
+                payload["resized_url"] = cleaned_result["resized_url"]
+                payload["result_url"] = cleaned_result["resized_url"]
             
-            # Send webhook
-            async with httpx.AsyncClient() as client:
+            if "transformed_url" in cleaned_result:
+                payload["transformed_url"] = cleaned_result["transformed_url"]
+                payload["result_url"] = cleaned_result["transformed_url"]
+            
+            # Add db_updated flag if present
+            if "db_updated" in cleaned_result:
+                payload["db_updated"] = cleaned_result["db_updated"]
+            
+            # Store cleaned result
+            payload["result"] = cleaned_result
+        
+        if error:
+            payload["error"] = error
+        
+        return payload
+    
+    def _auth_headers(self, url: str) -> Dict[str, str]:
+        """Authentication headers for Supabase edge function URLs"""
+        headers = {}
+        if self.supabase_url and url.startswith(self.supabase_url) and "/functions/" in url:
+            # This is a Supabase edge function - add auth headers
+            auth_key = self.supabase_anon_key or self.supabase_service_key
+            if auth_key:
+                headers["Authorization"] = f"Bearer {auth_key}"
+                headers["apikey"] = auth_key  # Some edge functions check this too
+            else:
+                logger.warning("⚠️ No Supabase key available for edge function authentication")
+        return headers
+    
+    async def deliver(
+        self,
+        url: str,
+        payloads: List[Dict[str, Any]],
+        traceparent: Optional[str] = None
+    ) -> bool:
+        """POST one payload (or a batch as a JSON array) and report whether it was accepted
+        
+        traceparent links the delivery span to the job that queued it.
+        """
+        with tracer.span("webhook.post", traceparent=traceparent, url=url, payloads=len(payloads)) as span:
+            delivered = await self._post(url, payloads)
+            span.set_attribute("delivered", delivered)
+            return delivered
+    
+    async def _post(self, url: str, payloads: List[Dict[str, Any]]) -> bool:
+        body = payloads[0] if len(payloads) == 1 else payloads
+        
+        logger.info("Sending webhook to: %s (%s payload(s))", url, len(payloads))
+        
+        # FIXED: Use json.dumps with proper settings to avoid semicolons
+        if verbose_enabled(logger):
+            try:
+                clean_json_str = json.dumps(body, separators=(',', ': '), ensure_ascii=False)
+                logger.debug("Webhook payload: %s", clean_json_str)
+            except Exception as log_error:
+                logger.warning("Could not format payload for logging: %s", log_error)
+        
+        # Prepare headers with authentication
+        headers = {
+            "Content-Type": "application/json",
+            "User-Agent": "FFmpeg-Service/1.0",
+            **self._auth_headers(url)
+        }
+        if tracer.traceparent():
+            headers["traceparent"] = tracer.traceparent()
+        
+        # Send webhook
+        started = time.perf_counter()
+        async with httpx.AsyncClient() as client:
+            try:
                 response = await client.post(
                     url,
-                    json=payload,
+                    json=body,
                     headers=headers,
                     timeout=30.0
                 )
-                
-                logger.info(f"Webhook response status: {response.status_code}")
-                
-                if response.status_code == 200:
-                    logger.info("✅ Webhook sent successfully")
+            except httpx.HTTPError:
+                WEBHOOK_SECONDS.labels("error").observe(time.perf_counter() - started)
+                raise
+            WEBHOOK_SECONDS.labels(
+                "delivered" if 200 <= response.status_code < 300 else "rejected"
+            ).observe(time.perf_counter() - started)
+            
+            logger.info("Webhook response status: %s", response.status_code)
+            
+            if 200 <= response.status_code < 300:
+                logger.info("✅ Webhook sent successfully")
+                if verbose_enabled(logger):
                     try:
-                        response_data = response.json()
-                        clean_response = json.dumps(response_data, indent=2, separators=(',', ': '))
-                        logger.info(f"Webhook response:\n{clean_response}")
-                    except Exception as resp_error:
-                        logger.info(f"Webhook response text: {response.text}")
-                elif response.status_code == 401:
-                    logger.error(f"❌ Webhook authentication failed: {response.text}")
-                    logger.error("Make sure SUPABASE_ANON_KEY or SUPABASE_SERVICE_ROLE_KEY is set in environment variables")
-                else:
-                    logger.warning(f"⚠️ Webhook failed: {response.status_code}")
-                    logger.warning(f"Response: {response.text}")
-                    
-        except Exception as e:
-            logger.error(f"❌ Webhook failed: {str(e)}")
-            import traceback
-            logger.error(f"Traceback: {traceback.format_exc()}")
+                        logger.debug("Webhook response: %s", json.dumps(response.json(), separators=(',', ': ')))
+                    except Exception:
+                        logger.debug("Webhook response text: %s", response.text)
+                return True
+            elif response.status_code == 401:
+                logger.error("❌ Webhook authentication failed: %s", response.text)
+                logger.error("Make sure SUPABASE_ANON_KEY or SUPABASE_SERVICE_ROLE_KEY is set in environment variables")
+            else:
+                logger.warning("⚠️ Webhook failed: %s", response.status_code)
+                logger.warning("Response: %s", response.text)
+            return False
     
     async def send_progress_webhook(
         self,
@@ -161,28 +237,25 @@ class WebhookManager:
             
             # Prepare headers with authentication
             headers = {
-                "Content-Type": "application/json"
+                "Content-Type": "application/json",
+                **self._auth_headers(url)
             }
             
-            # Add authentication headers for Supabase edge functions
-            if url.startswith(self.supabase_url) and "/functions/" in url:
-                auth_key = self.supabase_anon_key or self.supabase_service_key
-                if auth_key:
-                    headers["Authorization"] = f"Bearer {auth_key}"
-                    headers["apikey"] = auth_key
-            
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    url,
-                    json=payload,
-                    headers=headers,
-                    timeout=10.0
-                )
+            with tracer.span("webhook.progress", url=url, progress=progress):
+                if tracer.traceparent():
+                    headers["traceparent"] = tracer.traceparent()
+                async with httpx.AsyncClient() as client:
+                    response = await client.post(
+                        url,
+                        json=payload,
+                        headers=headers,
+                        timeout=10.0
+                    )
                 
                 if response.status_code == 200:
-                    logger.info(f"✅ Progress webhook sent: {progress}%")
+                    logger.info("✅ Progress webhook sent: %s%%", progress)
                 elif response.status_code == 401:
-                    logger.error(f"❌ Progress webhook authentication failed")
+                    logger.error("❌ Progress webhook authentication failed")
                     
         except Exception as e:
-            logger.error(f"❌ Progress webhook failed: {str(e)}")
\ No newline at end of file
+            logger.error("❌ Progress webhook failed: %s", e)
\ No newline at end of file
@@ -0,0 +1,266 @@
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+import sqlite3
+import tempfile
+from typing import Optional, Dict, Any, List, Callable, Awaitable
+
+logger = logging.getLogger(__name__)
+
+class WebhookOutbox:
+    """Durable SQLite outbox for webhook deliveries
+
+    Jobs enqueue payloads and return immediately. A background worker delivers
+    them with exponential backoff and jitter, limits concurrency per
+    receiver URL and can batch several payloads for one URL into a single POST.
+    Undelivered rows survive restarts and are retried by the next instance.
+    Several processes can share one outbox file: a row is claimed by pushing
+    its next attempt past the delivery timeout before sending it. SQLite
+    calls made from the event loop run in a worker thread, since a locked
+    database can block them for up to the connection timeout.
+    """
+
+    def __init__(
+        self,
+        deliver: Callable[[str, List[Dict[str, Any]], Optional[str]], Awaitable[bool]],
+        db_path: Optional[str] = None
+    ):
+        self.deliver = deliver
+        self.db_path = db_path or os.getenv(
+            "WEBHOOK_OUTBOX_PATH",
+            os.path.join(tempfile.gettempdir(), "ffmpeg_webhook_outbox.db")
+        )
+        self.max_attempts = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "8"))
+        self.base_delay = float(os.getenv("WEBHOOK_RETRY_BASE_SECONDS", "2"))
+        self.max_delay = float(os.getenv("WEBHOOK_RETRY_MAX_SECONDS", "300"))
+        self.per_url_limit = int(os.getenv("WEBHOOK_MAX_PER_URL", "4"))
+        self.batch_size = max(1, int(os.getenv("WEBHOOK_BATCH_SIZE", "1")))
+        self.retention = float(os.getenv("WEBHOOK_OUTBOX_RETENTION_HOURS", "24")) * 3600
+        self.poll_interval = 1.0
+        # Longer than a delivery attempt can take; a claimed row becomes due again after this
+        self.claim_seconds = 120.0
+
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._sending: set = set()
+        self._tasks: set = set()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._recent_lags: List[float] = []
+
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS outbox ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "url TEXT NOT NULL, payload TEXT NOT NULL, "
+                "status TEXT NOT NULL DEFAULT 'pending', "
+                "attempts INTEGER NOT NULL DEFAULT 0, "
+                "next_attempt_at REAL NOT NULL, created_at REAL NOT NULL, "
+                "delivered_at REAL, last_error TEXT, traceparent TEXT)"
+            )
+            try:
+                # Outboxes created before trace propagation
+                conn.execute("ALTER TABLE outbox ADD COLUMN traceparent TEXT")
+            except sqlite3.OperationalError:
+                pass
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at)"
+            )
+        logger.info("✅ Webhook outbox at: %s", self.db_path)
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=10.0)
+
+    async def enqueue(self, url: str, payload: Dict[str, Any], traceparent: Optional[str] = None) -> int:
+        """Persist a webhook for delivery and wake the worker"""
+        outbox_id = await asyncio.to_thread(self._insert, url, json.dumps(payload), traceparent)
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return outbox_id
+
+    def _insert(self, url: str, payload: str, traceparent: Optional[str]) -> int:
+        now = time.time()
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "INSERT INTO outbox (url, payload, next_attempt_at, created_at, traceparent) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (url, payload, now, now, traceparent)
+            )
+            return cursor.lastrowid
+
+    async def start(self):
+        """Start the delivery worker"""
+        if self._worker is None:
+            self._wakeup = asyncio.Event()
+            self._worker = asyncio.create_task(self._run())
+            logger.info("📮 Webhook delivery worker started")
+
+    async def stop(self, timeout: float = 10.0):
+        """Stop the worker, giving in-progress deliveries a moment to finish"""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        if self._tasks:
+            await asyncio.wait(self._tasks, timeout=timeout)
+        logger.info("📮 Webhook delivery worker stopped")
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                # Rows in flight here are skipped; the thread gets a copy since deliveries finish meanwhile
+                claimed = await asyncio.to_thread(self._claim_due, frozenset(self._sending))
+                self._dispatch(claimed)
+                wait = await asyncio.to_thread(self._next_wait)
+            except Exception as e:
+                logger.error("❌ Webhook outbox dispatch failed: %s", e)
+                wait = self.poll_interval
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def _next_wait(self) -> float:
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT MIN(next_attempt_at) FROM outbox WHERE status = 'pending'"
+            ).fetchone()
+        if row[0] is None:
+            return self.poll_interval * 30
+        return min(max(row[0] - time.time(), 0.05), self.poll_interval * 30)
+
+    def _claim_due(self, sending: frozenset) -> List[tuple]:
+        """Claim every due row that isn't already being sent"""
+        with self._connect() as conn:
+            conn.execute(
+                "DELETE FROM outbox WHERE status = 'delivered' AND delivered_at < ?",
+                (time.time() - self.retention,)
+            )
+            rows = conn.execute(
+                "SELECT id, url, payload, attempts, created_at, traceparent FROM outbox "
+                "WHERE status = 'pending' AND next_attempt_at <= ? "
+                "ORDER BY next_attempt_at LIMIT 500",
+                (time.time(),)
+            ).fetchall()
+
+            # Compare-and-set on next_attempt_at so other processes skip rows we took
+            claimed = []
+            claim_until = time.time() + self.claim_seconds
+            for row in rows:
+                if row[0] in sending:
+                    continue
+                cursor = conn.execute(
+                    "UPDATE outbox SET next_attempt_at = ? "
+                    "WHERE id = ? AND status = 'pending' AND next_attempt_at <= ?",
+                    (claim_until, row[0], time.time())
+                )
+                if cursor.rowcount == 1:
+                    claimed.append(row)
+        return claimed
+
+    def _dispatch(self, claimed: List[tuple]):
+        """Start delivery tasks for claimed rows, grouped into per-URL batches"""
+        by_url: Dict[str, List[tuple]] = {}
+        for row in claimed:
+            by_url.setdefault(row[1], []).append(row)
+
+        for url, url_rows in by_url.items():
+            for i in range(0, len(url_rows), self.batch_size):
+                batch = url_rows[i:i + self.batch_size]
+                self._sending.update(row[0] for row in batch)
+                task = asyncio.create_task(self._deliver_batch(url, batch))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    async def _deliver_batch(self, url: str, rows: List[tuple]):
+        semaphore = self._semaphores.setdefault(url, asyncio.Semaphore(self.per_url_limit))
+        ids = [row[0] for row in rows]
+        try:
+            async with semaphore:
+                error = None
+                # A batch spans several traces, so only single deliveries carry one
+                traceparent = rows[0][5] if len(rows) == 1 else None
+                try:
+                    delivered = await self.deliver(url, [json.loads(row[2]) for row in rows], traceparent)
+                except Exception as e:
+                    delivered = False
+                    error = str(e)
+
+            now = time.time()
+            await asyncio.to_thread(self._record_attempt, url, rows, delivered, error, now)
+            if delivered:
+                self._record_lags([now - row[4] for row in rows])
+        finally:
+            self._sending.difference_update(ids)
+            # Let the worker re-plan its sleep around any newly scheduled retry
+            if self._wakeup is not None:
+                self._wakeup.set()
+
+    def _record_attempt(self, url: str, rows: List[tuple], delivered: bool, error: Optional[str], now: float):
+        """Mark a batch delivered, or schedule its retries (dead once out of attempts)"""
+        with self._connect() as conn:
+            if delivered:
+                conn.executemany(
+                    "UPDATE outbox SET status = 'delivered', delivered_at = ?, "
+                    "attempts = attempts + 1, last_error = NULL WHERE id = ?",
+                    [(now, row[0]) for row in rows]
+                )
+                return
+            for outbox_id, _, _, attempts, _, _ in rows:
+                attempts += 1
+                if attempts >= self.max_attempts:
+                    conn.execute(
+                        "UPDATE outbox SET status = 'dead', attempts = ?, last_error = ? WHERE id = ?",
+                        (attempts, error or "delivery rejected", outbox_id)
+                    )
+                    logger.error("❌ Webhook #%s to %s gave up after %s attempts", outbox_id, url, attempts)
+                else:
+                    delay = self._backoff(attempts)
+                    conn.execute(
+                        "UPDATE outbox SET attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                        (attempts, now + delay, error or "delivery rejected", outbox_id)
+                    )
+                    logger.warning("⚠️ Webhook #%s attempt %s failed, retrying in %.1fs", outbox_id, attempts, delay)
+
+    def _backoff(self, attempts: int) -> float:
+        """Exponential backoff, jittered over the upper half of the interval"""
+        ceiling = min(self.max_delay, self.base_delay * (2 ** (attempts - 1)))
+        return random.uniform(ceiling / 2, ceiling)
+
+    def _record_lags(self, lags: List[float]):
+        self._recent_lags.extend(lags)
+        del self._recent_lags[:-200]
+
+    def stats(self) -> Dict[str, Any]:
+        """Queue sizes and delivery lag (enqueue to successful delivery)
+
+        Blocking; call it through asyncio.to_thread from the event loop.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            counts = dict(conn.execute(
+                "SELECT status, COUNT(*) FROM outbox GROUP BY status"
+            ).fetchall())
+            oldest = conn.execute(
+                "SELECT MIN(created_at) FROM outbox WHERE status = 'pending'"
+            ).fetchone()[0]
+
+        lags = sorted(self._recent_lags)
+        return {
+            "pending": counts.get("pending", 0),
+            "delivered": counts.get("delivered", 0),
+            "dead": counts.get("dead", 0),
+            "in_progress": len(self._sending),
+            "oldest_pending_age_seconds": round(now - oldest, 3) if oldest else 0.0,
+            "delivery_lag_p50_seconds": round(lags[len(lags) // 2], 3) if lags else None,
+            "delivery_lag_p95_seconds": round(lags[int(len(lags) * 0.95)], 3) if lags else None,
+            "worker_running": self._worker is not None
+        }
@@ -0,0 +1,187 @@
+import os
+import shutil
+import asyncio
+import logging
+import socket
+import tempfile
+from contextlib import asynccontextmanager
+from typing import Optional, Dict, Any
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+# Written into every workspace: "<hostname> <pid>" of the process that owns it
+OWNER_FILE = ".owner"
+
+class Workspace:
+    """A job's private scratch directory and the disk it has reserved"""
+
+    def __init__(self, path: str, reserved_bytes: int, tmpfs: bool):
+        self.path = path
+        self.reserved_bytes = reserved_bytes
+        self.tmpfs = tmpfs
+
+class WorkspaceManager:
+    """Per-job scratch directories charged against a global disk budget
+
+    Each job gets its own directory, removed as a whole when the job ends, so
+    crashed stages cannot leak files. Jobs wait until their expected size fits
+    the budget. Small jobs can run in a RAM-backed (tmpfs) directory. Orphaned
+    workspaces left by dead processes on this host are swept at startup and on
+    a schedule; nothing outside the workspace roots is touched.
+    """
+
+    def __init__(self):
+        self.base_dir = os.getenv("WORKSPACE_DIR", os.path.join(tempfile.gettempdir(), "ffmpeg-jobs"))
+        self.disk_budget = int(os.getenv("WORKSPACE_DISK_BUDGET_MB", "8192")) * MB
+        self.tmpfs_dir = os.getenv("WORKSPACE_TMPFS_DIR", "/dev/shm")
+        self.tmpfs_max_job = int(os.getenv("WORKSPACE_TMPFS_MAX_JOB_MB", "0")) * MB
+        self.tmpfs_budget = int(os.getenv("WORKSPACE_TMPFS_BUDGET_MB", "256")) * MB
+        self.sweep_interval = int(os.getenv("WORKSPACE_SWEEP_INTERVAL_MINUTES", "15")) * 60
+
+        self.disk_reserved = 0
+        self.tmpfs_reserved = 0
+        self.waiting = 0
+        self.hostname = socket.gethostname()
+        self._active: Dict[str, Workspace] = {}
+        self._condition: Optional[asyncio.Condition] = None
+        self._sweeper: Optional[asyncio.Task] = None
+
+        os.makedirs(self.base_dir, exist_ok=True)
+        self.tmpfs_enabled = self.tmpfs_max_job > 0 and os.path.isdir(self.tmpfs_dir)
+        logger.info(
+            "✅ Workspaces in %s (budget %sMB, tmpfs %s)", self.base_dir, self.disk_budget // MB, 'on' if self.tmpfs_enabled else 'off'
+        )
+
+    def _get_condition(self) -> asyncio.Condition:
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    @asynccontextmanager
+    async def acquire(self, job_name: str, expected_bytes: int):
+        """Reserve space for a job, yield its workspace and remove it afterwards"""
+        condition = self._get_condition()
+        use_tmpfs = self.tmpfs_enabled and expected_bytes <= self.tmpfs_max_job
+
+        async with condition:
+            if use_tmpfs and self.tmpfs_reserved + expected_bytes > self.tmpfs_budget:
+                # RAM is full - fall back to disk rather than wait
+                use_tmpfs = False
+
+            # An oversized job waits until it can run alone instead of failing
+            reserved = expected_bytes if use_tmpfs else min(expected_bytes, self.disk_budget)
+            if not use_tmpfs:
+                if self.disk_reserved + reserved > self.disk_budget:
+                    logger.info("⏳ Waiting for %sMB of workspace disk for %s", reserved // MB, job_name)
+                    self.waiting += 1
+                    try:
+                        await condition.wait_for(lambda: self.disk_reserved + reserved <= self.disk_budget)
+                    finally:
+                        self.waiting -= 1
+                self.disk_reserved += reserved
+            else:
+                self.tmpfs_reserved += reserved
+
+        root = os.path.join(self.tmpfs_dir, "ffmpeg-jobs") if use_tmpfs else self.base_dir
+        os.makedirs(root, exist_ok=True)
+        path = tempfile.mkdtemp(prefix=f"job_{os.getpid()}_", dir=root)
+        with open(os.path.join(path, OWNER_FILE), "w") as owner:
+            owner.write(f"{self.hostname} {os.getpid()}")
+        workspace = Workspace(path, reserved, use_tmpfs)
+        self._active[path] = workspace
+        logger.info("📂 Workspace for %s: %s (%sMB reserved%s)", job_name, path, reserved // MB, ', tmpfs' if use_tmpfs else '')
+
+        try:
+            yield workspace
+        finally:
+            self._active.pop(path, None)
+            shutil.rmtree(path, ignore_errors=True)
+            async with condition:
+                if use_tmpfs:
+                    self.tmpfs_reserved -= reserved
+                else:
+                    self.disk_reserved -= reserved
+                condition.notify_all()
+            logger.info("🧹 Workspace removed: %s", path)
+
+    def _owner(self, path: str) -> Optional[tuple]:
+        """(hostname, pid) from a workspace's owner file; None for directories the service didn't create"""
+        try:
+            with open(os.path.join(path, OWNER_FILE)) as owner:
+                hostname, pid = owner.read().split()
+            return hostname, int(pid)
+        except (OSError, ValueError):
+            return None
+
+    def sweep_orphans(self) -> int:
+        """Remove workspaces whose owning process on this host is gone"""
+        removed = 0
+        roots = [self.base_dir]
+        if self.tmpfs_enabled:
+            roots.append(os.path.join(self.tmpfs_dir, "ffmpeg-jobs"))
+
+        for root in roots:
+            if not os.path.isdir(root):
+                continue
+            for name in os.listdir(root):
+                path = os.path.join(root, name)
+                if not name.startswith("job_") or path in self._active:
+                    continue
+                owner = self._owner(path)
+                # Processes on other hosts sharing the root can't be checked from here; their own sweeper removes them
+                if owner is None or owner[0] != self.hostname:
+                    continue
+                pid = owner[1]
+                # Our own pid (e.g. pid 1 after a container restart) with no active job is an orphan too
+                if pid == os.getpid() or not self._pid_alive(pid):
+                    shutil.rmtree(path, ignore_errors=True)
+                    removed += 1
+
+        if removed:
+            logger.info("🧹 Swept %s orphaned workspace(s)", removed)
+        return removed
+
+    @staticmethod
+    def _pid_alive(pid: int) -> bool:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+
+    async def start(self):
+        """Sweep once now and then on a schedule"""
+        self.sweep_orphans()
+        if self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep_periodically())
+
+    async def stop(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            try:
+                await self._sweeper
+            except asyncio.CancelledError:
+                pass
+            self._sweeper = None
+
+    async def _sweep_periodically(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                self.sweep_orphans()
+            except Exception as e:
+                logger.warning("⚠️ Workspace sweep failed: %s", e)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active": len(self._active),
+            "waiting": self.waiting,
+            "disk_reserved_mb": round(self.disk_reserved / MB, 1),
+            "disk_budget_mb": self.disk_budget // MB,
+            "tmpfs_reserved_mb": round(self.tmpfs_reserved / MB, 1),
+            "tmpfs_enabled": self.tmpfs_enabled
+        }
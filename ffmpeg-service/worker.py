@@ -0,0 +1,36 @@
+"""Standalone job worker: runs queued jobs from the shared SQLite queue without serving HTTP
+
+    python worker.py
+
+Start as many as the host has cores for, next to the API. Set
+JOB_QUEUE_EMBEDDED_WORKER=false on the API to keep it request-only. On
+SIGTERM running jobs get DRAIN_GRACE_SECONDS to finish; the rest are requeued.
+"""
+import sys
+import signal
+import asyncio
+import logging
+
+import main
+
+logger = logging.getLogger("worker")
+
+async def run():
+    if main.job_runner is None:
+        logger.error("❌ JOB_QUEUE_ENABLED=false, there is no queue to work on")
+        return 1
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await main.start_background_services(run_jobs=True)
+    logger.info("🏭 Worker running against %s", main.job_queue.db_path)
+    await stop.wait()
+    logger.info("🛑 Worker shutting down...")
+    await main.stop_background_services(main.DRAIN_GRACE_SECONDS)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(run()))